@@ -0,0 +1,95 @@
+"""
+Extraction of fields from the answers to the questions of a meeting type
+"""
+
+import functools
+import json
+import re
+
+# field -> keywords, a question label containing any of them maps to the field
+DEFAULT_FIELDS = {
+    "phone_number": ["phone", "telephon", "telefon"],
+    "meeting_title": ["title", "titel"],
+    "meeting_comment": ["kommentar", "comment", "agenda"],
+}
+
+
+class AnswerExtractor:
+    """
+    Maps answers to fields by keywords in their question labels
+
+    The keywords of each field are compiled into one regular expression, and
+    the first answer whose label contains a keyword of a field wins. One
+    label can match several fields, e.g. "Company phone". Rules are keyed
+    by event type slug, "*" applies to all event types and the fields of a
+    slug are added to or replace those. Which answer maps to which field is
+    memoized per event type and question layout.
+    """
+
+    def __init__(self, rules=None):
+        """
+        :param rules: dict of {field: [keywords]} by event type slug or "*",
+                      by default DEFAULT_FIELDS for all event types
+        """
+        self.rules = {"*": DEFAULT_FIELDS} if rules is None else rules
+        self.matcher = functools.lru_cache(maxsize=64)(self._matcher)
+        self.layout = functools.lru_cache(maxsize=256)(self._layout)
+
+    @classmethod
+    def from_json(cls, text):
+        """
+        Create an extractor from rules in JSON, e.g. the ANSWER_FIELDS env var
+        """
+        rules = json.loads(text)
+        # fields of "*" are added to or replace the defaults, too
+        return cls(rules | {"*": DEFAULT_FIELDS | rules.get("*", {})})
+
+    def fields(self, slug):
+        """
+        Keywords by field for an event type
+        """
+        return self.rules.get("*", {}) | self.rules.get(slug, {})
+
+    def _matcher(self, slug):
+        """
+        one alternation of the keywords of each field
+        :return: list of (field, compiled pattern)
+        """
+        return [
+            (
+                field,
+                re.compile(
+                    "|".join(re.escape(keyword.lower()) for keyword in keywords)
+                    or "(?!)"
+                ),
+            )
+            for field, keywords in self.fields(slug).items()
+        ]
+
+    def _layout(self, slug, labels):
+        """
+        index of the first answer of each field
+        :return: dict of answer index by field
+        """
+        patterns = self.matcher(slug)
+        indexes = {}
+        for index, label in enumerate(labels):
+            label = label.lower()
+            for field, pattern in patterns:
+                if field not in indexes and pattern.search(label):
+                    indexes[field] = index
+            if len(indexes) == len(patterns):
+                break
+        return indexes
+
+    def extract(self, payload):
+        """
+        Values of all fields of the rules, "" if there is no matching answer
+        """
+        slug = (payload.get("event_type") or {}).get("slug")
+        answers = payload.get("answers") or []
+        labels = tuple(answer.get("question_label", "") for answer in answers)
+        values = dict.fromkeys(self.fields(slug), "")
+        for field, index in self.layout(slug, labels).items():
+            values[field] = answers[index].get("value", "")
+        return values
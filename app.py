@@ -3,48 +3,302 @@ Harmonizely.com meeting to HubSpot CRM
 """
 
 import argparse
-import datetime
+import contextvars
+import json
 import logging
+import math
 import os
-import pprint
+import random
+import threading
+import time
 
 import dotenv
 import flask
 import hubspot
-import nameparser
-import phonenumbers
-import sentry_sdk
-from hubspot.crm.associations import BatchInputPublicAssociation
-from hubspot.crm.contacts import ApiException, SimplePublicObjectInput
-from sentry_sdk.integrations.flask import FlaskIntegration
+
+import answers
+import cache
+import hubspotclient
+import hubspotcontacts
+import hubspotdeals
+import idempotency
+import jobqueue
+import logs
+import metrics
+import phones
+import pipeline
+import replay
+import server
 
 LOGFORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# personal data left out of logged payloads, see logs.redact()
+LOG_REDACT = [
+    "invitee.email",
+    "invitee.full_name",
+    "participants.email",
+    "answers.value",
+]
 CONFIG = {}  # will be loaded in main()
+QUEUE = None  # will be created in main() if QUEUE_DB is set
+IDEMPOTENCY = None  # will be created in main() if IDEMPOTENCY_DB is set
+SENTRY = None  # sentry_sdk, imported by init_sentry() if SENTRY_URL is set
+API_CLIENT = None  # shared by all requests, created by get_api_client()
+API_CLIENT_LOCK = threading.Lock()
+SPOOL_LOCK = threading.Lock()  # serializes appending payloads to the spool file
+# payloads currently processed by webhook requests and queue workers
+IN_FLIGHT = {"payloads": 0, "peak": 0}
+IN_FLIGHT_LOCK = threading.Lock()
+METRICS = metrics.Registry()  # exposed on /metrics
+METRICS.counter(
+    "hubspot_requests_total", "HubSpot API requests by operation and HTTP status"
+)
+METRICS.histogram(
+    "hubspot_request_duration_seconds", "Duration of HubSpot API requests"
+)
+METRICS.histogram(
+    "webhook_request_duration_seconds", "Duration of webhook requests by status"
+)
+METRICS.histogram(
+    "payload_duration_seconds", "Duration of processing a payload by outcome"
+)
+METRICS.histogram(
+    "payload_hubspot_requests",
+    "HubSpot API requests made to process a payload",
+    buckets=(1, 2, 4, 6, 8, 10, 12, 15, 20, 30, 50),
+)
+# shares of the HubSpot requests made for the current payload
+PAYLOAD_REQUESTS = contextvars.ContextVar("PAYLOAD_REQUESTS", default=None)
+# will be reconfigured in main()
+POOL = hubspotclient.PooledApiFactory(rate_limiter=hubspotclient.RateLimiter())
+# caches are in-process or, with CACHE_DB set, shared by all replicas
+OWNERS = cache.TTLCache(ttl=3600)  # owner ID by email, refreshed in background
+ANSWERS = answers.AnswerExtractor()  # fields taken from the answers of a payload
 APP = flask.Flask(__name__)  # Standard Flask app
+STOPPING = threading.Event()  # set on shutdown to stop the background threads
+
+# payload fields process_payload() can not do without
+REQUIRED_FIELDS = [
+    ("invitee", "email"),
+    ("invitee", "full_name"),
+    ("event_type", "name"),
+    ("scheduled_at",),
+    ("end_date",),
+    ("location",),
+    ("answers",),
+]
 
 
 def main(args):
     """
     main function
     """
-    if args.verbose:
-        logging.basicConfig(level=logging.DEBUG, format=LOGFORMAT)
-    else:
-        logging.basicConfig(level=logging.INFO, format=LOGFORMAT)
+    configure_logging(args.verbose)
 
     logging.debug("starting with arguments %s", args)
     dotenv.load_dotenv()
-    config = {}
-    config["token"] = os.environ.get("HUBSPOT_ACCESS_TOKEN")
-    config["emails"] = os.environ.get("HUBSPOT_USERS").split(",")
-    global CONFIG  # pylint: disable=global-statement
+    config = load_config()
+    global CONFIG, POOL, OWNERS  # pylint: disable=global-statement
     CONFIG = config
+    POOL = configure_hubspot_pool()
+    # the namespaces of the shared caches change with the format of their values
+    OWNERS = cache.open_cache(
+        os.environ.get("CACHE_DB"),
+        "owners.v1",
+        ttl=float(os.environ.get("OWNER_CACHE_TTL", 3600)),
+    )
+    configure_hubspot_objects()
+    if os.environ.get("ANSWER_FIELDS"):
+        # keywords of additional or event type specific answer fields
+        global ANSWERS  # pylint: disable=global-statement
+        ANSWERS = answers.AnswerExtractor.from_json(os.environ["ANSWER_FIELDS"])
     logging.info(
         "loaded HUBSPOT_ACCESS_TOKEN and HUBSPOT_USERS with emails: %s",
         CONFIG["emails"],
     )
 
-    APP.run(host="0.0.0.0", port=os.environ.get("listenport", 8080))
+    if os.environ.get("IDEMPOTENCY_DB"):
+        # remember processed deliveries to skip redeliveries of the same payload
+        global IDEMPOTENCY  # pylint: disable=global-statement
+        IDEMPOTENCY = idempotency.IdempotencyStore(
+            os.environ["IDEMPOTENCY_DB"],
+            ttl=float(os.environ.get("IDEMPOTENCY_TTL", 7 * 24 * 3600)),
+        )
+
+    if args.command == "replay":
+        processed, failed = replay.replay(
+            args.file,
+            replay_payload,
+            args.user,
+            concurrency=args.concurrency,
+            batch_size=args.batch_size,
+        )
+        logging.info("replay done: %s processed, %s failed", processed, failed)
+        close_stores()
+        return
+
+    if os.environ.get("QUEUE_DB"):
+        # accept webhooks into a durable queue and process them in the background
+        global QUEUE  # pylint: disable=global-statement
+        QUEUE = jobqueue.JobQueue(os.environ["QUEUE_DB"])
+        workers = start_queue_workers(int(os.environ.get("QUEUE_WORKERS", 4)))
+        logging.info(
+            "queueing webhooks in %s with %s pending jobs",
+            os.environ["QUEUE_DB"],
+            QUEUE.depth(),
+        )
+    else:
+        workers = []
+
+    # keep the owner IDs of all HUBSPOT_USERS cached off the webhook hot path
+    threading.Thread(
+        target=owner_refresher, name="owner-refresher", daemon=True
+    ).start()
+
+    server.serve(APP, port=int(os.environ.get("listenport", 8080)))
+
+    # let the queue workers finish their current job, the rest stays queued
+    STOPPING.set()
+    deadline = time.monotonic() + float(os.environ.get("GRACEFUL_TIMEOUT", 30))
+    for worker in workers:
+        worker.join(max(0, deadline - time.monotonic()))
+    # waitress waits only 5 seconds for the requests in progress, their daemon
+    # threads would be killed in the middle of HubSpot calls
+    remaining = wait_for_in_flight(deadline)
+    close_stores()
+    if remaining:
+        logging.warning("shut down with %s payloads still in flight", remaining)
+    else:
+        logging.info("shut down")
+
+
+def wait_for_in_flight(deadline):
+    """
+    Wait until no payload is being processed or time.monotonic() reaches deadline
+    :return: number of payloads still in flight
+    """
+    while IN_FLIGHT["payloads"] and time.monotonic() < deadline:
+        time.sleep(0.1)
+    return IN_FLIGHT["payloads"]
+
+
+def close_stores():
+    """
+    Close the database connections of the caches, IDEMPOTENCY and QUEUE
+    """
+    for store in (
+        OWNERS,
+        hubspotcontacts.CONTACTS,
+        hubspotdeals.DEALS,
+        IDEMPOTENCY,
+        QUEUE,
+    ):
+        if store is not None:
+            store.close()
+
+
+def load_config():
+    """
+    CONFIG from the env
+    """
+    config = {}
+    config["token"] = os.environ.get("HUBSPOT_ACCESS_TOKEN")
+    config["emails"] = os.environ.get("HUBSPOT_USERS").split(",")
+    # e.g. the URL of a fakehubspot server instead of https://api.hubapi.com
+    config["host"] = os.environ.get("HUBSPOT_HOST")
+    # parallel HubSpot calls per payload
+    config["concurrency"] = int(os.environ.get("HUBSPOT_CONCURRENCY", 4))
+    # country of local phone numbers if the invitee locale and timezone do not tell
+    config["phone_region"] = os.environ.get("DEFAULT_PHONE_REGION")
+    # share of webhook payloads logged in full, redacted and truncated
+    config["log_payload_rate"] = float(os.environ.get("LOG_PAYLOAD_RATE", 1))
+    config["log_redact"] = os.environ.get("LOG_REDACT", ",".join(LOG_REDACT)).split(",")
+    config["log_max_length"] = int(os.environ.get("LOG_MAX_LENGTH", 200))
+    # JSONL file for replay.replay() of the payloads received while HubSpot is down
+    config["spool_file"] = os.environ.get("SPOOL_FILE")
+    return config
+
+
+def configure_hubspot_objects():
+    """
+    Caches and settings of hubspotcontacts and hubspotdeals from the env
+    """
+    hubspotcontacts.CONTACTS = cache.open_cache(
+        os.environ.get("CACHE_DB"),
+        "contacts.v1",
+        ttl=float(os.environ.get("CONTACT_CACHE_TTL", 300)),
+        maxsize=int(os.environ.get("CONTACT_CACHE_SIZE", 1000)),
+        encode=hubspotcontacts.encode_contact,
+        decode=hubspotcontacts.decode_contact,
+    )
+    hubspotcontacts.CONTACT_NEGATIVE_TTL = float(
+        os.environ.get("CONTACT_NEGATIVE_TTL", 60)
+    )
+    if os.environ.get("NAME_TITLES"):
+        hubspotcontacts.configure_name_titles(os.environ["NAME_TITLES"].split(","))
+    hubspotdeals.DEALS = cache.open_cache(
+        os.environ.get("CACHE_DB"),
+        "deals.v1",
+        ttl=float(os.environ.get("DEAL_CACHE_TTL", 60)),
+        maxsize=10000,
+    )
+    # pipeline and stage of new deals, deals in the closed stages are not reused
+    hubspotdeals.DEAL_PIPELINE = os.environ.get("DEAL_PIPELINE", "default")
+    hubspotdeals.DEAL_STAGE = os.environ.get("DEAL_STAGE", "1159035")
+    if os.environ.get("CLOSED_DEAL_STAGES"):
+        hubspotdeals.CLOSED_DEAL_STAGES = os.environ["CLOSED_DEAL_STAGES"].split(",")
+    # deals, meetings and associations created by concurrent payloads are sent
+    # in shared batch calls, waiting for more only while other payloads are in
+    # flight
+    hubspotdeals.BATCHER = hubspotclient.MicroBatcher(
+        window=float(os.environ.get("HUBSPOT_BATCH_WINDOW", 0.05)),
+        max_items=int(os.environ.get("HUBSPOT_BATCH_ITEMS", hubspotclient.BATCH_SIZE)),
+        busy=concurrent_payloads,
+    )
+
+
+def configure_logging(verbose):
+    """
+    Log to stderr as text, or as JSON lines if LOG_FORMAT=json
+    """
+    handler = logging.StreamHandler()
+    if os.environ.get("LOG_FORMAT") == "json":
+        # one JSON object per line, with the IDs and timings of each event
+        handler.setFormatter(logs.JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOGFORMAT))
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.INFO, handlers=[handler]
+    )
+
+
+def configure_hubspot_pool():
+    """
+    PooledApiFactory with the rate limits, timeout and circuit breaker of the env
+    """
+    breaker = None
+    max_failures = int(os.environ.get("HUBSPOT_BREAKER_FAILURES", 5))
+    if max_failures > 0:
+        # fail fast while HubSpot is unavailable instead of waiting for timeouts
+        breaker = hubspotclient.CircuitBreaker(
+            max_failures=max_failures,
+            slow_call=float(os.environ.get("HUBSPOT_BREAKER_SLOW_CALL", 10)),
+            reset_timeout=float(os.environ.get("HUBSPOT_BREAKER_RESET", 30)),
+        )
+    return hubspotclient.PooledApiFactory(
+        num_pools=int(os.environ.get("HUBSPOT_POOL_SIZE", 4)),
+        maxsize=int(os.environ.get("HUBSPOT_POOL_MAXSIZE", 10)),
+        idle_timeout=float(os.environ.get("HUBSPOT_POOL_IDLE_TIMEOUT", 60)),
+        rate_limiter=hubspotclient.RateLimiter(
+            limits=[
+                (int(os.environ.get("HUBSPOT_RATE_PER_SECOND", 10)), 1),
+                (int(os.environ.get("HUBSPOT_RATE_PER_10_SECONDS", 100)), 10),
+            ],
+            max_retries=int(os.environ.get("HUBSPOT_MAX_RETRIES", 3)),
+        ),
+        observer=observe_hubspot_request,
+        circuit_breaker=breaker,
+        timeout=float(os.environ.get("HUBSPOT_TIMEOUT", 30)),
+    )
 
 
 def parse_arguments():
@@ -59,6 +313,27 @@ def parse_arguments():
         action="store_true",
         default=False,
     )
+    subparsers = parser.add_subparsers(dest="command")
+    replay_parser = subparsers.add_parser(
+        "replay", help="process the webhook payloads of a JSONL file and exit"
+    )
+    replay_parser.add_argument("file", help="JSONL file with one payload per line")
+    replay_parser.add_argument(
+        "--user",
+        help="HubSpot user email for payloads without user_email",
+    )
+    replay_parser.add_argument(
+        "--concurrency",
+        help="payloads processed in parallel",
+        type=int,
+        default=4,
+    )
+    replay_parser.add_argument(
+        "--batch-size",
+        help="payloads processed between checkpoints",
+        type=int,
+        default=100,
+    )
     args_parser = parser.parse_args()
     return args_parser
 
@@ -66,9 +341,105 @@ def parse_arguments():
 @APP.route("/")
 def healthcheck():
     """
-    healthcheck OK on root path
+    healthcheck OK on root path, with the state of the HubSpot circuit breaker
+    unless it is closed
+    """
+    breaker = POOL.circuit_breaker
+    state = "closed" if breaker is None else breaker.state()
+    if state == "closed":
+        return "OK"
+    # still healthy, payloads are spooled or queued until HubSpot is back
+    return f"OK (HubSpot circuit breaker {state})"
+
+
+@APP.route("/stats")
+def stats():
+    """
+    internal counters as JSON
+    """
+    return flask.jsonify(
+        hubspot_pool=POOL.stats(),
+        hubspot_rate_limiter=POOL.rate_limiter.stats(),
+        hubspot_batches=hubspotdeals.BATCHER.stats(),
+        hubspot_circuit_breaker=(
+            POOL.circuit_breaker.stats() if POOL.circuit_breaker else None
+        ),
+        owners=OWNERS.stats(),
+        contacts=hubspotcontacts.CONTACTS.stats(),
+        deals=hubspotdeals.DEALS.stats(),
+        names=hubspotcontacts.parse_name.cache_info()._asdict(),
+        phone_numbers=phones.normalize.cache_info()._asdict(),
+        in_flight=dict(IN_FLIGHT, queued=QUEUE.depth() if QUEUE is not None else 0),
+    )
+
+
+@APP.route("/metrics")
+def prometheus_metrics():
+    """
+    metrics in the Prometheus text format
+    """
+    rate_limiter = POOL.rate_limiter.stats() if POOL.rate_limiter else {}
+    gauges = [
+        ("payloads_in_flight", "Payloads being processed", IN_FLIGHT["payloads"]),
+        (
+            "payloads_queued",
+            "Payloads waiting in the queue",
+            QUEUE.depth() if QUEUE is not None else 0,
+        ),
+        (
+            "hubspot_requests_waiting",
+            "HubSpot API requests waiting for the rate limiter",
+            rate_limiter.get("waiting", 0),
+        ),
+        (
+            "hubspot_circuit_open",
+            "1 while HubSpot requests fail fast, see the healthcheck",
+            int(circuit_open()),
+        ),
+    ]
+    return flask.Response(METRICS.render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+def observe_hubspot_request(operation, status, seconds):
+    """
+    Record a HubSpot API request in METRICS, observer of POOL
+    """
+    METRICS.inc("hubspot_requests_total", operation=operation, status=status)
+    contexts = hubspotclient.BATCH_CONTEXTS.get()
+    if contexts is None:
+        shares = [(PAYLOAD_REQUESTS.get(), 1)]
+    else:
+        # a batched request counts evenly against the payloads it carries
+        shares = [
+            (context.get(PAYLOAD_REQUESTS), 1 / len(contexts)) for context in contexts
+        ]
+    for requests, share in shares:
+        if requests is not None:
+            # the pipeline steps share the list through their copied context
+            requests.append(share)
+    METRICS.observe("hubspot_request_duration_seconds", seconds, operation=operation)
+
+
+@APP.before_request
+def start_request_timer():
+    """
+    Remember when the request started for observe_request()
     """
-    return "OK"
+    flask.g.request_started = time.monotonic()
+
+
+@APP.after_request
+def observe_request(response):
+    """
+    Record the duration of webhook requests in METRICS
+    """
+    if flask.request.endpoint == "webhook":
+        METRICS.observe(
+            "webhook_request_duration_seconds",
+            time.monotonic() - flask.g.request_started,
+            status=str(response.status_code),
+        )
+    return response
 
 
 @APP.errorhandler(404)
@@ -87,105 +458,6 @@ def internal_error(error):
     return flask.jsonify(error=str(error)), 500
 
 
-def search_or_create_contact(
-    email, owner, first_name="", last_name="", phone_number=""
-):
-    """
-    contact searching, creation and updating
-    """
-
-    try:
-        if phone_number != "":
-            phonenumberobj = phonenumbers.parse(phone_number, None)
-            phone_number = phonenumbers.format_number(
-                phonenumberobj, phonenumbers.PhoneNumberFormat.INTERNATIONAL
-            )
-    except phonenumbers.phonenumberutil.NumberParseException:
-        # number could not be parsed, e.g. because it is a
-        # local number without country code
-        # ignore since we don't have a country to match it to
-        pass
-
-    logging.debug("got phone_number: %s", phone_number)
-
-    contact = search_contact(email)
-
-    # create contact
-    if contact is None:
-        # contact does not exist yet
-        try:
-            contact = flask.g.api_client.crm.contacts.basic_api.create(
-                SimplePublicObjectInput(
-                    properties={
-                        "email": email,
-                        "firstname": first_name,
-                        "lastname": last_name,
-                        "phone": phone_number,
-                        "hubspot_owner_id": owner,
-                    }
-                )
-            )
-            logging.debug("new contact created, searching again")
-            # search again to get all the associations
-            contact = search_contact(email)
-        except ApiException as error:
-            logging.error("Exception when creating contact: %s\n", error)
-            flask.abort(500, description=error)
-    else:
-        # contact found
-        logging.info("contact found: %s", contact)
-
-    # check if the hubspot contact has the lastname in the firstname field
-    if contact.properties["lastname"] is None or (
-        last_name != "" and contact.properties["firstname"].endswith(last_name)
-    ):
-        hubspot_update(contact, {"firstname": first_name, "lastname": last_name})
-
-    # check if the hubspot phone number should be updated
-    if phone_number != "" and (
-        contact.properties.get("phone", None) is None
-        or (
-            not contact.properties["phone"].startswith("+")
-            and phone_number.startswith("+")
-        )
-    ):
-        hubspot_update(contact, {"phone": phone_number})
-    # check if the existing hubspot phone number needs formatting
-    elif (
-        contact.properties.get("phone", None) is not None
-        and contact.properties["phone"] != ""
-    ):
-        try:
-            phonenumberobj = phonenumbers.parse(contact.properties["phone"], None)
-            formatted_phone_number = phonenumbers.format_number(
-                phonenumberobj, phonenumbers.PhoneNumberFormat.INTERNATIONAL
-            )
-            if formatted_phone_number != contact.properties["phone"]:
-                # the contacts phone number needs formatting
-                hubspot_update(contact, {"phone": formatted_phone_number})
-        except phonenumbers.phonenumberutil.NumberParseException:
-            # number could not be parsed, e.g. because it is a
-            # local number without country code
-            # ignore since we don't have a country to match it to
-            pass
-
-    return contact
-
-
-def hubspot_update(contact, properties):
-    """
-    hubspot contact update with "properties" diff
-    """
-    try:
-        logging.info("Updating contact %s to %s", contact, properties)
-        flask.g.api_client.crm.contacts.basic_api.update(
-            contact.id, SimplePublicObjectInput(properties=properties)
-        )
-    except ApiException as error:
-        logging.error("Exception when updating contact: %s\n", error)
-        flask.abort(500, description=error)
-
-
 @APP.route("/<path>", methods=["GET", "POST"])
 def webhook(path):
     """
@@ -196,406 +468,429 @@ def webhook(path):
         flask.abort(404, description="Resource not found")
 
     payload = flask.request.json
-    logging.info("got new request with payload:\n%s", pprint.pformat(payload))
+    event = {
+        "event": "webhook",
+        "user": path,
+        "uuid": payload.get("uuid") if isinstance(payload, dict) else None,
+    }
+    if random.random() < CONFIG.get("log_payload_rate", 1):
+        logging.info(
+            "got new request with payload:\n%s",
+            logs.Pretty(
+                payload,
+                CONFIG.get("log_redact", LOG_REDACT),
+                CONFIG.get("log_max_length", 200),
+            ),
+            extra=event,
+        )
+    else:
+        logging.info("got new request %s", event["uuid"], extra=event)
 
     if payload is None:
         flask.abort(400, description="no payload")
 
-    flask.g.api_client = hubspot.HubSpot(access_token=CONFIG["token"])
+    missing = missing_fields(payload)
+    if missing:
+        flask.abort(400, description="missing payload fields: " + ", ".join(missing))
+
+    if QUEUE is not None:
+        job_id = QUEUE.put(user_email=path, payload=payload)
+        logging.info("queued payload as job %s", job_id)
+        return "Accepted", 202
 
-    process_payload(user_email=path, payload=payload)
+    if circuit_open():
+        return spool(path, payload)
+
+    flask.g.api_client = get_api_client()
+
+    try:
+        handle_payload(user_email=path, payload=payload)
+    except idempotency.InFlightError:
+        flask.abort(409, description="payload is already being processed")
+    except hubspotclient.CircuitOpenError:
+        # HubSpot became unavailable while the payload was processed
+        return spool(path, payload)
 
     return "OK"
 
 
-def process_payload(user_email, payload):  # pylint: disable=too-many-branches
+def circuit_open():
     """
-    Process the payload for the hubspot user specified by email address
+    Whether HubSpot requests currently fail fast, see hubspotclient.CircuitBreaker
     """
-    first_name, last_name = parse_name(payload["invitee"]["full_name"])
+    breaker = POOL.circuit_breaker
+    return breaker is not None and breaker.state() == "open"
 
-    # get the Hubspot user id for the email address specified as the URL path
-    owner = get_owner_id(email=user_email)
 
-    try:
-        phone_number = [
-            x.get("value", "")
-            for x in payload["answers"]
-            if "phone" in x.get("question_label", "").lower()
-            or "telephon" in x.get("question_label", "").lower()
-            or "telefon" in x.get("question_label", "").lower()
-        ][0]
-    except IndexError:
-        # phone number not supplied
-        phone_number = ""
-
-    contact = search_or_create_contact(
-        payload["invitee"]["email"],
-        owner,
-        first_name,
-        last_name,
-        phone_number,
+def spool(user_email, payload):
+    """
+    Keep a payload while HubSpot is unavailable, appended to the spool file
+    in the format of replay.replay(), or else ask Harmonizely to retry it later
+    """
+    retry_after = POOL.circuit_breaker.retry_after() if POOL.circuit_breaker else 0
+    if not CONFIG.get("spool_file"):
+        logging.warning(
+            "HubSpot is unavailable, rejected payload %s", payload.get("uuid")
+        )
+        return (
+            flask.jsonify(error="HubSpot is unavailable"),
+            503,
+            {"Retry-After": str(math.ceil(retry_after) or 1)},
+        )
+    line = json.dumps({"user_email": user_email, "payload": payload})
+    with SPOOL_LOCK, open(CONFIG["spool_file"], "a", encoding="utf-8") as file:
+        file.write(line + "\n")
+    logging.warning(
+        "HubSpot is unavailable, spooled payload %s to %s",
+        payload.get("uuid"),
+        CONFIG["spool_file"],
     )
+    return "Accepted", 202
 
-    # create meeting participants contacts in hubspot
-    additional_participants = []
-    for participant in payload.get("participants", []):
-        additional_participants.append(
-            search_or_create_contact(participant["email"], owner)
-        )
 
-    #  create new deal if the contact has no deals at all
-    if not contact.associations or not contact.associations.get("deals", False):
-        try:
-            # https://developers.hubspot.com/docs/api/crm/deals
-            properties = {
-                "amount": "",
-                "closedate": payload["scheduled_at"].replace("+00:00", "Z"),
-                "dealname": "Meeting "
-                + first_name
-                + " "
-                + last_name
-                + ": "
-                + payload["event_type"]["name"],
-                "dealstage": 1159035,  # Deal stage "New" at VSHN
-                "hubspot_owner_id": owner,
-                "pipeline": "default",
-            }
-            new_deal = flask.g.api_client.crm.deals.basic_api.create(
-                SimplePublicObjectInput(properties=properties)
+def get_api_client():
+    """
+    Get the process-wide HubSpot client sharing POOL between all threads
+    """
+    global API_CLIENT  # pylint: disable=global-statement
+    with API_CLIENT_LOCK:
+        if API_CLIENT is None:
+            API_CLIENT = hubspot.HubSpot(
+                access_token=CONFIG["token"],
+                api_factory=POOL,
+                **({"host": CONFIG["host"]} if CONFIG.get("host") else {}),
             )
-            logging.debug("created deal:\n%s", pprint.pformat(new_deal))
-        except ApiException as error:
-            logging.error("Exception when creating deal: %s\n", error)
-            flask.abort(500, description=error)
+        return API_CLIENT
 
-        # add new deal to contact
-
-        associate_contact_to_deal(contact_id=contact.id, deal_id=new_deal.id)
-
-        for participant in additional_participants:
-            associate_contact_to_deal(contact_id=participant.id, deal_id=new_deal.id)
-
-        if contact.associations and contact.associations.get("companies", False):
-            # if the contact has a company associate the deal with it
-
-            associate_company_to_deal(
-                company_id=contact.associations["companies"].results[0].id,
-                deal_id=new_deal.id,
-            )
 
-    # get meetings for contact
-    # future: check if there is a meeting already
-    # future: update/delete existing meeting
+def missing_fields(payload):
     """
-    try:
-        api_response = api_client.crm.associations.batch_api.read(
-            from_object_type="Contacts",
-            to_object_type="Meetings",
-            batch_input_public_object_id=BatchInputPublicObjectId(inputs=[{"id": contact.id}]),
-        )
-        logging.debug(pprint.pformat(api_response))
-    except ApiException as error:
-        logging.debug("Exception when calling batch_api->read: %s\n", error)
-"""
-
-    try:
-        meeting_title = [
-            x.get("value", "")
-            for x in payload["answers"]
-            if "title" in x.get("question_label", "").lower()
-            or "titel" in x.get("question_label", "").lower()
-        ][0]
-    except IndexError:
-        meeting_title = ""
+    List the REQUIRED_FIELDS not present in the payload
+    """
+    missing = []
+    for field in REQUIRED_FIELDS:
+        value = payload
+        for key in field:
+            if not isinstance(value, dict) or key not in value:
+                missing.append(".".join(field))
+                break
+            value = value[key]
+    return missing
 
-    try:
-        meeting_comment = [
-            x.get("value", "")
-            for x in payload["answers"]
-            if "kommentar" in x.get("question_label", "").lower()
-            or "comment" in x.get("question_label", "").lower()
-            or "agenda" in x.get("question_label", "").lower()
-        ][0]
-    except IndexError:
-        meeting_comment = ""
-
-    # create meeting
-    try:
-        # https://developers.hubspot.com/docs/api/crm/meetings
-        properties = {
-            "hs_timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
-            "hubspot_owner_id": owner,
-            "hs_meeting_title": payload["event_type"]["name"]
-            + (": " + meeting_title if meeting_title else ""),
-            "hs_meeting_body": "Harmonizely meeting location: "
-            + str(payload["location"])
-            + ("\n" + meeting_comment if meeting_comment else ""),
-            "hs_internal_meeting_notes": "",
-            "hs_meeting_external_url": str(payload["location"]),
-            "hs_meeting_location": "Remote",
-            "hs_meeting_start_time": payload["scheduled_at"].replace("+00:00", "Z"),
-            "hs_meeting_end_time": payload["end_date"].replace("+00:00", "Z"),
-            "hs_meeting_outcome": "SCHEDULED",
-        }
 
-        meeting = flask.g.api_client.crm.objects.basic_api.create(
-            "Meetings",
-            SimplePublicObjectInput(properties=properties),
+def start_queue_workers(count):
+    """
+    Start background threads draining QUEUE through process_payload()
+    :return: list of threads
+    """
+    workers = [
+        threading.Thread(
+            target=queue_worker, name=f"queue-worker-{number}", daemon=True
         )
-        logging.debug("new meeting:\n%s", pprint.pformat(meeting))
-    except ApiException as error:
-        logging.error("Exception when creating meeting: %s\n", error)
-        flask.abort(500, description=error)
-
-    # associate new meeting with the contact
-    associate_contact_to_meeting(contact_id=contact.id, meeting_id=meeting.id)
+        for number in range(count)
+    ]
+    for worker in workers:
+        worker.start()
+    return workers
 
-    # associate participants to the meeting
-    for participant in additional_participants:
-        associate_contact_to_meeting(contact_id=participant.id, meeting_id=meeting.id)
 
-    if contact.associations and contact.associations.get("companies", False):
-        # if the contact has a company associate the meeting with it
-
-        associate_company_to_meeting(
-            company_id=contact.associations["companies"].results[0].id,
-            meeting_id=meeting.id,
-        )
-
-    # associate the meeting to the deal
-    # either the contact has existing deals or we just created one above
-    if contact.associations and contact.associations.get("deals", False):
-        new_deal = find_first_non_closed_deal(contact.associations["deals"].results)
+def queue_worker():
+    """
+    Process queued jobs until STOPPING is set
+    """
+    while not STOPPING.is_set():
+        if circuit_open():
+            # leave the jobs queued until HubSpot is probed again
+            STOPPING.wait(1)
+            continue
+        job = QUEUE.get()
+        if job is not None:
+            process_job(*job)
 
-        # if the contact has a deal associate the meeting with it
-        associate_deal_to_meeting(deal_id=new_deal.id, meeting_id=meeting.id)
 
-        # associate participants to the existing deal
-        for participant in additional_participants:
-            associate_contact_to_deal(contact_id=participant.id, deal_id=new_deal.id)
+def process_job(job_id, user_email, payload):
+    """
+    Process one queued job, re-queueing it for a later retry if it fails
+    """
+    try:
+        with APP.app_context():
+            flask.g.api_client = get_api_client()
+            handle_payload(user_email=user_email, payload=payload)
+    except hubspotclient.CircuitOpenError as error:
+        # HubSpot is unavailable, retry later without using up an attempt
+        QUEUE.release(job_id)
+        logging.warning("job %s postponed: %s", job_id, error)
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        # flask.abort() raises HTTPException, anything else is a bug
+        if SENTRY is not None:
+            SENTRY.capture_exception(error)
+        state = QUEUE.retry(job_id, error)
+        logging.error("job %s failed (%s): %s", job_id, state, error)
+    else:
+        QUEUE.done(job_id)
+        logging.info("job %s processed", job_id)
 
 
-def find_first_non_closed_deal(deals):
+def replay_payload(user_email, payload):
     """
-    Select the first non-closed deal from a list of deal associations
+    Process a payload of a replay.replay() file like a webhook of user_email
     """
-    for deal_association in deals:
-        try:
-            deal = flask.g.api_client.crm.deals.basic_api.get_by_id(deal_association.id)
-            logging.debug(
-                "deal %s found:\n%s", deal_association.id, pprint.pformat(deal)
-            )
-            if "closed" not in deal.properties["dealstage"]:
-                return deal
-        except ApiException:
-            logging.debug("deal not found: %s", deal_association.id)
-    # if we end here we didn't find a non-closed deal, so just take one
-    return deals[0]
+    if user_email not in CONFIG["emails"]:
+        raise ValueError(f"unknown user {user_email}")
+    missing = missing_fields(payload)
+    if missing:
+        raise ValueError("missing payload fields: " + ", ".join(missing))
+    with APP.app_context():
+        flask.g.api_client = get_api_client()
+        handle_payload(user_email=user_email, payload=payload)
 
 
-def parse_name(full_name):
+def concurrent_payloads():
     """
-    Parse the assumed first and last names from the full name
+    Whether other payloads are in flight, busy() of hubspotdeals.BATCHER
     """
-    # remove "Herr" and "Frau" from the name
-    # https://github.com/derek73/python-nameparser/pull/99
-    nameparser.config.CONSTANTS.titles.add("Herr", "Frau")
+    return IN_FLIGHT["payloads"] > 1
 
-    # make an educated guess about the first and last name from full_name
-    parsed_name = nameparser.HumanName(full_name)
-    first_name = parsed_name.first.strip()
-    if parsed_name.middle:
-        first_name += " " + parsed_name.middle.strip()
-    logging.debug("parsed first name: %s", first_name)
-    last_name = parsed_name.last.strip()
-    logging.debug("parsed last name: %s", last_name)
-    return first_name, last_name
 
-
-def associate_contact_to_deal(contact_id, deal_id):
+def handle_payload(user_email, payload):
     """
-    Create a bi-directional HubSpot association between a contact and a deal
+    process_payload() unless the same delivery has been processed already
+    :return: dict of the created HubSpot object IDs
     """
+    with IN_FLIGHT_LOCK:
+        IN_FLIGHT["payloads"] += 1
+        IN_FLIGHT["peak"] = max(IN_FLIGHT["peak"], IN_FLIGHT["payloads"])
+    started = time.monotonic()
+    outcome = "error"
+    requests = []
+    token = PAYLOAD_REQUESTS.set(requests)
     try:
-        association = flask.g.api_client.crm.associations.batch_api.create(
-            from_object_type="Contact",
-            to_object_type="Deal",
-            batch_input_public_association=BatchInputPublicAssociation(
-                inputs=[
-                    {
-                        "from": {"id": contact_id},
-                        "to": {"id": deal_id},
-                        "type": "contact_to_deal",
-                    }
-                ]
-            ),
+        result = deduplicated_payload(user_email, payload)
+        outcome = "ok"
+        return result
+    finally:
+        with IN_FLIGHT_LOCK:
+            IN_FLIGHT["payloads"] -= 1
+        PAYLOAD_REQUESTS.reset(token)
+        METRICS.observe(
+            "payload_duration_seconds", time.monotonic() - started, outcome=outcome
         )
-        logging.debug("associate deal with contact:\n%s", pprint.pformat(association))
-    except ApiException as error:
-        logging.error("Exception when associate deal with contact: %s\n", error)
-        flask.abort(500, description=error)
+        METRICS.observe("payload_hubspot_requests", sum(requests), outcome=outcome)
 
 
-def associate_company_to_deal(company_id, deal_id):
+def deduplicated_payload(user_email, payload):
     """
-    Create a bi-directional HubSpot association between a company and a deal
+    process_payload() with the IDEMPOTENCY store
     """
+    if IDEMPOTENCY is None or not payload.get("uuid"):
+        return process_payload(user_email=user_email, payload=payload)
 
-    logging.debug("adding deal to company association")
+    # a rescheduled meeting keeps its uuid but needs to be processed again
+    key = ":".join(
+        str(payload.get(field)) for field in ("uuid", "state", "scheduled_at")
+    )
+    result = IDEMPOTENCY.begin(key)
+    if result is not None:
+        logging.info("skipping already processed payload %s: %s", key, result)
+        return result
     try:
-        association = flask.g.api_client.crm.associations.batch_api.create(
-            from_object_type="Companies",
-            to_object_type="Deal",
-            batch_input_public_association=BatchInputPublicAssociation(
-                inputs=[
-                    {
-                        "from": {"id": company_id},
-                        "to": {"id": deal_id},
-                        "type": "company_to_deal",
-                    }
-                ]
-            ),
-        )
-        logging.debug("associate deal with company:\n%s", pprint.pformat(association))
-    except ApiException as error:
-        logging.error("Exception when associate deal with company: %s\n", error)
-        flask.abort(500, description=error)
+        result = process_payload(user_email=user_email, payload=payload)
+    except BaseException:
+        IDEMPOTENCY.release(key)
+        raise
+    IDEMPOTENCY.finish(key, result)
+    return result
 
 
-def associate_contact_to_meeting(contact_id, meeting_id):
+def process_payload(user_email, payload):
     """
-    Create a bi-directional HubSpot association between a contact and a meeting
+    Process the payload for the hubspot user specified by email address
+
+    The HubSpot calls are run as a dependency graph of steps, so e.g. the
+    meeting is created while the contacts are resolved.
+    :return: dict of the created HubSpot object IDs
     """
-    logging.debug("associate meeting with contact")
-    try:
-        association = flask.g.api_client.crm.associations.batch_api.create(
-            from_object_type="Contact",
-            to_object_type="Meeting",
-            batch_input_public_association=BatchInputPublicAssociation(
-                inputs=[
-                    {
-                        "from": {"id": contact_id},
-                        "to": {"id": meeting_id},
-                        "type": "contact_to_meeting_event",
-                    }
-                ]
+    first_name, last_name = hubspotcontacts.parse_name(payload["invitee"]["full_name"])
+
+    # collects all associations to create them in batches at the end
+    flask.g.associations = hubspotclient.AssociationBatch()
+
+    # phone number, meeting title and comment from the answers, "" if missing
+    fields = ANSWERS.extract(payload)
+
+    wanted = [
+        {
+            "email": payload["invitee"]["email"],
+            "first_name": first_name,
+            "last_name": last_name,
+            "phone_number": fields["phone_number"],
+            # local numbers are most likely from where the invitee is
+            "phone_region": phones.default_region(
+                payload["invitee"].get("locale"), payload["invitee"].get("timezone")
+            )
+            or CONFIG.get("phone_region"),
+        }
+    ]
+    # create meeting participants contacts in hubspot
+    wanted += [{"email": x["email"]} for x in payload.get("participants", [])]
+
+    results, trace = pipeline.run(
+        {
+            # get the Hubspot user id for the email address specified as the URL path
+            "owner": (lambda: get_owner_id(email=user_email), []),
+            "contacts": (
+                lambda owner: hubspotcontacts.resolve_contacts(
+                    owner, wanted, max_workers=CONFIG.get("concurrency", 4)
+                ),
+                ["owner"],
             ),
-        )
+            "meeting": (
+                lambda owner: hubspotdeals.create_meeting(owner, payload, fields),
+                ["owner"],
+            ),
+            "deal": (
+                lambda owner, contacts: hubspotdeals.find_or_create_deal(
+                    owner, contacts[0], payload, first_name, last_name
+                ),
+                ["owner", "contacts"],
+            ),
+            "associations": (
+                hubspotdeals.associate_objects,
+                ["contacts", "deal", "meeting"],
+            ),
+        },
+        max_workers=CONFIG.get("concurrency", 4),
+    )
+    contact, *additional_participants = results["contacts"]
+    ids = {
+        "contact": contact.id,
+        "participants": [participant.id for participant in additional_participants],
+        "deal": results["deal"][0].id,
+        "meeting": results["meeting"].id,
+    }
+    for name, (start, end) in trace.items():
         logging.debug(
-            "associate meeting with contact:\n%s", pprint.pformat(association)
+            "step %s took %.0f ms",
+            name,
+            (end - start) * 1000,
+            extra={
+                "event": "step",
+                "uuid": payload.get("uuid"),
+                "step": name,
+                "start_ms": round(start * 1000, 1),
+                "duration_ms": round((end - start) * 1000, 1),
+            },
         )
-    except ApiException as error:
-        logging.error("Exception when associate meeting with contact: %s\n", error)
-        flask.abort(500, description=error)
+    logging.info(
+        "processed payload: %s",
+        pipeline.describe(trace),
+        extra={
+            "event": "processed",
+            "uuid": payload.get("uuid"),
+            "duration_ms": round(max(end for _, end in trace.values()) * 1000, 1),
+            **ids,
+        },
+    )
+    return ids
 
 
-def associate_company_to_meeting(company_id, meeting_id):
+def get_owner_id(email):
     """
-    Create a bi-directional HubSpot association between a company and a meeting
+    Get the Hubspot user ID for an email, cached in OWNERS
     """
-    logging.debug("adding company association")
-    try:
-        association = flask.g.api_client.crm.associations.batch_api.create(
-            from_object_type="Companies",
-            to_object_type="Meeting",
-            batch_input_public_association=BatchInputPublicAssociation(
-                inputs=[
-                    {
-                        "from": {"id": company_id},
-                        "to": {"id": meeting_id},
-                        "type": "company_to_meeting_event",
-                    }
-                ]
-            ),
-        )
-        logging.debug(
-            "associate meeting with company:\n%s", pprint.pformat(association)
-        )
-    except ApiException as error:
-        logging.error("Exception when associate meeting with company: %s\n", error)
-        flask.abort(500, description=error)
+    owner_id = OWNERS.get(email)
+    if owner_id is None:
+        try:
+            owner_id = fetch_owner_id(email)
+        except owner_lookup_errors() as error:
+            logging.error("Exception when getting owner %s: %s\n", email, error)
+            flask.abort(500, description=error)
+    return owner_id
 
 
-def associate_deal_to_meeting(deal_id, meeting_id):
+@hubspotclient.operation("get_owner_id")
+def fetch_owner_id(email):
     """
-    Create a bi-directional HubSpot association between a deal and a meeting
+    Look up the Hubspot user ID for an email and refresh it in OWNERS
     """
-    logging.debug("adding deal association")
     try:
-        association = flask.g.api_client.crm.associations.batch_api.create(
-            from_object_type="Deals",
-            to_object_type="Meeting",
-            batch_input_public_association=BatchInputPublicAssociation(
-                inputs=[
-                    {
-                        "from": {"id": deal_id},
-                        "to": {"id": meeting_id},
-                        "type": "deal_to_meeting_event",
-                    }
-                ]
-            ),
+        owner_id = (
+            flask.g.api_client.crm.owners.owners_api.get_page(
+                email=email, limit=100, archived=False
+            )
+            .results[0]
+            .id
         )
-        logging.debug("associate meeting with deal:\n%s", pprint.pformat(association))
-    except ApiException as error:
-        logging.error("Exception when associate meeting with deal: %s\n", error)
-        flask.abort(500, description=error)
+    except owner_lookup_errors():
+        OWNERS.delete(email)
+        raise
+    OWNERS.set(email, owner_id)
+    return owner_id
 
 
-def get_owner_id(email):
+def owner_lookup_errors():
     """
-    Get the Hubspot user ID for an email
+    Exceptions of a failed owner lookup, IndexError if there is no such owner
     """
-    return (
-        flask.g.api_client.crm.owners.owners_api.get_page(
-            email=email, limit=100, archived=False
-        )
-        .results[0]
-        .id
+    from hubspot.crm.owners import (  # pylint: disable=import-outside-toplevel
+        ApiException,
     )
 
+    return (ApiException, IndexError)
+
 
-def search_contact(email):
+def owner_refresher():
     """
-    Search for a contact using the email
-    :param email: email to search for (does not need to be primary)
-    :return: dict of contact or None if not found
+    Prewarm OWNERS for all configured emails and refresh them before they expire
     """
-    try:
-        contact = flask.g.api_client.crm.contacts.basic_api.get_by_id(
-            email,
-            id_property="email",
-            associations=["Meetings", "Deals", "Companies"],
-            properties=["email", "firstname", "lastname"],
-        )
-        logging.debug("email %s found:\n%s", email, pprint.pformat(contact))
-        return contact
-    except ApiException:
-        logging.debug("email not found: %s", email)
-        return None
+    while True:
+        with APP.app_context():
+            flask.g.api_client = get_api_client()
+            for email in CONFIG["emails"]:
+                try:
+                    fetch_owner_id(email)
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    # keep refreshing, the webhook falls back to a live lookup
+                    logging.warning("could not refresh owner %s: %s", email, error)
+        if STOPPING.wait(OWNERS.ttl / 2):
+            return
 
 
 def sentry_healthcheck_sampling(context):
     """
-    Sample healthcheck requests every second to / for
+    Sample healthcheck requests every second to / and metrics scrapes for
     sentry performance monitoring wayyy lower than the rest
     """
-    if (
-        context.get("wsgi_environ", False)
-        and context["wsgi_environ"].get("REQUEST_URI", False)
-        and context["wsgi_environ"]["REQUEST_URI"] == "/"
-    ):
-        # ignore calls to the healthcheck endpoint
+    environ = context.get("wsgi_environ") or {}
+    # the development server sets REQUEST_URI, waitress only PATH_INFO
+    if environ.get("REQUEST_URI", environ.get("PATH_INFO")) in ("/", "/metrics"):
+        # ignore calls to the healthcheck and metrics endpoints
         return 0.001
     # else sample 100%
     return 1
 
 
-if __name__ == "__main__":
+def init_sentry(dsn):
+    """
+    Report errors and performance traces to Sentry, sentry_sdk takes a while
+    to import and is only imported if it is configured
+    """
+    global SENTRY  # pylint: disable=global-statement
+    import sentry_sdk  # pylint: disable=import-outside-toplevel
+    from sentry_sdk.integrations.flask import (  # pylint: disable=import-outside-toplevel
+        FlaskIntegration,
+    )
+
     sentry_sdk.init(
-        os.environ.get("SENTRY_URL"),
+        dsn,
         integrations=[FlaskIntegration()],
         traces_sampler=sentry_healthcheck_sampling,
     )
+    SENTRY = sentry_sdk
+
+
+if __name__ == "__main__":
+    if os.environ.get("SENTRY_URL"):
+        init_sentry(os.environ["SENTRY_URL"])
     ARG = parse_arguments()
     main(ARG)
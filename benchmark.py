@@ -0,0 +1,289 @@
+"""
+Benchmarks of the webhook hot path, run with `python benchmark.py --help`
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import copy
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+import timeit
+import warnings
+from pathlib import Path
+
+import nameparser
+
+import app
+import cache
+import fakehubspot
+import hubspotclient
+import hubspotcontacts
+import hubspotdeals
+
+FIRST_NAMES = ["Aarno", "Anna", "Johann Sebastian", "Marie-Louise", "Peter", "Zoë"]
+LAST_NAMES = ["Aukia", "Bach", "Müller", "van der Berg", "O'Brien", "Rossi"]
+TITLES = ["", "", "", "Herr ", "Frau ", "Dr. "]
+
+
+def name_corpus(size, seed=42):
+    """
+    Full names as in a backfill: some people booked many meetings
+    """
+    rng = random.Random(seed)
+    people = [
+        rng.choice(TITLES) + rng.choice(FIRST_NAMES) + " " + rng.choice(LAST_NAMES)
+        for _ in range(size // 10)
+    ]
+    # a few people account for most of the meetings
+    return rng.choices(
+        people, weights=[1 / (rank + 1) for rank in range(len(people))], k=size
+    )
+
+
+def uncached_parse_name(full_name):
+    """
+    parse_name() as before, configuring nameparser on every call
+    """
+    nameparser.config.CONSTANTS.titles.add("Herr", "Frau")
+    parsed_name = nameparser.HumanName(full_name)
+    first_name = parsed_name.first.strip()
+    if parsed_name.middle:
+        first_name += " " + parsed_name.middle.strip()
+    return first_name, parsed_name.last.strip()
+
+
+def bench_parse_name(size, repeat):
+    """
+    parse_name() with and without configuration once and memoization
+    """
+    names = name_corpus(size)
+    assert [hubspotcontacts.parse_name(name) for name in names] == [
+        uncached_parse_name(name) for name in names
+    ]
+    variants = {
+        "uncached": lambda: [uncached_parse_name(name) for name in names],
+        "configured once": lambda: [
+            hubspotcontacts.parse_name.__wrapped__(name) for name in names
+        ],
+        "memoized": lambda: [hubspotcontacts.parse_name(name) for name in names],
+    }
+    for label, func in variants.items():
+        seconds = min(
+            timeit.repeat(
+                func,
+                setup=hubspotcontacts.parse_name.cache_clear,
+                number=1,
+                repeat=repeat,
+            )
+        )
+        print(f"parse_name {label:>16}: {seconds / size * 1e6:8.2f} µs/name")
+
+
+def generate_payloads(count, returning=0.3, participants=1, seed=42):
+    """
+    Webhook payloads based on example.json with a unique uuid each
+    :param returning: share of invitees who booked a meeting before
+    :param participants: number of additional participants per meeting
+    """
+    rng = random.Random(seed)
+    example = json.loads(Path("example.json").read_text(encoding="utf-8"))
+    payloads = []
+    for number in range(count):
+        payload = copy.deepcopy(example)
+        invitee = number
+        if number and rng.random() < returning:
+            invitee = rng.randrange(number)
+        payload["uuid"] = f"benchmark-{number}"
+        payload["invitee"]["email"] = f"invitee{invitee}@example.com"
+        payload["invitee"]["full_name"] = (
+            rng.choice(FIRST_NAMES) + " " + rng.choice(LAST_NAMES)
+        )
+        payload["participants"] = [
+            {"email": f"participant{rng.randrange(count)}@example.com"}
+            for _ in range(participants)
+        ]
+        payloads.append(payload)
+    return payloads
+
+
+def bench_webhooks(  # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+    payloads,
+    concurrency,
+    latency,
+    error_rate,
+    rate_limit_rate,
+    rate_limit,
+    batch_window,
+):
+    """
+    Post payloads to webhook() against a fakehubspot server
+    """
+    with fakehubspot.FakeHubSpot(
+        latency=latency,
+        error_rate=error_rate,
+        rate_limit_rate=rate_limit_rate,
+        retry_after=0,
+        seed=42,
+    ) as fake:
+        fake.add_owner("user@example.com")
+        app.CONFIG = {
+            "emails": ["user@example.com"],
+            "token": "benchmark",
+            "host": fake.url,
+            "concurrency": 4,
+        }
+        app.POOL = hubspotclient.PooledApiFactory(
+            maxsize=concurrency * 4,
+            rate_limiter=hubspotclient.RateLimiter(limits=[(rate_limit, 1)]),
+        )
+        hubspotdeals.BATCHER = hubspotclient.MicroBatcher(
+            window=batch_window, busy=app.concurrent_payloads
+        )
+        app.API_CLIENT = None
+        app.OWNERS = cache.TTLCache(ttl=3600)
+        hubspotcontacts.CONTACTS = cache.TTLCache(ttl=300, maxsize=1000)
+        hubspotdeals.DEALS = cache.TTLCache(ttl=60, maxsize=10000)
+
+        def post(payload):
+            started = time.perf_counter()
+            with app.APP.test_client() as client:
+                response = client.post("/user@example.com", json=payload)
+            return response.status_code, time.perf_counter() - started
+
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(post, payloads))
+        elapsed = time.perf_counter() - started
+
+    latencies = [seconds * 1000 for _, seconds in results]
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    print(f"webhooks: {len(payloads)} payloads, concurrency {concurrency}")
+    print(f"  status codes: {dict(collections.Counter(s for s, _ in results))}")
+    print(f"  requests/s:   {len(payloads) / elapsed:8.1f}")
+    print(
+        f"  latency ms:   p50 {percentiles[49]:.1f}"
+        f"  p95 {percentiles[94]:.1f}  p99 {percentiles[98]:.1f}"
+    )
+    print(f"  API calls per payload: {fake.calls.total() / len(payloads):.2f}")
+    for name, calls in fake.calls.most_common():
+        print(f"    {name:>20}: {calls / len(payloads):.2f}")
+
+
+def import_times(module):
+    """
+    Import times of a module and its imports in a fresh interpreter
+    :return: dict of (cumulative µs, nesting depth) by module name
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: <self µs> | <cumulative µs> | <indented module name>
+        _, _, cumulative, name = line.replace("|", ":").split(":")
+        if cumulative.strip().isdigit():
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            times[name.strip()] = int(cumulative), depth
+    return times
+
+
+def bench_imports(module, repeat, top):
+    """
+    Cold start: time to import module and each of its direct imports
+    """
+    runs = [import_times(module) for _ in range(repeat)]
+    direct = {name for name, (_, depth) in runs[0].items() if depth == 1}
+    medians = {
+        name: statistics.median(run[name][0] for run in runs if name in run)
+        for name in direct | {module}
+    }
+    print(f"import {module}: {medians.pop(module) / 1000:8.1f} ms (median)")
+    for name, micros in sorted(medians.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {name:>30}: {micros / 1000:8.1f} ms")
+
+
+def main():
+    """
+    Run a benchmark
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    names_parser = subparsers.add_parser("names", help="parse_name() variants")
+    names_parser.add_argument("--size", type=int, default=5000, help="names per run")
+    names_parser.add_argument(
+        "--repeat", type=int, default=5, help="runs per benchmark"
+    )
+    webhooks_parser = subparsers.add_parser(
+        "webhooks", help="webhook() end-to-end against a fake HubSpot API"
+    )
+    webhooks_parser.add_argument(
+        "--payloads", type=int, default=500, help="number of payloads"
+    )
+    webhooks_parser.add_argument(
+        "--concurrency", type=int, default=8, help="payloads posted in parallel"
+    )
+    webhooks_parser.add_argument(
+        "--latency", type=float, default=0.05, help="seconds per HubSpot call"
+    )
+    webhooks_parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of calls failing"
+    )
+    webhooks_parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="share of calls answered with 429",
+    )
+    webhooks_parser.add_argument(
+        "--rate-limit",
+        type=int,
+        default=0,
+        help="HubSpot calls per second of the client, 0 for unlimited",
+    )
+    webhooks_parser.add_argument(
+        "--batch-window",
+        type=float,
+        default=0.05,
+        help="seconds to collect writes of concurrent payloads, 0 to disable",
+    )
+    imports_parser = subparsers.add_parser(
+        "imports", help="import time per module in fresh interpreters"
+    )
+    imports_parser.add_argument(
+        "--module", default="app", help="module to import, e.g. app.py as app"
+    )
+    imports_parser.add_argument(
+        "--repeat", type=int, default=5, help="interpreters to start"
+    )
+    imports_parser.add_argument(
+        "--top", type=int, default=15, help="slowest imports to show"
+    )
+    args = parser.parse_args()
+    if args.benchmark == "imports":
+        bench_imports(args.module, args.repeat, args.top)
+    elif args.benchmark == "names":
+        # the uncached baseline mutates the deprecated shared nameparser CONSTANTS
+        warnings.simplefilter("ignore", DeprecationWarning)
+        bench_parse_name(args.size, args.repeat)
+    else:
+        bench_webhooks(
+            generate_payloads(args.payloads),
+            args.concurrency,
+            args.latency,
+            args.error_rate,
+            args.rate_limit_rate,
+            args.rate_limit,
+            args.batch_window,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Caches for HubSpot lookups, in-process or shared by all replicas
+
+All caches have the same interface: get(key, default), set(key, value, ttl),
+delete(key), stats() and the default ttl in seconds.
+"""
+
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import jobqueue
+
+# get() default to tell a cached None (negative entry) from a cache miss
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe mapping whose entries expire ttl seconds after they were set
+
+    With maxsize set, the least recently used entries are evicted first.
+    """
+
+    def __init__(self, ttl, maxsize=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), in least recently used first order
+        self._entries = collections.OrderedDict()
+        self._counters = {"hits": 0, "misses": 0}
+
+    def get(self, key, default=None):
+        """
+        Get the cached value or default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._counters["misses"] += 1
+                return default
+            self._counters["hits"] += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache value for ttl seconds, by default the ttl of the cache
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            if self.maxsize is not None and len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Invalidate a cached value
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def close(self):
+        """
+        Nothing to release, like SQLiteCache.close()
+        """
+
+    def stats(self):
+        """
+        Hit and miss counters
+        """
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "size": len(self._entries),
+                "hits": self._counters["hits"],
+                "misses": self._counters["misses"],
+                "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+            }
+
+
+class SQLiteCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Cache in a SQLite database shared by all replicas that can open it
+
+    Entries of several caches live in one table, separated by namespace, and
+    expire ttl seconds after they were set, by the wall clock shared by all
+    processes. Values are stored as JSON, encode and decode convert values
+    that are not JSON serializable. Expired entries are deleted at most once
+    per compact_interval seconds, and with maxsize set the entries expiring
+    soonest are evicted then. As the cache only saves HubSpot calls, database
+    errors are logged and treated like misses.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        path,
+        namespace,
+        ttl,
+        maxsize=None,
+        encode=None,
+        decode=None,
+        compact_interval=60,
+    ):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self.compact_interval = compact_interval
+        self._database = jobqueue.Database(path)
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "errors": 0}
+        self._last_compaction = 0.0
+        with self._database.connection() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                )
+                """
+            )
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS cache_expiry"
+                " ON cache (namespace, expires_at)"
+            )
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self._database.close()
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def get(self, key, default=None):
+        """
+        Get the cached value or default if it is missing or expired
+        """
+        try:
+            with self._database.connection() as db:
+                row = db.execute(
+                    "SELECT value FROM cache"
+                    " WHERE namespace = ? AND key = ? AND expires_at > ?",
+                    (self.namespace, key, time.time()),
+                ).fetchone()
+        except sqlite3.Error as error:
+            logging.warning("could not read %s from cache: %s", key, error)
+            self._count("errors")
+            row = None
+        if row is None:
+            self._count("misses")
+            return default
+        self._count("hits")
+        return self.decode(json.loads(row[0]))
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache value for ttl seconds, by default the ttl of the cache
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        try:
+            with self._database.connection() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (self.namespace, key, json.dumps(self.encode(value)), expires_at),
+                )
+            self.compact()
+        except sqlite3.Error as error:
+            logging.warning("could not write %s to cache: %s", key, error)
+            self._count("errors")
+
+    def delete(self, key):
+        """
+        Invalidate a cached value for all replicas
+        """
+        try:
+            with self._database.connection() as db:
+                db.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key = ?",
+                    (self.namespace, key),
+                )
+        except sqlite3.Error as error:
+            logging.error("could not invalidate %s in cache: %s", key, error)
+            self._count("errors")
+
+    def compact(self):
+        """
+        Delete expired entries and evict beyond maxsize, at most once per
+        compact_interval seconds
+        """
+        now = time.time()
+        with self._lock:
+            if now - self._last_compaction < self.compact_interval:
+                return
+            self._last_compaction = now
+        with self._database.connection() as db:
+            db.execute(
+                "DELETE FROM cache WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, now),
+            )
+            if self.maxsize is not None:
+                db.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key IN ("
+                    " SELECT key FROM cache WHERE namespace = ?"
+                    " ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                    (self.namespace, self.namespace, self.maxsize),
+                )
+
+    def stats(self):
+        """
+        Hit and miss counters of this process and the shared number of entries
+        """
+        try:
+            with self._database.connection() as db:
+                size = db.execute(
+                    "SELECT COUNT(*) FROM cache WHERE namespace = ? AND expires_at > ?",
+                    (self.namespace, time.time()),
+                ).fetchone()[0]
+        except sqlite3.Error:
+            size = None
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "size": size,
+                **self._counters,
+                "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+            }
+
+
+def open_cache(path, namespace, ttl, maxsize=None, **codec):
+    """
+    A SQLiteCache at path shared by all replicas, or an in-process TTLCache
+    if path is empty
+    :param namespace: separates the entries of caches sharing path, include
+                      a version to change the format of keys or values
+    :param codec: encode and decode functions of a SQLiteCache
+    """
+    if not path:
+        return TTLCache(ttl=ttl, maxsize=maxsize)
+    return SQLiteCache(path, namespace, ttl=ttl, maxsize=maxsize, **codec)
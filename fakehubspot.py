@@ -0,0 +1,394 @@
+"""
+Local stand-in for the HubSpot API endpoints used by harmonizely2hubspot,
+for end-to-end tests and benchmarks
+"""
+
+import collections
+import http.server
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+TIMESTAMP = "2024-01-01T00:00:00Z"
+
+# (method, path pattern, FakeHubSpot method handling it)
+ROUTES = [
+    ("GET", r"/crm/v3/owners/?", "get_owners"),
+    ("GET", r"/crm/v3/objects/contacts/(?P<contact_id>[^/]+)", "get_contact"),
+    ("POST", r"/crm/v3/objects/contacts/batch/read", "read_contacts"),
+    ("POST", r"/crm/v3/objects/contacts/batch/create", "create_contacts"),
+    ("POST", r"/crm/v3/objects/contacts/batch/update", "update_contacts"),
+    ("POST", r"/crm/v3/objects/deals", "create_deal"),
+    ("POST", r"/crm/v3/objects/deals/batch/read", "read_deals"),
+    ("POST", r"/crm/v3/objects/deals/batch/create", "create_deals"),
+    ("POST", r"/crm/v3/objects/meetings", "create_meeting"),
+    ("POST", r"/crm/v3/objects/meetings/batch/create", "create_meetings"),
+    (
+        "POST",
+        r"/crm/v3/associations/(?P<from_type>\w+)/(?P<to_type>\w+)/batch/create",
+        "create_associations",
+    ),
+]
+
+
+class FakeHubSpot:  # pylint: disable=too-many-instance-attributes
+    """
+    In-memory HubSpot CRM served over HTTP on localhost
+
+    Every request is delayed by latency seconds, answered with 429 Too Many
+    Requests with probability rate_limit_rate and with 500 Internal Server
+    Error with probability error_rate. Requests are counted by route in calls.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self, latency=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1, seed=None
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = collections.Counter()
+        self.owners = {}  # owner ID by email
+        self.contacts = {}  # contact by email
+        self.objects = {}  # deal or meeting by ID
+        self.associations = set()  # (from_type, from_id, to_type, to_id)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1001)
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """Dispatch requests to the FakeHubSpot"""
+
+            protocol_version = "HTTP/1.1"
+            # headers and body are sent separately, do not delay the body
+            disable_nagle_algorithm = True
+
+            def do_GET(self):  # noqa: N802 pylint: disable=invalid-name
+                """Dispatch a GET request"""
+                self.respond(*fake.handle("GET", self.path, None))
+
+            def do_POST(self):  # noqa: N802 pylint: disable=invalid-name
+                """Dispatch a POST request"""
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or "null")
+                self.respond(*fake.handle("POST", self.path, body))
+
+            def respond(self, status, body, headers=()):
+                """Send a JSON response on the kept-alive connection"""
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """Keep the output of tests and benchmarks quiet"""
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        """
+        host to pass to hubspot.HubSpot()
+        """
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        threading.Thread(
+            target=self.server.serve_forever,
+            # stop() waits up to one poll interval
+            kwargs={"poll_interval": 0.05},
+            daemon=True,
+        ).start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving requests
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method, path, body):
+        """
+        Answer a request
+        :return: tuple (status, JSON body, list of (header, value))
+        """
+        url = urllib.parse.urlsplit(path)
+        query = {
+            key: ",".join(values)
+            for key, values in urllib.parse.parse_qs(url.query).items()
+        }
+        for route_method, pattern, route in ROUTES:
+            match = re.fullmatch(pattern, url.path, re.IGNORECASE)
+            if route_method == method and match:
+                name = route
+                break
+        else:
+            return 404, error("no such endpoint: " + url.path, "NOT_FOUND"), []
+
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[name] += 1
+            chance = self.random.random()
+            if chance < self.rate_limit_rate:
+                return (
+                    429,
+                    error("too many requests", "RATE_LIMITS"),
+                    [("Retry-After", str(self.retry_after))],
+                )
+            if chance < self.rate_limit_rate + self.error_rate:
+                return 500, error("internal error", "INTERNAL_ERROR"), []
+            status, response = getattr(self, name)(
+                query=query, body=body, **match.groupdict()
+            )
+        return status, response, []
+
+    def add_owner(self, email):
+        """
+        Create an owner
+        :return: owner ID
+        """
+        owner_id = str(next(self._ids))
+        self.owners[email] = owner_id
+        return owner_id
+
+    def add_contact(self, email, deal_stages=(), **properties):
+        """
+        Create a contact with a deal in each of deal_stages
+        :return: contact ID
+        """
+        contact_id = str(next(self._ids))
+        email = email.lower()
+        self.contacts[email] = {"id": contact_id, "properties": {"email": email}}
+        self.contacts[email]["properties"].update(properties)
+        for stage in deal_stages:
+            deal_id = str(next(self._ids))
+            self.objects[deal_id] = {"id": deal_id, "properties": {"dealstage": stage}}
+            self.associations.add(("contacts", contact_id, "deals", deal_id))
+        return contact_id
+
+    def get_owners(self, query, **_kwargs):
+        """
+        owners by email
+        """
+        owner_id = self.owners.get(query.get("email"))
+        owners = [] if owner_id is None else [owner(owner_id, query["email"])]
+        return 200, {"results": owners}
+
+    def get_contact(self, query, contact_id, **_kwargs):
+        """
+        contact by email with the IDs of its associated objects
+        """
+        contact = self.contacts.get(urllib.parse.unquote(contact_id).lower())
+        if contact is None:
+            return 404, error("contact not found", "OBJECT_NOT_FOUND")
+        response = simple_object(contact)
+        response["associations"] = {}
+        for to_type in query.get("associations", "").lower().split(","):
+            ids = [
+                to_id
+                for kind, from_id, kind_to, to_id in self.associations
+                if kind == "contacts"
+                and from_id == contact["id"]
+                and kind_to == to_type
+            ]
+            if ids:
+                response["associations"][to_type] = {
+                    "results": [
+                        {"id": to_id, "type": "contact_to_" + to_type[:-1]}
+                        for to_id in sorted(ids)
+                    ]
+                }
+        return 200, response
+
+    def read_contacts(self, body, **_kwargs):
+        """
+        contacts by email
+        """
+        emails = [item["id"].lower() for item in body["inputs"]]
+        found = [self.contacts[email] for email in emails if email in self.contacts]
+        missing = [email for email in emails if email not in self.contacts]
+        response = batch([simple_object(contact) for contact in found])
+        if not missing:
+            return 200, response
+        response["errors"] = [
+            dict(
+                error("contacts not found", "OBJECT_NOT_FOUND"),
+                context={"ids": missing},
+            )
+        ]
+        return 207, response
+
+    def create_contacts(self, body, **_kwargs):
+        """
+        new contacts
+        """
+        created = []
+        for item in body["inputs"]:
+            email = item["properties"]["email"].lower()
+            self.add_contact(**item["properties"])
+            created.append(simple_object(self.contacts[email]))
+        return 201, batch(created)
+
+    def update_contacts(self, body, **_kwargs):
+        """
+        changed contact properties
+        """
+        by_id = {contact["id"]: contact for contact in self.contacts.values()}
+        updated = []
+        for item in body["inputs"]:
+            by_id[item["id"]]["properties"].update(item["properties"])
+            updated.append(simple_object(by_id[item["id"]]))
+        return 200, batch(updated)
+
+    def create_deal(self, body, **_kwargs):
+        """
+        a new deal
+        """
+        return 201, simple_object(self.create_object(body["properties"]))
+
+    def read_deals(self, body, **_kwargs):
+        """
+        deals by ID
+        """
+        return 200, batch(
+            [
+                simple_object(self.objects[item["id"]])
+                for item in body["inputs"]
+                if item["id"] in self.objects
+            ]
+        )
+
+    def create_deals(self, body, **_kwargs):
+        """
+        new deals
+        """
+        return 201, batch(self.create_objects(body["inputs"]))
+
+    def create_meeting(self, body, **_kwargs):
+        """
+        a new meeting
+        """
+        return 201, simple_object(self.create_object(body["properties"]))
+
+    def create_meetings(self, body, **_kwargs):
+        """
+        new meetings
+        """
+        return 201, batch(self.create_objects(body["inputs"]))
+
+    def create_objects(self, inputs):
+        """
+        store deals or meetings of a batch create, in reverse order like
+        HubSpot does not guarantee the order of the results
+        """
+        created = []
+        for item in inputs:
+            new_object = simple_object(self.create_object(item["properties"]))
+            if "objectWriteTraceId" in item:
+                new_object["objectWriteTraceId"] = item["objectWriteTraceId"]
+            created.insert(0, new_object)
+        return created
+
+    def create_object(self, properties):
+        """
+        store a deal or meeting
+        """
+        object_id = str(next(self._ids))
+        self.objects[object_id] = {"id": object_id, "properties": dict(properties)}
+        return self.objects[object_id]
+
+    def create_associations(self, body, from_type, to_type, **_kwargs):
+        """
+        associations between two object types
+        """
+        from_type, to_type = normalize_type(from_type), normalize_type(to_type)
+        results = []
+        for item in body["inputs"]:
+            from_id, to_id = item["from"]["id"], item["to"]["id"]
+            self.associations.add((from_type, from_id, to_type, to_id))
+            self.associations.add((to_type, to_id, from_type, from_id))
+            results.append(
+                {"from": {"id": from_id}, "to": [{"id": to_id, "type": item["type"]}]}
+            )
+        return 201, batch(results)
+
+
+def normalize_type(object_type):
+    """
+    "Contact", "Contacts" and "contacts" all mean the same object type
+    """
+    object_type = object_type.lower()
+    return object_type if object_type.endswith("s") else object_type + "s"
+
+
+def simple_object(stored):
+    """
+    SimplePublicObject JSON of a stored object
+    """
+    return {
+        "id": stored["id"],
+        "properties": dict(stored["properties"], hs_object_id=stored["id"]),
+        "createdAt": TIMESTAMP,
+        "updatedAt": TIMESTAMP,
+        "archived": False,
+    }
+
+
+def owner(owner_id, email):
+    """
+    PublicOwner JSON
+    """
+    return {
+        "id": owner_id,
+        "email": email,
+        "type": "PERSON",
+        "archived": False,
+        "createdAt": TIMESTAMP,
+        "updatedAt": TIMESTAMP,
+    }
+
+
+def batch(results):
+    """
+    batch response JSON
+    """
+    return {
+        "status": "COMPLETE",
+        "results": results,
+        "startedAt": TIMESTAMP,
+        "completedAt": TIMESTAMP,
+    }
+
+
+def error(message, category):
+    """
+    error JSON
+    """
+    return {
+        "status": "error",
+        "message": message,
+        "category": category,
+        "context": {},
+        "links": {},
+        "errors": [],
+    }
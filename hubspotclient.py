@@ -0,0 +1,653 @@
+"""
+Process-wide HubSpot API client layer with a shared keep-alive connection pool
+"""
+
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import importlib.metadata
+import random
+import threading
+import time
+
+import urllib3
+
+BATCH_SIZE = 100  # maximum number of inputs HubSpot accepts per batch call
+# name of the operation HubSpot requests are made for, e.g. "search_contact"
+OPERATION = contextvars.ContextVar("OPERATION", default="other")
+# contexts of the threads whose items the current MicroBatcher call carries
+BATCH_CONTEXTS = contextvars.ContextVar("BATCH_CONTEXTS", default=None)
+# whether the current CircuitBreaker.call() is the probe of a half-open circuit
+_PROBE = contextvars.ContextVar("_PROBE", default=False)
+
+
+@contextlib.contextmanager
+def operation(name):
+    """
+    Attribute the HubSpot requests made within to the operation name
+    """
+    token = OPERATION.set(name)
+    try:
+        yield
+    finally:
+        OPERATION.reset(token)
+
+
+class PooledApiFactory:  # pylint: disable=too-many-instance-attributes
+    """
+    api_factory for hubspot.HubSpot() reusing API clients and connections
+
+    The stock factory builds a new ApiClient, and with it a new urllib3 pool
+    and TLS handshake, on every `client.crm.<object>.<api>` access. This one
+    creates one ApiClient per SDK package and lets all of them share a single
+    urllib3.PoolManager, so connections to api.hubapi.com are kept alive
+    across requests, threads and SDK packages. With a rate_limiter, every
+    HTTP request of every API is scheduled through it. With an observer, it
+    is called with the OPERATION, the HTTP status (or "error" if there is no
+    response) and the seconds taken by each HTTP request. With a
+    circuit_breaker, requests fail fast while HubSpot is unavailable. urllib3
+    does not retry, timeouts and connection errors are raised at once as the
+    ApiException of the SDK package with status 0.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        num_pools=4,
+        maxsize=10,
+        idle_timeout=60,
+        rate_limiter=None,
+        observer=None,
+        circuit_breaker=None,
+        timeout=None,
+    ):
+        """
+        :param num_pools: number of hosts to keep connection pools for
+        :param maxsize: number of connections kept alive per host
+        :param idle_timeout: seconds after which idle connections are dropped
+        :param rate_limiter: RateLimiter all requests are sent through
+        :param observer: function(operation, status, seconds) called per request
+        :param circuit_breaker: CircuitBreaker all requests are sent through
+        :param timeout: seconds to wait for a response, by default forever
+        """
+        self.idle_timeout = idle_timeout
+        self.rate_limiter = rate_limiter
+        self.observer = observer
+        self.circuit_breaker = circuit_breaker
+        self.timeout = timeout
+        self.pool_manager = urllib3.PoolManager(
+            num_pools=num_pools,
+            maxsize=maxsize,
+            cert_reqs="CERT_REQUIRED",
+            # the RateLimiter retries rate-limited requests, and failed requests
+            # must reach the CircuitBreaker instead of hanging in hidden retries
+            retries=False,
+        )
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._last_used = time.monotonic()
+        # counters of the connection pools already dropped by clear()
+        self._dropped = {"requests": 0, "connections": 0, "idle_drops": 0}
+
+    def __call__(self, api_client_package, api_name, config):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_used > self.idle_timeout:
+                # the server side has most likely closed these already
+                requests, connections = self._pool_counters()
+                self._dropped["requests"] += requests
+                self._dropped["connections"] += connections
+                self._dropped["idle_drops"] += 1
+                self.pool_manager.clear()
+            self._last_used = now
+            api_client = self._clients.get(api_client_package.__name__)
+            if api_client is None:
+                api_client = self._create_api_client(api_client_package, config)
+                self._clients[api_client_package.__name__] = api_client
+        return getattr(api_client_package, api_name)(api_client=api_client)
+
+    def _create_api_client(self, api_client_package, config):
+        configuration = api_client_package.Configuration()
+        for key, value in config.items():
+            if key == "api_key":
+                configuration.api_key["developer_hapikey"] = value
+            elif key == "retry":
+                configuration.retries = value
+            else:
+                setattr(configuration, key, value)
+        api_client = api_client_package.ApiClient(configuration=configuration)
+        api_client.rest_client.pool_manager = self.pool_manager
+        request = functools.partial(
+            _api_errors, api_client_package.ApiException, api_client.rest_client.request
+        )
+        if self.timeout is not None:
+            request = functools.partial(_timed_out, self.timeout, request)
+        if self.observer is not None:
+            request = functools.partial(_observed, self.observer, request)
+        if self.circuit_breaker is not None:
+            # only the HTTP request is timed, not waiting for the rate limiter
+            request = functools.partial(self.circuit_breaker.send, request)
+        if self.rate_limiter is not None:
+            request = functools.partial(self.rate_limiter.call, request)
+        if self.circuit_breaker is not None:
+            # rejected before waiting for the rate limiter
+            request = functools.partial(self.circuit_breaker.call, request)
+        api_client.rest_client.request = request
+        api_client.user_agent = "hubspot-api-client-python; " + (
+            importlib.metadata.version("hubspot-api-client")
+        )
+        return api_client
+
+    def _pool_counters(self):
+        requests = connections = 0
+        pools = self.pool_manager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                requests += pool.num_requests
+                connections += pool.num_connections
+        return requests, connections
+
+    def stats(self):
+        """
+        Connection reuse counters, a "hit" is a request on a kept-alive connection
+        """
+        with self._lock:
+            requests, connections = self._pool_counters()
+            requests += self._dropped["requests"]
+            connections += self._dropped["connections"]
+        return {
+            "api_clients": len(self._clients),
+            "requests": requests,
+            "hits": requests - connections,
+            "misses": connections,
+            "idle_drops": self._dropped["idle_drops"],
+        }
+
+
+def _observed(observer, request, *args, **kwargs):
+    """
+    RESTClientObject.request() reporting its outcome and duration to observer
+    """
+    status = "error"
+    started = time.monotonic()
+    try:
+        response = request(*args, **kwargs)
+        status = response.status
+        return response
+    except Exception as error:
+        # every SDK package raises its own ApiException class
+        status = getattr(error, "status", None) or "error"
+        raise
+    finally:
+        observer(OPERATION.get(), str(status), time.monotonic() - started)
+
+
+def _api_errors(api_exception, request, *args, **kwargs):
+    """
+    RESTClientObject.request() raising api_exception with status 0 for
+    timeouts and connection errors, like the SDK does for SSL errors
+    """
+    try:
+        return request(*args, **kwargs)
+    except urllib3.exceptions.HTTPError as error:
+        exception = api_exception(status=0, reason=f"{type(error).__name__}: {error}")
+        # ApiClient decodes the body of every ApiException
+        exception.body = b""
+        raise exception from error
+
+
+def _timed_out(timeout, request, *args, _request_timeout=None, **kwargs):
+    """
+    RESTClientObject.request() with a default timeout, the SDK passes none
+    """
+    return request(*args, _request_timeout=_request_timeout or timeout, **kwargs)
+
+
+class AssociationBatch:
+    """
+    Collects associations and creates them with as few batch requests as possible
+
+    Associations are grouped by (from_object_type, to_object_type) and sent as
+    one crm.associations.batch_api.create call per group and BATCH_SIZE inputs.
+    With a MicroBatcher, the groups are sent together with the associations of
+    other payloads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (from_object_type, to_object_type) -> {(from_id, to_id, type): None}
+        self._pending = {}
+
+    def add(self, kind, from_id, to_id):
+        """
+        Queue an association
+        :param kind: tuple (from_object_type, to_object_type, association type)
+        """
+        from_object_type, to_object_type, association_type = kind
+        with self._lock:
+            self._pending.setdefault((from_object_type, to_object_type), {})[
+                (from_id, to_id, association_type)
+            ] = None
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(inputs) for inputs in self._pending.values())
+
+    def flush(self, api_client, batcher=None):
+        """
+        Create all queued associations
+        :param batcher: MicroBatcher to combine them with those of other threads
+        :return: number of associations created
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (from_object_type, to_object_type), associations in pending.items():
+            inputs = [
+                {"from": {"id": from_id}, "to": {"id": to_id}, "type": kind}
+                for from_id, to_id, kind in associations
+            ]
+            send = functools.partial(
+                self.create, api_client, from_object_type, to_object_type
+            )
+            if batcher is None:
+                send(inputs)
+            else:
+                batcher.submit(
+                    ("associations", from_object_type, to_object_type), send, inputs
+                )
+        return sum(len(associations) for associations in pending.values())
+
+    def create(self, api_client, from_object_type, to_object_type, inputs):
+        """
+        Create associations of one object type pair with BATCH_SIZE inputs per call
+        :return: list of the batch response of each input
+        """
+        # the SDK package takes a while to import, see app.WARM_UP_MODULES
+        from hubspot.crm.associations import (  # pylint: disable=import-outside-toplevel
+            BatchInputPublicAssociation,
+        )
+
+        name = f"associate_{from_object_type}_to_{to_object_type}".lower()
+        responses = []
+        for start in range(0, len(inputs), BATCH_SIZE):
+            chunk = inputs[start : start + BATCH_SIZE]
+            with operation(name):
+                response = api_client.crm.associations.batch_api.create(
+                    from_object_type=from_object_type,
+                    to_object_type=to_object_type,
+                    batch_input_public_association=BatchInputPublicAssociation(
+                        inputs=chunk
+                    ),
+                )
+            responses += [response] * len(chunk)
+        return responses
+
+
+class MicroBatcher:
+    """
+    Combines the writes of concurrent threads into shared batch calls
+
+    The first thread submitting items for a key leads the batch: it waits up
+    to window seconds for other threads to add items for the same key, or
+    until max_items are pending, then sends all of them with one call and
+    hands each thread the results of its items. A result that is an
+    exception is raised in the thread of its item. If HubSpot rejects the
+    batch call, e.g. with 400 Bad Request because of one invalid item, the
+    items of each thread are sent again on their own, so only the thread
+    with the invalid item gets the error. If the call fails otherwise, all
+    threads get its exception. The leader only waits while busy() is true,
+    e.g. while other payloads are in flight, so a lone webhook is not delayed.
+    While a batch is sent, BATCH_CONTEXTS holds the contextvars.Context of
+    each thread in it, e.g. to attribute the requests to all of them.
+    """
+
+    def __init__(self, window=0.05, max_items=100, busy=None):
+        """
+        :param window: seconds to wait for more items, 0 to never wait
+        :param max_items: a batch is sent as soon as it has this many items
+        :param busy: function returning whether more items may arrive soon,
+                     by default the leader always waits
+        """
+        self.window = window
+        self.max_items = max_items
+        self.busy = busy
+        self._condition = threading.Condition()
+        # key -> batch, a list of (items, future, context) of the waiting threads
+        self._pending = {}
+        self._stats = {"batches": 0, "items": 0}
+
+    def submit(self, key, send, items):
+        """
+        Send items in one batch with those submitted for key by other threads
+        :param send: function(list of items) returning a list of one result
+                     or exception per item, called with the items of all
+                     threads of a batch
+        :return: list of the results of items
+        """
+        future = concurrent.futures.Future()
+        with self._condition:
+            batch = self._pending.setdefault(key, [])
+            batch.append((items, future, contextvars.copy_context()))
+            if sum(len(queued) for queued, _, _ in batch) >= self.max_items:
+                # full, the leader sends it right away
+                del self._pending[key]
+                self._condition.notify_all()
+        if batch[0][1] is future:
+            self._lead(key, send, batch)
+        return future.result()
+
+    def _lead(self, key, send, batch):
+        """
+        Wait for the window to end or the batch to fill up, then send it
+        """
+        with self._condition:
+            if self.window > 0 and (self.busy is None or self.busy()):
+                self._condition.wait_for(
+                    lambda: self._pending.get(key) is not batch, timeout=self.window
+                )
+            if self._pending.get(key) is batch:
+                del self._pending[key]
+            self._stats["batches"] += 1
+            self._stats["items"] += sum(len(items) for items, _, _ in batch)
+        try:
+            results = _shared(
+                [context for _, _, context in batch],
+                send,
+                [item for items, _, _ in batch for item in items],
+            )
+        # every SDK package raises its own ApiException class
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            status = getattr(error, "status", None)
+            if len(batch) == 1 or not isinstance(status, int) or status // 100 != 4:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                return
+            # nothing was written, find out whose items HubSpot rejects
+            for items, future, context in batch:
+                _resolve(future, context, send, items)
+            return
+        start = 0
+        for items, future, _ in batch:
+            _set_results(future, results[start : start + len(items)])
+            start += len(items)
+
+    def stats(self):
+        """
+        Number of batches sent and of items in them
+        """
+        with self._condition:
+            return dict(self._stats)
+
+
+def _shared(contexts, send, items):
+    """
+    send(items) with BATCH_CONTEXTS set to the contexts of the threads of items
+    """
+    token = BATCH_CONTEXTS.set(contexts)
+    try:
+        return send(items)
+    finally:
+        BATCH_CONTEXTS.reset(token)
+
+
+def _resolve(future, context, send, items):
+    """
+    Send the items of one thread of a batch and hand it the results or error
+    """
+    try:
+        results = _shared([context], send, items)
+    # every SDK package raises its own ApiException class
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        future.set_exception(error)
+    else:
+        _set_results(future, results)
+
+
+def _set_results(future, results):
+    """
+    Hand a thread its results, or the first of them that is an exception
+    """
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        future.set_exception(errors[0])
+    else:
+        future.set_result(results)
+
+
+class RateLimiter:
+    """
+    Token buckets shared by all HubSpot calls, with retries of rate-limited calls
+
+    Each limit is a bucket of `requests` tokens refilled over `seconds`, a call
+    waits until every bucket has a token. Calls answered with 429 Too Many
+    Requests pause all calls for the Retry-After time, or a jittered
+    exponential backoff, and are retried up to max_retries times.
+    """
+
+    def __init__(self, limits=((10, 1), (100, 10)), max_retries=3, backoff=1.0):
+        """
+        :param limits: list of (requests, seconds) limits
+        :param max_retries: retries of a call answered with 429
+        :param backoff: base delay in seconds of the exponential backoff
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        now = time.monotonic()
+        # [tokens, capacity, tokens refilled per second, last refill]
+        self._buckets = [
+            [requests, requests, requests / seconds, now]
+            for requests, seconds in limits
+            if requests > 0
+        ]
+        self._paused_until = now
+        self._stats = {"waiting": 0, "throttled_seconds": 0.0, "retries": 0}
+
+    def acquire(self):
+        """
+        Block until a call may be made within all limits
+        """
+        started = time.monotonic()
+        with self._lock:
+            self._stats["waiting"] += 1
+        try:
+            while True:
+                with self._lock:
+                    wait = self._take_token()
+                if wait <= 0:
+                    return
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self._stats["waiting"] -= 1
+                self._stats["throttled_seconds"] += time.monotonic() - started
+
+    def _take_token(self):
+        """
+        Take a token from every bucket
+        :return: 0 if successful or seconds to wait before trying again
+        """
+        now = time.monotonic()
+        wait = self._paused_until - now
+        for bucket in self._buckets:
+            tokens, capacity, rate, last = bucket
+            bucket[0] = tokens = min(capacity, tokens + (now - last) * rate)
+            bucket[3] = now
+            wait = max(wait, (1 - tokens) / rate)
+        if wait > 0:
+            return wait
+        for bucket in self._buckets:
+            bucket[0] -= 1
+        return 0
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func within the limits, retrying it if it is rate-limited
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                return func(*args, **kwargs)
+            # every SDK package raises its own ApiException class
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                if getattr(error, "status", None) != 429 or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_after(error)
+                if delay is None:
+                    delay = random.uniform(0, self.backoff * 2**attempt)
+                with self._lock:
+                    self._stats["retries"] += 1
+                    self._paused_until = max(
+                        self._paused_until, time.monotonic() + delay
+                    )
+            attempt += 1
+
+    @staticmethod
+    def _retry_after(error):
+        value = (getattr(error, "headers", None) or {}).get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    def stats(self):
+        """
+        Number of calls waiting for a token, total seconds waited and retries
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+class CircuitOpenError(Exception):
+    """
+    A HubSpot request was not sent because HubSpot is unavailable
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"HubSpot is unavailable, retry in {retry_after:.0f} seconds")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:  # pylint: disable=too-many-instance-attributes
+    """
+    Fails HubSpot requests fast while HubSpot is unavailable
+
+    Calls are admitted by call() and their HTTP requests sent with send(),
+    so time spent in between, e.g. waiting for the RateLimiter, does not
+    count. A request fails if it gets no response, a 5xx response or takes
+    longer than slow_call seconds, other responses like 404 or 429 are
+    successes. After max_failures consecutive failures the circuit opens:
+    calls raise CircuitOpenError without sending anything. After
+    reset_timeout seconds it is half-open, one call at a time is let through
+    as a probe. The circuit closes if its request succeeds and opens again
+    if it fails.
+    """
+
+    def __init__(self, max_failures=5, slow_call=10.0, reset_timeout=30.0):
+        """
+        :param max_failures: consecutive failures opening the circuit
+        :param slow_call: seconds after which a response counts as a failure,
+                          None to only count errors
+        :param reset_timeout: seconds until the first probe of an open circuit
+        """
+        self.max_failures = max_failures
+        self.slow_call = slow_call
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None  # time.monotonic() the circuit opened, if open
+        self._probing = False
+        self._stats = {"opened": 0, "rejected": 0}
+
+    def state(self):
+        """
+        "closed", "open" or "half-open" if the next request will be a probe
+        """
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or self.retry_after() > 0:
+            return "open"
+        return "half-open"
+
+    def retry_after(self):
+        """
+        Seconds until an open circuit is half-open, 0 if it is not open
+        """
+        opened_at = self._opened_at
+        if opened_at is None:
+            return 0
+        return max(0, opened_at + self.reset_timeout - time.monotonic())
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func unless the circuit is open, func sends requests with send()
+        """
+        with self._lock:
+            state = self._state()
+            if state == "open":
+                self._stats["rejected"] += 1
+                raise CircuitOpenError(self.retry_after())
+            probe = state == "half-open"
+            if probe:
+                self._probing = True
+        token = _PROBE.set(probe)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _PROBE.reset(token)
+            if probe:
+                with self._lock:
+                    self._probing = False
+
+    def send(self, request, *args, **kwargs):
+        """
+        Send an HTTP request of call(), recording whether it failed
+        """
+        failed = True
+        started = time.monotonic()
+        try:
+            response = request(*args, **kwargs)
+            failed = (
+                self.slow_call is not None
+                and time.monotonic() - started > self.slow_call
+            )
+            return response
+        # every SDK package raises its own ApiException class
+        except Exception as error:
+            # status 0 for SSL and connection errors
+            status = getattr(error, "status", None)
+            failed = not isinstance(status, int) or not 0 < status < 500
+            raise
+        finally:
+            self._record(failed, _PROBE.get())
+
+    def _record(self, failed, probe):
+        with self._lock:
+            if not failed:
+                # a response to a request sent before the circuit opened
+                # does not close it
+                if probe or self._opened_at is None:
+                    self._failures = 0
+                    self._opened_at = None
+                return
+            self._failures += 1
+            if probe or (
+                self._opened_at is None and self._failures >= self.max_failures
+            ):
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+
+    def stats(self):
+        """
+        State, consecutive failures, times opened and requests rejected
+        """
+        with self._lock:
+            return dict(self._stats, state=self._state(), failures=self._failures)
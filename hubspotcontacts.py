@@ -0,0 +1,405 @@
+"""
+HubSpot contacts of a meeting, found, created and fixed up in batches
+"""
+
+import datetime
+import functools
+import logging
+
+import flask
+
+import cache
+import hubspotclient
+import logs
+import phones
+import pipeline
+
+# caches are in-process or, with CACHE_DB set, shared by all replicas
+# contact by contact_cache_key(email), None for emails not found in HubSpot
+CONTACTS = cache.TTLCache(ttl=300, maxsize=1000)
+CONTACT_NEGATIVE_TTL = 60  # seconds to remember that an email was not found
+# titles removed by parse_name() in addition to the nameparser defaults
+# https://github.com/derek73/python-nameparser/pull/99
+NAME_TITLES = ["Herr", "Frau"]
+
+
+def resolve_contacts(owner, wanted, max_workers=4):
+    """
+    Find or create contacts with a constant number of HubSpot calls, no matter
+    how many participants a meeting has: one read for the invitee (the only
+    one whose associations are needed), one batch read for the participants,
+    one batch create for the missing contacts and one batch update for the
+    name and phone number fix-ups.
+    :param owner: owner ID of created contacts
+    :param wanted: list of dicts with "email" and optionally "first_name",
+                   "last_name", "phone_number" and "phone_region" (country of
+                   local phone numbers), the invitee first
+    :param max_workers: maximum number of parallel HubSpot calls
+    :return: list of contacts in the order of wanted
+    """
+    for details in wanted:
+        details["phone_number"] = phones.normalize(
+            details.get("phone_number", ""), details.get("phone_region")
+        )
+        logging.debug("got phone_number: %s", details["phone_number"])
+
+    # participants are also served from CONTACTS if cached with associations
+    keys = [contact_cache_key(details["email"]) for details in wanted]
+    found = {key: CONTACTS.get(key, cache.MISSING) for key in keys[1:]}
+    uncached = [key for key, contact in found.items() if contact is cache.MISSING]
+    invitee, participants = pipeline.map_concurrently(
+        lambda task: task(),
+        [
+            lambda: search_contact(wanted[0]["email"]),
+            lambda: read_contacts(uncached),
+        ],
+        max_workers=max_workers,
+    )
+    found.update(participants)
+    found[keys[0]] = invitee
+
+    # create contacts that do not exist yet
+    missing = {}
+    for key, details in zip(keys, wanted, strict=True):
+        if found[key] is None:
+            missing.setdefault(key, details)
+    if missing:
+        found.update(create_contacts(owner, missing))
+
+    updates = {}
+    for key, details in zip(keys, wanted, strict=True):
+        properties = contact_fixups(
+            found[key],
+            details.get("first_name", ""),
+            details.get("last_name", ""),
+            details["phone_number"],
+            details.get("phone_region"),
+        )
+        if properties:
+            updates.setdefault(key, (found[key], properties))
+    if updates:
+        hubspot_update(list(updates.values()))
+
+    return [found[key] for key in keys]
+
+
+@hubspotclient.operation("read_contacts")
+def read_contacts(keys):
+    """
+    Batch read contacts by email
+    :return: dict of contact by cache key, None for emails not found
+    """
+    from hubspot.crm.contacts import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+        BatchReadInputSimplePublicObjectId,
+        SimplePublicObjectId,
+    )
+
+    found = {}
+    for start in range(0, len(keys), hubspotclient.BATCH_SIZE):
+        chunk = keys[start : start + hubspotclient.BATCH_SIZE]
+        try:
+            response = flask.g.api_client.crm.contacts.batch_api.read(
+                BatchReadInputSimplePublicObjectId(
+                    id_property="email",
+                    inputs=[SimplePublicObjectId(id=key) for key in chunk],
+                    properties=["email", "firstname", "lastname", "phone"],
+                    properties_with_history=[],
+                )
+            )
+        except ApiException as error:
+            logging.error("Exception when reading contacts: %s\n", error)
+            flask.abort(500, description=error)
+        for contact in response.results:
+            found[contact_cache_key(contact.properties["email"])] = contact
+        for error in getattr(response, "errors", None) or []:
+            for key in (error.context or {}).get("ids", []):
+                found[contact_cache_key(key)] = None
+        for key in chunk:
+            if key not in found:
+                # matched by a secondary email address
+                found[key] = search_contact(key)
+    return found
+
+
+@hubspotclient.operation("create_contacts")
+def create_contacts(owner, missing):
+    """
+    Batch create contacts and write them through to CONTACTS
+    :param missing: dict of contact details by cache key
+    :return: dict of contact by cache key
+    """
+    from hubspot.crm.contacts import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+        BatchInputSimplePublicObjectBatchInputForCreate,
+        SimplePublicObjectBatchInputForCreate,
+        SimplePublicObjectWithAssociations,
+    )
+
+    created = {}
+    items = list(missing.values())
+    for start in range(0, len(items), hubspotclient.BATCH_SIZE):
+        try:
+            response = flask.g.api_client.crm.contacts.batch_api.create(
+                BatchInputSimplePublicObjectBatchInputForCreate(
+                    inputs=[
+                        SimplePublicObjectBatchInputForCreate(
+                            associations=[],
+                            properties={
+                                "email": details["email"],
+                                "firstname": details.get("first_name", ""),
+                                "lastname": details.get("last_name", ""),
+                                "phone": details["phone_number"],
+                                "hubspot_owner_id": owner,
+                            },
+                        )
+                        for details in items[start : start + hubspotclient.BATCH_SIZE]
+                    ]
+                )
+            )
+        except ApiException as error:
+            logging.error("Exception when creating contacts: %s\n", error)
+            flask.abort(500, description=error)
+        for new_contact in response.results:
+            # write-through, a new contact has no associations yet
+            contact = SimplePublicObjectWithAssociations(
+                id=new_contact.id,
+                properties=new_contact.properties,
+                created_at=new_contact.created_at,
+                updated_at=new_contact.updated_at,
+                archived=new_contact.archived,
+            )
+            key = contact_cache_key(contact.properties["email"])
+            CONTACTS.set(key, contact)
+            created[key] = contact
+    logging.debug("new contacts created: %s", ", ".join(created))
+    return created
+
+
+def contact_fixups(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    contact, first_name="", last_name="", phone_number="", phone_region=None
+):
+    """
+    Properties of an existing contact to update from the meeting details,
+    all changes of a contact are written with one update
+    :param phone_region: country of local phone numbers
+    :return: dict of properties, empty if nothing needs to be updated
+    """
+    properties = {}
+
+    # check if the hubspot contact has the lastname in the firstname field, the
+    # responses of batch creates only include the properties that were sent
+    if (first_name or last_name) and (
+        contact.properties.get("lastname") is None
+        or (
+            last_name != ""
+            and (contact.properties.get("firstname") or "").endswith(last_name)
+        )
+    ):
+        properties.update(firstname=first_name, lastname=last_name)
+
+    # check if the hubspot phone number should be updated
+    phone = contact.properties.get("phone", None)
+    if phone_number != "" and (
+        not phone or (not phone.startswith("+") and phone_number.startswith("+"))
+    ):
+        properties["phone"] = phone_number
+    # check if the existing hubspot phone number needs formatting
+    elif phone is not None and phone != "":
+        formatted_phone_number = phones.normalize(phone, phone_region)
+        if formatted_phone_number != phone:
+            # the contacts phone number needs formatting
+            properties["phone"] = formatted_phone_number
+
+    # skip writes that would not change anything
+    return {
+        name: value
+        for name, value in properties.items()
+        if contact.properties.get(name) != value
+    }
+
+
+@hubspotclient.operation("update_contacts")
+def hubspot_update(updates):
+    """
+    hubspot contact batch update with "properties" diffs
+    :param updates: list of (contact, properties) tuples
+    """
+    from hubspot.crm.contacts import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+        BatchInputSimplePublicObjectBatchInput,
+        SimplePublicObjectBatchInput,
+        SimplePublicObjectWithAssociations,
+    )
+
+    for start in range(0, len(updates), hubspotclient.BATCH_SIZE):
+        chunk = updates[start : start + hubspotclient.BATCH_SIZE]
+        try:
+            # IDs and property names only, the values are personal data
+            logging.info(
+                "updating contacts %s",
+                {contact.id: sorted(properties) for contact, properties in chunk},
+            )
+            flask.g.api_client.crm.contacts.batch_api.update(
+                BatchInputSimplePublicObjectBatchInput(
+                    inputs=[
+                        SimplePublicObjectBatchInput(
+                            id=contact.id, properties=properties
+                        )
+                        for contact, properties in chunk
+                    ]
+                )
+            )
+        except ApiException as error:
+            logging.error("Exception when updating contacts: %s\n", error)
+            flask.abort(500, description=error)
+    for contact, properties in updates:
+        # write-through so cached lookups see the updated properties
+        contact.properties.update(properties)
+        key = contact_cache_key(contact.properties["email"])
+        if isinstance(contact, SimplePublicObjectWithAssociations):
+            CONTACTS.set(key, contact)
+        else:
+            # read without associations, drop a copy cached e.g. by another replica
+            CONTACTS.delete(key)
+
+
+@hubspotclient.operation("search_contact")
+def search_contact(email):
+    """
+    Search for a contact using the email, cached in CONTACTS
+    :param email: email to search for (does not need to be primary)
+    :return: dict of contact or None if not found
+    """
+    from hubspot.crm.contacts import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+    )
+
+    key = contact_cache_key(email)
+    contact = CONTACTS.get(key, cache.MISSING)
+    if contact is not cache.MISSING:
+        logging.debug("email %s found in cache", email)
+        return contact
+    try:
+        contact = flask.g.api_client.crm.contacts.basic_api.get_by_id(
+            email,
+            id_property="email",
+            # not "Meetings", they are not used and would be stale in CONTACTS
+            associations=["Deals", "Companies"],
+            properties=["email", "firstname", "lastname", "phone"],
+        )
+        logging.debug("email %s found:\n%s", email, logs.Pretty(contact))
+        CONTACTS.set(key, contact)
+        return contact
+    except ApiException as error:
+        logging.debug("email not found: %s", email)
+        if error.status == 404:
+            CONTACTS.set(key, None, ttl=CONTACT_NEGATIVE_TTL)
+        return None
+
+
+def forget_contacts(contacts):
+    """
+    Drop contacts from CONTACTS, e.g. after associating them with a new deal
+    """
+    for contact in contacts:
+        CONTACTS.delete(contact_cache_key(contact.properties["email"]))
+
+
+def contact_cache_key(email):
+    """
+    Normalize an email address for use as CONTACTS key
+    """
+    return email.strip().lower()
+
+
+def encode_contact(contact):
+    """
+    JSON serializable form of a contact in CONTACTS, None for emails not found
+    """
+    if contact is None:
+        return None
+    return {
+        "id": contact.id,
+        "properties": contact.properties,
+        "created_at": contact.created_at and contact.created_at.isoformat(),
+        "updated_at": contact.updated_at and contact.updated_at.isoformat(),
+        "archived": contact.archived,
+        "associations": {
+            to_type: [
+                {"id": associated.id, "type": associated.type}
+                for associated in collection.results
+            ]
+            for to_type, collection in (contact.associations or {}).items()
+        },
+    }
+
+
+def decode_contact(data):
+    """
+    Contact in CONTACTS from encode_contact()
+    """
+    from hubspot.crm.contacts import (  # pylint: disable=import-outside-toplevel
+        AssociatedId,
+        CollectionResponseAssociatedId,
+        SimplePublicObjectWithAssociations,
+    )
+
+    if data is None:
+        return None
+    return SimplePublicObjectWithAssociations(
+        id=data["id"],
+        properties=data["properties"],
+        created_at=data["created_at"]
+        and datetime.datetime.fromisoformat(data["created_at"]),
+        updated_at=data["updated_at"]
+        and datetime.datetime.fromisoformat(data["updated_at"]),
+        archived=data["archived"],
+        associations={
+            to_type: CollectionResponseAssociatedId(
+                results=[AssociatedId(**associated) for associated in results]
+            )
+            for to_type, results in data["associations"].items()
+        },
+    )
+
+
+def configure_name_titles(titles):
+    """
+    Remove these titles and salutations from names, in addition to "Herr",
+    "Frau" and the nameparser defaults
+    """
+    NAME_TITLES.extend(title.strip() for title in titles)
+    # names parsed before may have changed
+    name_constants.cache_clear()
+    parse_name.cache_clear()
+
+
+@functools.cache
+def name_constants():
+    """
+    nameparser configuration of parse_name() with NAME_TITLES as titles
+    """
+    import nameparser  # pylint: disable=import-outside-toplevel
+
+    constants = nameparser.config.Constants()
+    constants.titles.add(*NAME_TITLES)
+    return constants
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_name(full_name):
+    """
+    Parse the assumed first and last names from the full name, memoized
+    """
+    # make an educated guess about the first and last name from full_name
+    import nameparser  # pylint: disable=import-outside-toplevel
+
+    parsed_name = nameparser.HumanName(full_name, constants=name_constants())
+    first_name = parsed_name.first.strip()
+    if parsed_name.middle:
+        first_name += " " + parsed_name.middle.strip()
+    logging.debug("parsed first name: %s", first_name)
+    last_name = parsed_name.last.strip()
+    logging.debug("parsed last name: %s", last_name)
+    return first_name, last_name
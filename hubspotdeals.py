@@ -0,0 +1,354 @@
+"""
+HubSpot deals and meetings of a payload and their associations
+"""
+
+import datetime
+import functools
+import logging
+
+import flask
+
+import answers
+import cache
+import hubspotclient
+import hubspotcontacts
+import logs
+
+# pipeline and stage of new deals, "New" at VSHN
+DEAL_PIPELINE = "default"
+DEAL_STAGE = "1159035"
+# stages of the deals not reused, by default those with "closed" in their ID
+CLOSED_DEAL_STAGES = None
+DEALS = cache.TTLCache(ttl=60, maxsize=10000)  # deal stage by deal ID
+# will be reconfigured in main(), until then batches are sent right away
+BATCHER = hubspotclient.MicroBatcher(window=0)
+
+# (from_object_type, to_object_type, association type) for batch_api.create
+CONTACT_TO_DEAL = ("Contact", "Deal", "contact_to_deal")
+COMPANY_TO_DEAL = ("Companies", "Deal", "company_to_deal")
+CONTACT_TO_MEETING = ("Contact", "Meeting", "contact_to_meeting_event")
+COMPANY_TO_MEETING = ("Companies", "Meeting", "company_to_meeting_event")
+DEAL_TO_MEETING = ("Deals", "Meeting", "deal_to_meeting_event")
+
+
+@hubspotclient.operation("create_deal")
+def find_or_create_deal(owner, contact, payload, first_name, last_name):
+    """
+    Select the first non-closed deal of the contact or create a new deal
+    :return: tuple (deal, True if the deal was created)
+    """
+    from hubspot.crm.objects import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+    )
+
+    if contact.associations and contact.associations.get("deals", False):
+        return find_first_non_closed_deal(contact.associations["deals"].results), False
+
+    #  create new deal if the contact has no deals at all
+    try:
+        # https://developers.hubspot.com/docs/api/crm/deals
+        properties = {
+            "amount": "",
+            "closedate": payload["scheduled_at"].replace("+00:00", "Z"),
+            "dealname": "Meeting "
+            + first_name
+            + " "
+            + last_name
+            + ": "
+            + payload["event_type"]["name"],
+            "dealstage": DEAL_STAGE,
+            "hubspot_owner_id": owner,
+            "pipeline": DEAL_PIPELINE,
+        }
+        new_deal = batch_create("deals", properties)
+        logging.debug("created deal:\n%s", logs.Pretty(new_deal))
+    except ApiException as error:
+        logging.error("Exception when creating deal: %s\n", error)
+        flask.abort(500, description=error)
+
+    DEALS.set(new_deal.id, properties["dealstage"])
+    return new_deal, True
+
+
+@hubspotclient.operation("create_meeting")
+def create_meeting(owner, payload, fields):
+    """
+    Create the meeting, it only depends on the owner and the payload
+    :param fields: answer fields extracted by answers.AnswerExtractor
+    """
+    from hubspot.crm.objects import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+    )
+
+    # get meetings for contact
+    # future: check if there is a meeting already
+    # future: update/delete existing meeting
+    """
+    try:
+        api_response = api_client.crm.associations.batch_api.read(
+            from_object_type="Contacts",
+            to_object_type="Meetings",
+            batch_input_public_object_id=BatchInputPublicObjectId(inputs=[{"id": contact.id}]),
+        )
+        logging.debug(logs.Pretty(api_response))
+    except ApiException as error:
+        logging.debug("Exception when calling batch_api->read: %s\n", error)
+"""
+
+    meeting_title = fields["meeting_title"]
+    # answers of the fields added with ANSWER_FIELDS are appended to the body
+    added = [
+        f"{field}: {value}"
+        for field, value in fields.items()
+        if field not in answers.DEFAULT_FIELDS and value
+    ]
+    meeting_comment = "\n".join(filter(None, [fields["meeting_comment"], *added]))
+
+    # create meeting
+    try:
+        # https://developers.hubspot.com/docs/api/crm/meetings
+        properties = {
+            "hs_timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+            "hubspot_owner_id": owner,
+            "hs_meeting_title": payload["event_type"]["name"]
+            + (": " + meeting_title if meeting_title else ""),
+            "hs_meeting_body": "Harmonizely meeting location: "
+            + str(payload["location"])
+            + ("\n" + meeting_comment if meeting_comment else ""),
+            "hs_internal_meeting_notes": "",
+            "hs_meeting_external_url": str(payload["location"]),
+            "hs_meeting_location": "Remote",
+            "hs_meeting_start_time": payload["scheduled_at"].replace("+00:00", "Z"),
+            "hs_meeting_end_time": payload["end_date"].replace("+00:00", "Z"),
+            "hs_meeting_outcome": "SCHEDULED",
+        }
+
+        meeting = batch_create("meetings", properties)
+        logging.debug("new meeting:\n%s", logs.Pretty(meeting))
+    except ApiException as error:
+        logging.error("Exception when creating meeting: %s\n", error)
+        flask.abort(500, description=error)
+    return meeting
+
+
+def batch_create(object_type, properties):
+    """
+    Create a HubSpot object in one batch call with those of concurrent payloads
+    :return: the new object
+    """
+    return BATCHER.submit(
+        object_type, functools.partial(create_objects, object_type), [properties]
+    )[0]
+
+
+def create_objects(object_type, properties):
+    """
+    Batch create objects, e.g. "deals" or "meetings"
+    :param properties: list of dicts of properties, one per object
+    :return: list of the new objects in the order of properties, ApiException
+             for those missing in the response
+    """
+    from hubspot.crm.objects import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+        BatchInputSimplePublicObjectBatchInputForCreate,
+        SimplePublicObjectBatchInputForCreate,
+    )
+
+    created = []
+    for start in range(0, len(properties), hubspotclient.BATCH_SIZE):
+        chunk = properties[start : start + hubspotclient.BATCH_SIZE]
+        response = flask.g.api_client.crm.objects.batch_api.create(
+            object_type,
+            BatchInputSimplePublicObjectBatchInputForCreate(
+                inputs=[
+                    SimplePublicObjectBatchInputForCreate(
+                        associations=[],
+                        object_write_trace_id=str(index),
+                        properties=object_properties,
+                    )
+                    for index, object_properties in enumerate(chunk)
+                ]
+            ),
+        )
+        # the results are not necessarily in the order of the inputs
+        by_trace_id = {
+            new_object.object_write_trace_id: new_object
+            for new_object in response.results
+        }
+        # the others of the batch were created, fail only the missing ones
+        created += [
+            by_trace_id.get(str(index))
+            or ApiException(reason=f"no {object_type} created for input {index}")
+            for index in range(len(chunk))
+        ]
+    logging.debug("created %s %s", len(created), object_type)
+    return created
+
+
+def associate_objects(contacts, deal, meeting):
+    """
+    Associate the contacts, their company, the deal and the meeting
+    :param deal: tuple (deal, True if the deal was created)
+    """
+    contact, *additional_participants = contacts
+    deal, created = deal
+    company = None
+    if contact.associations and contact.associations.get("companies", False):
+        company = contact.associations["companies"].results[0].id
+
+    if created:
+        # add new deal to contact
+        associate_contact_to_deal(contact_id=contact.id, deal_id=deal.id)
+
+        for participant in additional_participants:
+            associate_contact_to_deal(contact_id=participant.id, deal_id=deal.id)
+
+        if company is not None:
+            # if the contact has a company associate the deal with it
+            associate_company_to_deal(company_id=company, deal_id=deal.id)
+
+    # associate new meeting with the contact
+    associate_contact_to_meeting(contact_id=contact.id, meeting_id=meeting.id)
+
+    # associate participants to the meeting
+    for participant in additional_participants:
+        associate_contact_to_meeting(contact_id=participant.id, meeting_id=meeting.id)
+
+    if company is not None:
+        # if the contact has a company associate the meeting with it
+        associate_company_to_meeting(company_id=company, meeting_id=meeting.id)
+
+    if not created:
+        # if the contact has a deal associate the meeting with it
+        associate_deal_to_meeting(deal_id=deal.id, meeting_id=meeting.id)
+
+        # associate participants to the existing deal
+        for participant in additional_participants:
+            associate_contact_to_deal(contact_id=participant.id, deal_id=deal.id)
+
+    try:
+        flush_associations()
+    finally:
+        # the cached contacts associated with the deal, participants included,
+        # do not know about it, even if only some associations were created
+        hubspotcontacts.forget_contacts(
+            contacts if created else additional_participants
+        )
+
+
+def find_first_non_closed_deal(deals):
+    """
+    Select the first non-closed deal from a list of deal associations
+    """
+    stages = get_deal_stages([x.id for x in deals])
+    for deal in deals:
+        stage = stages.get(deal.id)
+        if stage is not None and not is_closed_deal_stage(stage):
+            return deal
+    # if we end here we didn't find a non-closed deal, so just take one
+    return deals[0]
+
+
+def is_closed_deal_stage(stage):
+    """
+    Whether a deal in this stage is closed, by default if its ID contains
+    "closed" like the stages "closedwon" and "closedlost" of the default pipeline
+    """
+    if CLOSED_DEAL_STAGES is None:
+        return "closed" in str(stage)
+    return str(stage) in CLOSED_DEAL_STAGES
+
+
+@hubspotclient.operation("read_deals")
+def get_deal_stages(deal_ids):
+    """
+    Get the stages of deals from DEALS or with batch reads of the others
+    :return: dict of deal stage by deal ID, without deals that can not be read
+    """
+    from hubspot.crm.deals import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+        BatchReadInputSimplePublicObjectId,
+        SimplePublicObjectId,
+    )
+
+    stages = {}
+    uncached = []
+    for deal_id in deal_ids:
+        stage = DEALS.get(deal_id)
+        if stage is None:
+            uncached.append(deal_id)
+        else:
+            stages[deal_id] = stage
+    for start in range(0, len(uncached), hubspotclient.BATCH_SIZE):
+        try:
+            response = flask.g.api_client.crm.deals.batch_api.read(
+                BatchReadInputSimplePublicObjectId(
+                    inputs=[
+                        SimplePublicObjectId(id=deal_id)
+                        for deal_id in uncached[
+                            start : start + hubspotclient.BATCH_SIZE
+                        ]
+                    ],
+                    properties=["dealstage"],
+                    properties_with_history=[],
+                )
+            )
+        except ApiException as error:
+            logging.warning("could not read deals: %s", error)
+            continue
+        for deal in response.results:
+            logging.debug("deal %s in stage %s", deal.id, deal.properties["dealstage"])
+            stages[deal.id] = deal.properties["dealstage"]
+            DEALS.set(deal.id, deal.properties["dealstage"])
+    return stages
+
+
+def associate_contact_to_deal(contact_id, deal_id):
+    """
+    Queue a bi-directional HubSpot association between a contact and a deal
+    """
+    flask.g.associations.add(CONTACT_TO_DEAL, contact_id, deal_id)
+
+
+def associate_company_to_deal(company_id, deal_id):
+    """
+    Queue a bi-directional HubSpot association between a company and a deal
+    """
+    flask.g.associations.add(COMPANY_TO_DEAL, company_id, deal_id)
+
+
+def associate_contact_to_meeting(contact_id, meeting_id):
+    """
+    Queue a bi-directional HubSpot association between a contact and a meeting
+    """
+    flask.g.associations.add(CONTACT_TO_MEETING, contact_id, meeting_id)
+
+
+def associate_company_to_meeting(company_id, meeting_id):
+    """
+    Queue a bi-directional HubSpot association between a company and a meeting
+    """
+    flask.g.associations.add(COMPANY_TO_MEETING, company_id, meeting_id)
+
+
+def associate_deal_to_meeting(deal_id, meeting_id):
+    """
+    Queue a bi-directional HubSpot association between a deal and a meeting
+    """
+    flask.g.associations.add(DEAL_TO_MEETING, deal_id, meeting_id)
+
+
+def flush_associations():
+    """
+    Create all associations queued by the associate_* functions
+    """
+    from hubspot.crm.associations import (  # pylint: disable=import-outside-toplevel
+        ApiException,
+    )
+
+    try:
+        created = flask.g.associations.flush(flask.g.api_client, BATCHER)
+        logging.debug("created %s associations", created)
+    except ApiException as error:
+        logging.error("Exception when creating associations: %s\n", error)
+        flask.abort(500, description=error)
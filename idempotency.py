@@ -0,0 +1,132 @@
+"""
+Persistent idempotency store to process each webhook delivery only once
+"""
+
+import json
+import sqlite3
+import time
+
+import jobqueue
+
+
+class InFlightError(Exception):
+    """
+    The same delivery is still being processed by someone else
+    """
+
+
+class IdempotencyStore:
+    """
+    SQLite table of delivery keys with their state and the created HubSpot IDs
+
+    begin() claims a key with a lease, so concurrent duplicates wait for the
+    first one to finish instead of processing it again. If the owner of a
+    lease dies, the key can be claimed again after the lease expired. Entries
+    are deleted ttl seconds after their last update.
+    """
+
+    def __init__(self, path, lease=300, ttl=7 * 24 * 3600, poll_interval=0.5):
+        self.path = path
+        self.lease = lease
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._database = jobqueue.Database(path)
+        self._last_compaction = 0.0
+        with self._database.connection() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS deliveries (
+                    key TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    result TEXT,
+                    lease_until REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self._database.close()
+
+    def begin(self, key, timeout=30):
+        """
+        Claim a key for processing
+        :return: None if the caller now owns the key and must call finish() or
+                 release(), or the result stored by finish() if it was
+                 processed already
+        :raise InFlightError: if it is still being processed after timeout
+        """
+        self.compact()
+        deadline = time.monotonic() + timeout
+        while True:
+            claimed, result = self._claim(key)
+            if claimed or result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                raise InFlightError(key)
+            time.sleep(self.poll_interval)
+
+    def _claim(self, key):
+        now = time.time()
+        with self._database.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT state, result, lease_until FROM deliveries WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None and row[0] == "done":
+                    db.execute("COMMIT")
+                    return False, json.loads(row[1])
+                if row is not None and row[2] > now:
+                    db.execute("COMMIT")
+                    return False, None
+                db.execute(
+                    "INSERT OR REPLACE INTO deliveries"
+                    " (key, state, result, lease_until, updated_at)"
+                    " VALUES (?, 'processing', NULL, ?, ?)",
+                    (key, now + self.lease, now),
+                )
+                db.execute("COMMIT")
+                return True, None
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+
+    def finish(self, key, result):
+        """
+        Mark a claimed key as processed and store its result
+        """
+        with self._database.connection() as db:
+            db.execute(
+                "UPDATE deliveries SET state = 'done', result = ?, updated_at = ?"
+                " WHERE key = ?",
+                (json.dumps(result), time.time(), key),
+            )
+
+    def release(self, key):
+        """
+        Give up a claimed key after a failure so a retry can process it
+        """
+        with self._database.connection() as db:
+            db.execute(
+                "DELETE FROM deliveries WHERE key = ? AND state = 'processing'", (key,)
+            )
+
+    def compact(self):
+        """
+        Delete expired entries, at most once per hour
+        """
+        now = time.time()
+        if now - self._last_compaction < 3600:
+            return
+        self._last_compaction = now
+        with self._database.connection() as db:
+            db.execute(
+                "DELETE FROM deliveries WHERE updated_at < ?"
+                " AND (state = 'done' OR lease_until < ?)",
+                (now - self.ttl, now),
+            )
@@ -0,0 +1,191 @@
+"""
+Durable on-disk job queue for webhook payloads, backed by SQLite in WAL mode
+"""
+
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def connect(path):
+    """
+    Open a SQLite database tuned for many concurrent readers and one writer
+    """
+    connection = sqlite3.connect(
+        path, timeout=30, isolation_level=None, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class Database:
+    """
+    One SQLite connection shared by all threads of a process
+
+    connection() hands it to one thread at a time, for a single statement or
+    a whole transaction, so short-lived pipeline threads do not each open a
+    connection of their own. close() it on shutdown.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = connect(path)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        The connection, locked for the calling thread until the block ends
+        """
+        with self._lock:
+            yield self._connection
+
+    def close(self):
+        """
+        Close the connection, further use raises sqlite3.ProgrammingError
+        """
+        with self._lock:
+            self._connection.close()
+
+
+class JobQueue:
+    """
+    FIFO queue of (user_email, payload) jobs persisted in a SQLite database
+
+    Jobs are only deleted after they have been processed, so accepted payloads
+    survive crashes and restarts. Failed jobs are retried with exponential
+    backoff and parked in the "failed" state after max_attempts.
+    """
+
+    def __init__(self, path, max_attempts=5, retry_delay=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._database = Database(path)
+        self._available = threading.Condition()
+        with self._database.connection() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_email TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    not_before REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_error TEXT
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+            # jobs that were running when the process died are picked up again
+            db.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'")
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        self._database.close()
+
+    def put(self, user_email, payload):
+        """
+        Persist a new job and wake up a waiting worker
+        """
+        now = time.time()
+        with self._database.connection() as db:
+            cursor = db.execute(
+                "INSERT INTO jobs (user_email, payload, not_before, created_at)"
+                " VALUES (?, ?, ?, ?)",
+                (user_email, json.dumps(payload), now, now),
+            )
+        with self._available:
+            self._available.notify()
+        return cursor.lastrowid
+
+    def get(self, timeout=1.0):
+        """
+        Claim the oldest runnable job
+        :return: tuple (job_id, user_email, payload) or None after timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._claim()
+            if job is not None:
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            with self._available:
+                # re-check periodically for jobs whose retry delay expired
+                self._available.wait(min(remaining, 1.0))
+
+    def _claim(self):
+        with self._database.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute(
+                    "SELECT id, user_email, payload FROM jobs"
+                    " WHERE state = 'queued' AND not_before <= ? ORDER BY id LIMIT 1",
+                    (time.time(),),
+                ).fetchone()
+                if row is not None:
+                    db.execute(
+                        "UPDATE jobs SET state = 'running' WHERE id = ?", (row[0],)
+                    )
+                db.execute("COMMIT")
+            except sqlite3.Error:
+                db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def done(self, job_id):
+        """
+        Remove a successfully processed job
+        """
+        with self._database.connection() as db:
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def retry(self, job_id, error):
+        """
+        Re-queue a failed job with exponential backoff or mark it as failed
+        """
+        with self._database.connection() as db:
+            (attempts,) = db.execute(
+                "SELECT attempts + 1 FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            state = "failed" if attempts >= self.max_attempts else "queued"
+            db.execute(
+                "UPDATE jobs SET state = ?, attempts = ?, not_before = ?, last_error = ?"
+                " WHERE id = ?",
+                (
+                    state,
+                    attempts,
+                    time.time() + self.retry_delay * 2 ** (attempts - 1),
+                    str(error),
+                    job_id,
+                ),
+            )
+        return state
+
+    def release(self, job_id):
+        """
+        Re-queue a job that could not be processed for now, e.g. while HubSpot
+        is unavailable, without counting it as an attempt
+        """
+        with self._database.connection() as db:
+            db.execute("UPDATE jobs SET state = 'queued' WHERE id = ?", (job_id,))
+
+    def depth(self):
+        """
+        Number of jobs waiting to be processed
+        """
+        with self._database.connection() as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE state = 'queued'"
+            ).fetchone()[0]
@@ -0,0 +1,78 @@
+"""
+Logging helpers: JSON lines output, lazy formatting and redaction of payloads
+"""
+
+import json
+import logging
+import pprint
+
+REDACTED = "[redacted]"
+# attributes of every LogRecord, any others were passed with extra=
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line with the time, level, logger and message of a
+    record, plus the fields passed with extra=, e.g. IDs and timings
+    """
+
+    def format(self, record):
+        event = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        event.update(
+            (name, value)
+            for name, value in vars(record).items()
+            if name not in RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            event["exception"] = self.formatException(record.exc_info)
+        return json.dumps(event, default=str)
+
+
+class Pretty:  # pylint: disable=too-few-public-methods
+    """
+    Log argument formatted with pprint.pformat() only if the record is emitted,
+    and only once for all handlers, optionally redacted and truncated like
+    redact()
+    """
+
+    __slots__ = ("value", "fields", "max_length", "_text")
+
+    def __init__(self, value, fields=(), max_length=None):
+        self.value = value
+        self.fields = fields
+        self.max_length = max_length
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            value = self.value
+            if self.fields or self.max_length is not None:
+                value = redact(value, self.fields, self.max_length)
+            self._text = pprint.pformat(value)
+        return self._text
+
+
+def redact(value, fields=(), max_length=None, path=""):
+    """
+    Copy of a JSON value with the values at the dotted paths in fields, e.g.
+    "invitee.email", replaced by REDACTED and strings cut to max_length
+    characters. The items of a list have the path of the list.
+    """
+    if path in fields:
+        return REDACTED
+    if isinstance(value, dict):
+        return {
+            key: redact(item, fields, max_length, f"{path}.{key}" if path else key)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [redact(item, fields, max_length, path) for item in value]
+    if isinstance(value, str) and max_length is not None and len(value) > max_length:
+        return f"{value[:max_length]}... ({len(value)} characters)"
+    return value
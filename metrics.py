@@ -0,0 +1,113 @@
+"""
+Counters and histograms exposed in the Prometheus text format
+"""
+
+import bisect
+import threading
+
+# upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Registry:
+    """
+    Thread-safe metrics by name and labels
+
+    Metrics are declared once with counter() or histogram() and updated with
+    inc() and observe(). render() returns all of them, plus gauges computed
+    by the caller, in the Prometheus text exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # name -> (type, help, {sorted label items: value}, buckets)
+        self._metrics = {}
+
+    def counter(self, name, documentation):
+        """
+        Declare a counter
+        """
+        self._metrics[name] = ("counter", documentation, {}, ())
+
+    def histogram(self, name, documentation, buckets=None):
+        """
+        Declare a histogram
+        :param buckets: upper bounds of the buckets, by default those of the registry
+        """
+        buckets = self.buckets if buckets is None else tuple(buckets)
+        self._metrics[name] = ("histogram", documentation, {}, buckets)
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Increase a counter
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._metrics[name][2]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value, e.g. a duration in seconds, to a histogram
+        """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            _, _, values, buckets = self._metrics[name]
+            # [count per bucket, +Inf included, sum]
+            histogram = values.setdefault(key, [[0] * (len(buckets) + 1), 0.0])
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+    def render(self, gauges=()):
+        """
+        All metrics in the Prometheus text format
+        :param gauges: list of (name, help, value) of current values
+        """
+        lines = []
+        with self._lock:
+            for name, (kind, documentation, values, buckets) in self._metrics.items():
+                lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+                for key, value in sorted(values.items()):
+                    if kind == "counter":
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                        continue
+                    lines += format_histogram(name, key, buckets, *value)
+        for name, documentation, value in gauges:
+            lines += [
+                f"# HELP {name} {documentation}",
+                f"# TYPE {name} gauge",
+                f"{name} {value}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def format_histogram(name, key, buckets, counts, total):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    lines of the cumulative buckets, sum and count of a histogram
+    """
+    lines = []
+    cumulative = 0
+    for bound, count in zip((*buckets, "+Inf"), counts, strict=True):
+        cumulative += count
+        labels = format_labels((*key, ("le", str(bound))))
+        lines.append(f"{name}_bucket{labels} {cumulative}")
+    lines.append(f"{name}_sum{format_labels(key)} {total}")
+    lines.append(f"{name}_count{format_labels(key)} {cumulative}")
+    return lines
+
+
+def format_labels(items):
+    """
+    {name="value",...} of label items, empty without labels
+    """
+    if not items:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in items
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
@@ -9,6 +9,29 @@ nox.options.default_venv_backend = "uv"
 nox.options.reuse_venv = "yes"
 nox.options.sessions = ["ruff", "pylint", "tests", "docker"]
 
+# application modules shipped in the Docker image
+MODULES = [
+    "answers",
+    "app",
+    "cache",
+    "hubspotclient",
+    "hubspotcontacts",
+    "hubspotdeals",
+    "idempotency",
+    "jobqueue",
+    "logs",
+    "metrics",
+    "phones",
+    "pipeline",
+    "replay",
+    "server",
+]
+# development tools, linted and measured like the application but not shipped
+TOOLS = [
+    "benchmark",
+    "fakehubspot",
+]
+
 
 def _project_deps() -> list[str]:
     """Read project dependencies from pyproject.toml."""
@@ -26,9 +49,9 @@ def ruff(session: nox.Session) -> None:
 
 @nox.session
 def pylint(session: nox.Session) -> None:
-    """Run pylint on app module."""
+    """Run pylint on the application modules and development tools."""
     session.install("pylint", *_project_deps())
-    session.run("pylint", "app")
+    session.run("pylint", *MODULES, *TOOLS)
 
 
 @nox.session
@@ -36,7 +59,10 @@ def tests(session: nox.Session) -> None:
     """Run the test suite."""
     session.install("pytest", "pytest-cov", *_project_deps())
     session.run(
-        "pytest", "--cov=app", "--cov-report=term", "--cov-report=xml:coverage.xml"
+        "pytest",
+        *(f"--cov={module}" for module in MODULES + TOOLS),
+        "--cov-report=term",
+        "--cov-report=xml:coverage.xml",
     )
 
 
@@ -0,0 +1,68 @@
+"""
+Normalization of phone numbers to the international format
+"""
+
+import functools
+import os
+import zoneinfo
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize(phone_number, region=None):
+    """
+    Format a phone number in international format, if it can be parsed
+    :param region: ISO 3166 country code of numbers without country code,
+                   without one these are returned unchanged
+    """
+    if phone_number == "":
+        return phone_number
+    # the phonenumbers package takes a while to import, its metadata of each
+    # region is loaded on first use
+    import phonenumbers  # pylint: disable=import-outside-toplevel
+
+    try:
+        parsed = phonenumbers.parse(phone_number, region)
+    except phonenumbers.NumberParseException:
+        # number could not be parsed, e.g. because it is a
+        # local number without country code and region
+        return phone_number
+    if region is not None and not phonenumbers.is_possible_number(parsed):
+        # e.g. a local number that is not from region after all
+        return phone_number
+    return phonenumbers.format_number(
+        parsed, phonenumbers.PhoneNumberFormat.INTERNATIONAL
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def default_region(locale=None, timezone=None):
+    """
+    Guess the country of local phone numbers from the locale, e.g. "de_CH",
+    or else the timezone, e.g. "Europe/Zurich", of a person
+    :return: ISO 3166 country code or None
+    """
+    if locale:
+        country = locale.replace("_", "-").split("-")[-1]
+        if country != locale and len(country) == 2 and country.isalpha():
+            return country.upper()
+    if timezone:
+        return _timezone_countries().get(timezone)
+    return None
+
+
+@functools.cache
+def _timezone_countries():
+    """
+    country code by timezone from the zone.tab of the system tz database
+    """
+    for directory in zoneinfo.TZPATH:
+        try:
+            with open(os.path.join(directory, "zone.tab"), encoding="utf-8") as file:
+                return {
+                    columns[2]: columns[0]
+                    for columns in (line.rstrip("\n").split("\t") for line in file)
+                    if not columns[0].startswith("#") and len(columns) >= 3
+                }
+        except OSError:
+            continue
+    return {}
@@ -0,0 +1,100 @@
+"""
+Dependency graph execution of the steps processing a webhook payload
+"""
+
+import concurrent.futures
+import contextvars
+import time
+
+
+def run(steps, max_workers=4):
+    """
+    Run steps as soon as the steps they depend on are done, sharing the
+    current context (e.g. flask.g) with the worker threads
+
+    A step is called with the results of its dependencies as keyword
+    arguments. If a step fails, no further steps are started and its
+    exception is raised after the running steps are done.
+    :param steps: dict of (func, list of dependency names) by step name
+    :return: tuple (dict of results by step name,
+             dict of (start, end) seconds since the start by step name)
+    """
+    pending = dict(steps)
+    results = {}
+    trace = {}
+    running = {}
+    error = None
+    started = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, (func, dependencies) in list(pending.items()):
+                if error is None and all(dep in results for dep in dependencies):
+                    del pending[name]
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        _timed,
+                        started,
+                        func,
+                        {dep: results[dep] for dep in dependencies},
+                    )
+                    running[future] = name
+            if not running:
+                if error is None:
+                    raise ValueError("unsatisfiable steps: " + ", ".join(pending))
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    results[name], trace[name] = future.result()
+    if error is not None:
+        raise error
+    return results, trace
+
+
+def _timed(started, func, kwargs):
+    start = time.monotonic() - started
+    result = func(**kwargs)
+    return result, (start, time.monotonic() - started)
+
+
+def describe(trace):
+    """
+    One line summary of a trace, listing the steps each step overlapped with
+    """
+    parts = []
+    for name, (start, end) in sorted(trace.items(), key=lambda item: item[1]):
+        overlapping = [
+            other
+            for other, (other_start, other_end) in trace.items()
+            if other != name and other_start < end and start < other_end
+        ]
+        parts.append(
+            f"{name} {start * 1000:.0f}-{end * 1000:.0f}ms"
+            + (" (parallel with " + ", ".join(overlapping) + ")" if overlapping else "")
+        )
+    return ", ".join(parts)
+
+
+def map_concurrently(func, items, max_workers=4):
+    """
+    Call func for all items on a thread pool of at most max_workers threads,
+    sharing the current context (e.g. flask.g)
+    :return: list of results in the order of items, the first exception
+             in that order is raised after all calls are done
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(items))
+    ) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, func, item)
+            for item in items
+        ]
+    return [future.result() for future in futures]
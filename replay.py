@@ -0,0 +1,102 @@
+"""
+Replay of the webhook payloads of a JSONL file, e.g. spooled during an outage
+"""
+
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import time
+
+
+def replay(path, process, user_email=None, concurrency=4, batch_size=100):
+    """
+    Process the webhook payloads of a JSONL file, e.g. after an outage
+
+    Each line is a payload, or a JSON object with "user_email" and "payload"
+    like the jobs of a jobqueue.JobQueue. Progress is checkpointed after each
+    batch to path + ".checkpoint", an interrupted replay resumes after the
+    last finished batch. Failed lines are appended to path + ".failed".
+    :param process: function(user_email, payload) raising if it fails
+    :param user_email: HubSpot user of the payloads without "user_email"
+    :return: tuple (number of processed payloads, number of failed payloads)
+    """
+    done = replay_checkpoint(path)
+    counts = {"processed": 0, "failed": 0}
+    started = time.monotonic()
+    with (
+        open(path, encoding="utf-8") as file,
+        open(path + ".failed", "a", encoding="utf-8") as failed,
+        concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor,
+    ):
+        # skip the lines processed before the checkpoint
+        next(itertools.islice(file, done, done), None)
+        while batch := list(itertools.islice(file, batch_size)):
+            for number, (line, error) in enumerate(
+                zip(
+                    batch,
+                    executor.map(
+                        lambda line: replay_line(line, process, user_email), batch
+                    ),
+                    strict=True,
+                ),
+                done + 1,
+            ):
+                if not line.strip():
+                    continue
+                if error is None:
+                    counts["processed"] += 1
+                else:
+                    counts["failed"] += 1
+                    logging.error("line %s failed: %s", number, error)
+                    failed.write(line.rstrip("\n") + "\n")
+            failed.flush()
+            done += len(batch)
+            replay_checkpoint(path, done)
+            logging.info(
+                "replayed %s lines, %s failed, %.1f payloads/s",
+                done,
+                counts["failed"],
+                (counts["processed"] + counts["failed"]) / (time.monotonic() - started),
+            )
+    return counts["processed"], counts["failed"]
+
+
+def replay_checkpoint(path, done=None):
+    """
+    Read or write the number of lines of a replay() file already processed
+    """
+    checkpoint = path + ".checkpoint"
+    if done is not None:
+        # write atomically, a crash keeps the previous checkpoint
+        with open(checkpoint + ".tmp", "w", encoding="utf-8") as file:
+            file.write(str(done))
+        os.replace(checkpoint + ".tmp", checkpoint)
+        return done
+    try:
+        with open(checkpoint, encoding="utf-8") as file:
+            done = int(file.read())
+    except FileNotFoundError:
+        return 0
+    logging.info("resuming replay of %s after line %s", path, done)
+    return done
+
+
+def replay_line(line, process, user_email):
+    """
+    Process one line of a replay() file
+    :return: None if it was processed or is empty, or the error
+    """
+    if not line.strip():
+        return None
+    try:
+        record = json.loads(line)
+        if "payload" in record:
+            user_email = record.get("user_email", user_email)
+            record = record["payload"]
+        process(user_email, record)
+    # flask.abort() raises HTTPException, anything else is a bug
+    except Exception as error:  # pylint: disable=broad-exception-caught
+        return error
+    return None
@@ -0,0 +1,70 @@
+"""
+Serving the Flask app with waitress, warming up the slow imports meanwhile
+"""
+
+import importlib
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import waitress
+
+import hubspotcontacts
+
+# slow to import and only needed to process payloads, each HubSpot SDK package
+# imports all of its APIs and models: imported on first use, or by warm_up()
+# in the background as soon as the server listens
+WARM_UP_MODULES = [
+    "hubspot.crm.associations",
+    "hubspot.crm.contacts",
+    "hubspot.crm.deals",
+    "hubspot.crm.objects",
+    "hubspot.crm.owners",
+    "nameparser",
+    "phonenumbers",
+]
+
+
+def serve(app, port):
+    """
+    Serve app until SIGTERM or SIGINT with the waitress production server,
+    or the Flask development server if SERVER=development
+    """
+    warmer = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    if os.environ.get("SERVER") == "development":
+        warmer.start()
+        app.run(host="0.0.0.0", port=port)
+        return
+
+    server = waitress.create_server(
+        app,
+        host="0.0.0.0",
+        port=port,
+        # requests processed in parallel
+        threads=int(os.environ.get("THREADS", 8)),
+        # open connections, further connections wait in the listen backlog
+        connection_limit=int(os.environ.get("CONNECTION_LIMIT", 100)),
+        # seconds until idle keep-alive connections are closed
+        channel_timeout=int(os.environ.get("KEEPALIVE_TIMEOUT", 120)),
+    )
+    # waitress stops listening on SystemExit and waits a few seconds for the
+    # requests in progress before it returns
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logging.info("listening on port %s with %s threads", port, server.adj.threads)
+    # the socket is bound, requests wait in the backlog until server.run()
+    warmer.start()
+    server.run()
+
+
+def warm_up():
+    """
+    Import WARM_UP_MODULES so the first webhook does not have to wait for them
+    """
+    started = time.monotonic()
+    for name in WARM_UP_MODULES:
+        importlib.import_module(name)
+    hubspotcontacts.name_constants()
+    logging.info("warmed up in %.3f seconds", time.monotonic() - started)
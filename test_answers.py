@@ -0,0 +1,84 @@
+"""Tests for the extraction of fields from meeting type answers."""
+
+import json
+from pathlib import Path
+
+import answers
+
+EXAMPLE_PAYLOAD = json.loads(Path("example.json").read_text())
+
+
+def payload(slug, *labels):
+    """Build a payload answering each question label with its position."""
+    return {
+        "event_type": {"slug": slug},
+        "answers": [
+            {"question_label": label, "value": str(number)}
+            for number, label in enumerate(labels)
+        ],
+    }
+
+
+def test_extract_first_matching_answers():
+    """Test that the first answer containing a keyword of a field wins."""
+    extractor = answers.AnswerExtractor()
+    assert extractor.extract(
+        payload("30", "Your Telephone", "Meeting Title", "Phone", "Agenda")
+    ) == {"phone_number": "0", "meeting_title": "1", "meeting_comment": "3"}
+    assert extractor.extract({"event_type": {}, "answers": []}) == {
+        "phone_number": "",
+        "meeting_title": "",
+        "meeting_comment": "",
+    }
+
+
+def test_extract_example_payload():
+    """Test the fields of the example payload."""
+    fields = answers.AnswerExtractor().extract(EXAMPLE_PAYLOAD)
+    assert set(fields) == set(answers.DEFAULT_FIELDS)
+
+
+def test_event_type_rules():
+    """Test that event type rules add fields and replace keywords."""
+    extractor = answers.AnswerExtractor.from_json(
+        json.dumps(
+            {"30": {"company": ["firma", "company"], "meeting_title": ["topic"]}}
+        )
+    )
+    fields = extractor.extract(payload("30", "Title", "Topic", "Firma"))
+    assert fields["company"] == "2"
+    assert fields["meeting_title"] == "1"
+    assert "company" not in extractor.extract(payload("60", "Firma"))
+
+
+def test_layout_memoized():
+    """Test that the answer layout of a question list is only matched once."""
+    extractor = answers.AnswerExtractor()
+    extractor.extract(payload("30", "Phone", "Title"))
+    extractor.extract(payload("30", "Phone", "Title"))
+    assert extractor.layout.cache_info().hits == 1
+
+
+def test_all_event_types_rules_keep_default_fields():
+    """Test that "*" rules replace keywords without dropping default fields."""
+    extractor = answers.AnswerExtractor.from_json(
+        json.dumps({"*": {"meeting_title": ["topic"], "company": ["firma"]}})
+    )
+    fields = extractor.extract(payload("30", "Phone", "Title", "Topic", "Firma"))
+    assert fields == {
+        "phone_number": "0",
+        "meeting_title": "2",
+        "meeting_comment": "",
+        "company": "3",
+    }
+
+
+def test_overlapping_keywords_of_different_fields():
+    """Test that a label matching the keywords of several fields fills each."""
+    extractor = answers.AnswerExtractor.from_json(
+        json.dumps({"*": {"company": ["company phone"]}})
+    )
+    fields = extractor.extract(payload("30", "Company phone", "Title"))
+    assert fields["company"] == "0"
+    assert fields["phone_number"] == "0"
+    assert fields["meeting_title"] == "1"
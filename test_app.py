@@ -1,10 +1,21 @@
 """Tests for harmonizely2hubspot app."""
 
 import json
+import threading
+import time
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
+import pytest
+from hubspot.crm.contacts import ApiException
+
 import app as harmonizely_app
+import cache
+import hubspotclient
+import hubspotcontacts
+import idempotency
+import jobqueue
+import replay
 
 EXAMPLE_PAYLOAD = json.loads(Path("example.json").read_text())
 
@@ -28,27 +39,6 @@ def test_404():
         assert response.status_code == 404
 
 
-def test_parse_name():
-    """Test name parsing from full name string."""
-    first, last = harmonizely_app.parse_name("Aarno Aukia")
-    assert first == "Aarno"
-    assert last == "Aukia"
-
-
-def test_parse_name_with_title():
-    """Test that Herr/Frau titles are stripped."""
-    first, last = harmonizely_app.parse_name("Herr Max Mustermann")
-    assert first == "Max"
-    assert last == "Mustermann"
-
-
-def test_parse_name_with_middle():
-    """Test that middle names are included in first name."""
-    first, last = harmonizely_app.parse_name("Johann Sebastian Bach")
-    assert first == "Johann Sebastian"
-    assert last == "Bach"
-
-
 def test_sentry_healthcheck_sampling_root():
     """Test that healthcheck path is sampled at low rate."""
     context = {"wsgi_environ": {"REQUEST_URI": "/"}}
@@ -104,3 +94,345 @@ def test_webhook_no_payload():
             data="",
         )
         assert response.status_code == 400
+
+
+def test_webhook_missing_fields():
+    """Test that a payload without required fields returns 400."""
+    harmonizely_app.CONFIG = {
+        "emails": ["user@example.com"],
+        "token": "fake-token",
+    }
+
+    with harmonizely_app.APP.test_client() as client:
+        response = client.post("/user@example.com", json={"invitee": {}})
+        assert response.status_code == 400
+        assert b"invitee.email" in response.data
+
+
+def test_webhook_queues_payload(tmp_path):
+    """Test that the webhook only queues the payload when QUEUE is set."""
+    harmonizely_app.CONFIG = {
+        "emails": ["user@example.com"],
+        "token": "fake-token",
+    }
+    queue = jobqueue.JobQueue(str(tmp_path / "queue.db"))
+
+    with (
+        harmonizely_app.APP.test_client() as client,
+        patch.object(harmonizely_app, "QUEUE", queue),
+        patch("app.process_payload") as mock_process,
+    ):
+        response = client.post("/user@example.com", json=EXAMPLE_PAYLOAD)
+        assert response.status_code == 202
+        mock_process.assert_not_called()
+
+    job_id, user_email, payload = queue.get(timeout=0)
+    assert job_id == 1
+    assert user_email == "user@example.com"
+    assert payload == EXAMPLE_PAYLOAD
+
+
+def test_process_job_retries_on_error(tmp_path):
+    """Test that a failing queued job is re-queued instead of dropped."""
+    harmonizely_app.CONFIG = {"emails": ["user@example.com"], "token": "fake"}
+    queue = jobqueue.JobQueue(str(tmp_path / "queue.db"))
+    queue.put("user@example.com", EXAMPLE_PAYLOAD)
+
+    with (
+        patch.object(harmonizely_app, "QUEUE", queue),
+        patch("app.hubspot"),
+        patch("app.process_payload", side_effect=RuntimeError("boom")),
+    ):
+        harmonizely_app.process_job(*queue.get(timeout=0))
+
+    assert queue.depth() == 1
+
+
+def test_process_job_postpones_while_hubspot_is_unavailable(tmp_path):
+    """Test that a job rejected by the circuit breaker keeps its attempts."""
+    harmonizely_app.CONFIG = {"emails": ["user@example.com"], "token": "fake"}
+    queue = jobqueue.JobQueue(str(tmp_path / "queue.db"))
+    queue.put("user@example.com", EXAMPLE_PAYLOAD)
+
+    with (
+        patch.object(harmonizely_app, "QUEUE", queue),
+        patch("app.hubspot"),
+        patch(
+            "app.process_payload",
+            side_effect=hubspotclient.CircuitOpenError(retry_after=30),
+        ),
+    ):
+        harmonizely_app.process_job(*queue.get(timeout=0))
+
+    assert queue.depth() == 1
+    with queue._database.connection() as db:  # pylint: disable=protected-access
+        assert db.execute("SELECT attempts FROM jobs").fetchone() == (0,)
+
+
+def test_wait_for_in_flight():
+    """Test that shutdown waits for the payloads in progress, up to a deadline."""
+    with patch.dict(harmonizely_app.IN_FLIGHT, payloads=1):
+        finished = threading.Timer(
+            0.2, harmonizely_app.IN_FLIGHT.__setitem__, ("payloads", 0)
+        )
+        finished.start()
+        assert harmonizely_app.wait_for_in_flight(time.monotonic() + 5) == 0
+        harmonizely_app.IN_FLIGHT["payloads"] = 2
+        assert harmonizely_app.wait_for_in_flight(time.monotonic() + 0.2) == 2
+
+
+def test_replay_payload(tmp_path):
+    """Test that replayed payloads are validated like webhooks."""
+    harmonizely_app.CONFIG = {"emails": ["user@example.com"], "token": "fake"}
+    path = tmp_path / "payloads.jsonl"
+    path.write_text(
+        json.dumps(EXAMPLE_PAYLOAD)
+        + "\n"
+        + json.dumps({"invitee": {}})
+        + "\n"
+        + json.dumps({"user_email": "other@example.com", "payload": EXAMPLE_PAYLOAD})
+        + "\n"
+    )
+    with (
+        patch("app.hubspot"),
+        patch("app.handle_payload") as mock_handle,
+    ):
+        assert replay.replay(
+            str(path), harmonizely_app.replay_payload, "user@example.com"
+        ) == (1, 2)
+    mock_handle.assert_called_once_with(
+        user_email="user@example.com", payload=EXAMPLE_PAYLOAD
+    )
+    failed = (tmp_path / "payloads.jsonl.failed").read_text()
+    assert "invitee" in failed
+    assert "other@example.com" in failed
+
+
+def test_stats():
+    """Test that the stats endpoint reports the HubSpot connection pool."""
+    with harmonizely_app.APP.test_client() as client:
+        response = client.get("/stats")
+        assert response.status_code == 200
+        assert "hits" in response.json["hubspot_pool"]
+        assert response.json["in_flight"]["payloads"] == 0
+
+
+def test_get_owner_id_cached():
+    """Test that owner IDs are only looked up once while cached."""
+    api_client = MagicMock()
+    api_client.crm.owners.owners_api.get_page.return_value.results = [
+        MagicMock(id="42")
+    ]
+    with (
+        harmonizely_app.APP.app_context(),
+        patch.object(harmonizely_app, "OWNERS", cache.TTLCache(ttl=60)),
+    ):
+        harmonizely_app.flask.g.api_client = api_client
+        assert harmonizely_app.get_owner_id("user@example.com") == "42"
+        assert harmonizely_app.get_owner_id("user@example.com") == "42"
+    api_client.crm.owners.owners_api.get_page.assert_called_once()
+
+
+def test_fetch_owner_id_invalidates_on_failure():
+    """Test that a failed owner lookup drops the cached owner ID."""
+    api_client = MagicMock()
+    api_client.crm.owners.owners_api.get_page.return_value.results = []
+    owners = cache.TTLCache(ttl=60)
+    owners.set("user@example.com", "42")
+    with (
+        harmonizely_app.APP.app_context(),
+        patch.object(harmonizely_app, "OWNERS", owners),
+        pytest.raises(IndexError),
+    ):
+        harmonizely_app.flask.g.api_client = api_client
+        harmonizely_app.fetch_owner_id("user@example.com")
+    assert owners.get("user@example.com") is None
+
+
+def mock_api_client(existing=()):
+    """Build a HubSpot client mock knowing the existing emails, without deals."""
+    api_client = MagicMock()
+    api_client.crm.owners.owners_api.get_page.return_value.results = [
+        MagicMock(id="42")
+    ]
+
+    def contact(email, **properties):
+        return MagicMock(
+            id="contact-" + email,
+            properties={"email": email, "firstname": "A", "lastname": "B"} | properties,
+            associations={},
+        )
+
+    def get_contact(email, **_kwargs):
+        if email not in existing:
+            raise ApiException(status=404)
+        return contact(email)
+
+    def batch_read(batch_read_input):
+        emails = [x.id for x in batch_read_input.inputs]
+        return MagicMock(
+            results=[contact(email) for email in emails if email in existing],
+            errors=[
+                MagicMock(context={"ids": [x for x in emails if x not in existing]})
+            ],
+        )
+
+    def batch_create(batch_input):
+        return MagicMock(results=[contact(**x.properties) for x in batch_input.inputs])
+
+    api_client.crm.contacts.basic_api.get_by_id.side_effect = get_contact
+    api_client.crm.contacts.batch_api.read.side_effect = batch_read
+    api_client.crm.contacts.batch_api.create.side_effect = batch_create
+    api_client.crm.objects.batch_api.create.side_effect = batch_create_objects
+    return api_client
+
+
+def batch_create_objects(object_type, batch_input):
+    """Create deals or meetings with IDs like "deal", "meeting-1", in reverse order."""
+    return MagicMock(
+        results=[
+            MagicMock(
+                id=object_type[:-1] + (f"-{number}" if number else ""),
+                object_write_trace_id=x.object_write_trace_id,
+            )
+            for number, x in reversed(list(enumerate(batch_input.inputs)))
+        ]
+    )
+
+
+def test_process_payload_batches_associations():
+    """Test that associations are created with one call per object pair."""
+    payload = dict(
+        EXAMPLE_PAYLOAD,
+        participants=[{"email": f"p{number}@example.com"} for number in range(5)],
+    )
+    api_client = mock_api_client(existing=["aarno.aukia@vshn.ch"])
+    with (
+        harmonizely_app.APP.app_context(),
+        patch.object(harmonizely_app, "OWNERS", cache.TTLCache(ttl=60)),
+        patch.object(hubspotcontacts, "CONTACTS", cache.TTLCache(ttl=60)),
+    ):
+        harmonizely_app.flask.g.api_client = api_client
+        harmonizely_app.process_payload("user@example.com", payload)
+
+    calls = api_client.crm.associations.batch_api.create.call_args_list
+    assert [
+        (c.kwargs["from_object_type"], c.kwargs["to_object_type"]) for c in calls
+    ] == [("Contact", "Deal"), ("Contact", "Meeting")]
+    assert all(
+        len(c.kwargs["batch_input_public_association"].inputs) == 6 for c in calls
+    )
+
+
+def test_process_payload_creates_meeting_while_resolving_contacts():
+    """Test that the meeting does not wait for the contacts and the deal."""
+    meeting_created = threading.Event()
+    api_client = mock_api_client(existing=["aarno.aukia@vshn.ch"])
+    get_contact = api_client.crm.contacts.basic_api.get_by_id.side_effect
+
+    def slow_get_contact(email, **kwargs):
+        assert meeting_created.wait(timeout=5)
+        return get_contact(email, **kwargs)
+
+    def create_objects(object_type, batch_input):
+        if object_type == "meetings":
+            meeting_created.set()
+        return batch_create_objects(object_type, batch_input)
+
+    api_client.crm.contacts.basic_api.get_by_id.side_effect = slow_get_contact
+    api_client.crm.objects.batch_api.create.side_effect = create_objects
+    with (
+        harmonizely_app.APP.app_context(),
+        patch.object(harmonizely_app, "OWNERS", cache.TTLCache(ttl=60)),
+        patch.object(hubspotcontacts, "CONTACTS", cache.TTLCache(ttl=60)),
+    ):
+        harmonizely_app.flask.g.api_client = api_client
+        result = harmonizely_app.process_payload("user@example.com", EXAMPLE_PAYLOAD)
+
+    assert result["meeting"] == "meeting"
+    assert result["deal"] == "deal"
+
+
+def test_process_payload_resolves_contacts_in_batches():
+    """Test that participants are read and created with one batch call each."""
+    payload = dict(
+        EXAMPLE_PAYLOAD,
+        participants=[{"email": f"p{number}@example.com"} for number in range(5)],
+    )
+    api_client = mock_api_client(existing=["p0@example.com", "p1@example.com"])
+    with (
+        harmonizely_app.APP.app_context(),
+        patch.object(harmonizely_app, "OWNERS", cache.TTLCache(ttl=60)),
+        patch.object(hubspotcontacts, "CONTACTS", cache.TTLCache(ttl=60)),
+    ):
+        harmonizely_app.flask.g.api_client = api_client
+        harmonizely_app.process_payload("user@example.com", payload)
+
+    contacts_api = api_client.crm.contacts
+    assert contacts_api.basic_api.get_by_id.call_count == 1
+    assert contacts_api.batch_api.read.call_count == 1
+    contacts_api.batch_api.create.assert_called_once()
+    created = contacts_api.batch_api.create.call_args.args[0].inputs
+    assert [x.properties["email"] for x in created] == [
+        "aarno.aukia@vshn.ch",
+        "p2@example.com",
+        "p3@example.com",
+        "p4@example.com",
+    ]
+    assert created[0].properties["phone"] == "+41 44 545 53 00"
+    contacts_api.basic_api.create.assert_not_called()
+
+
+def test_process_payload_skips_unchanged_contacts():
+    """Test that contacts are not updated if nothing would change."""
+    api_client = mock_api_client(existing=["aarno.aukia@vshn.ch"])
+    get_contact = api_client.crm.contacts.basic_api.get_by_id.side_effect
+
+    def get_contact_with_phone(email, **kwargs):
+        assert "phone" in kwargs["properties"]
+        contact = get_contact(email, **kwargs)
+        contact.properties["phone"] = "+41 44 545 53 00"
+        return contact
+
+    api_client.crm.contacts.basic_api.get_by_id.side_effect = get_contact_with_phone
+    with (
+        harmonizely_app.APP.app_context(),
+        patch.object(harmonizely_app, "OWNERS", cache.TTLCache(ttl=60)),
+        patch.object(hubspotcontacts, "CONTACTS", cache.TTLCache(ttl=60)),
+    ):
+        harmonizely_app.flask.g.api_client = api_client
+        harmonizely_app.process_payload(
+            "user@example.com", dict(EXAMPLE_PAYLOAD, participants=[])
+        )
+
+    api_client.crm.contacts.batch_api.update.assert_not_called()
+
+
+def test_handle_payload_counts_in_flight():
+    """Test that payloads being processed are counted for /stats."""
+    seen = []
+
+    def process_payload(user_email, payload):  # pylint: disable=unused-argument
+        seen.append(dict(harmonizely_app.IN_FLIGHT))
+        return {}
+
+    with patch("app.process_payload", side_effect=process_payload):
+        harmonizely_app.handle_payload("user@example.com", EXAMPLE_PAYLOAD)
+
+    assert seen[0]["payloads"] == 1
+    assert harmonizely_app.IN_FLIGHT["payloads"] == 0
+    assert harmonizely_app.IN_FLIGHT["peak"] >= 1
+
+
+def test_handle_payload_skips_duplicates(tmp_path):
+    """Test that a redelivered payload is only processed once."""
+    store = idempotency.IdempotencyStore(str(tmp_path / "idempotency.db"))
+    with (
+        patch.object(harmonizely_app, "IDEMPOTENCY", store),
+        patch("app.process_payload", return_value={"meeting": "1"}) as mock_process,
+    ):
+        for _ in range(2):
+            assert harmonizely_app.handle_payload(
+                "user@example.com", EXAMPLE_PAYLOAD
+            ) == {"meeting": "1"}
+    mock_process.assert_called_once()
@@ -0,0 +1,114 @@
+"""Tests for the in-process lookup caches."""
+
+from unittest.mock import patch
+
+import cache
+
+
+def test_ttl_cache_expiry():
+    """Test that entries expire after the ttl and count hits and misses."""
+    ttl_cache = cache.TTLCache(ttl=10)
+    with patch("cache.time.monotonic", return_value=100):
+        ttl_cache.set("key", "value")
+        assert ttl_cache.get("key") == "value"
+    with patch("cache.time.monotonic", return_value=111):
+        assert ttl_cache.get("key") is None
+
+    stats = ttl_cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["size"] == 0
+
+
+def test_ttl_cache_delete():
+    """Test that deleted entries are gone."""
+    ttl_cache = cache.TTLCache(ttl=10)
+    ttl_cache.set("key", "value")
+    ttl_cache.delete("key")
+    ttl_cache.delete("missing")
+    assert ttl_cache.get("key", "default") == "default"
+
+
+def test_ttl_cache_lru_eviction():
+    """Test that the least recently used entry is evicted at maxsize."""
+    ttl_cache = cache.TTLCache(ttl=10, maxsize=2)
+    ttl_cache.set("a", 1)
+    ttl_cache.set("b", 2)
+    assert ttl_cache.get("a") == 1
+    ttl_cache.set("c", 3)
+    assert ttl_cache.get("b") is None
+    assert ttl_cache.get("a") == 1
+    assert ttl_cache.get("c") == 3
+
+
+def test_ttl_cache_negative_entry():
+    """Test that a cached None is distinguishable from a miss."""
+    ttl_cache = cache.TTLCache(ttl=10)
+    ttl_cache.set("a", None)
+    assert ttl_cache.get("a", cache.MISSING) is None
+    assert ttl_cache.get("b", cache.MISSING) is cache.MISSING
+
+
+def test_sqlite_cache_is_shared(tmp_path):
+    """Test that replicas see each other's entries, negative ones and deletes."""
+    path = str(tmp_path / "cache.db")
+    replica_a = cache.SQLiteCache(path, "contacts.v1", ttl=10)
+    replica_b = cache.SQLiteCache(path, "contacts.v1", ttl=10)
+    other = cache.SQLiteCache(path, "owners.v1", ttl=10)
+    replica_a.set("a@example.com", {"id": "1"})
+    replica_a.set("b@example.com", None)
+    assert replica_b.get("a@example.com") == {"id": "1"}
+    assert replica_b.get("b@example.com", cache.MISSING) is None
+    assert other.get("a@example.com", cache.MISSING) is cache.MISSING
+
+    replica_b.delete("a@example.com")
+    assert replica_a.get("a@example.com") is None
+    assert replica_b.stats() | {"hit_rate": None} == {
+        "size": 1,
+        "hits": 2,
+        "misses": 0,
+        "errors": 0,
+        "hit_rate": None,
+    }
+
+
+def test_sqlite_cache_expiry_and_eviction(tmp_path):
+    """Test that entries expire by the wall clock and maxsize is enforced."""
+    ttl_cache = cache.SQLiteCache(
+        str(tmp_path / "cache.db"), "deals.v1", ttl=10, maxsize=2, compact_interval=0
+    )
+    with patch("cache.time.time", return_value=100):
+        ttl_cache.set("short", "1", ttl=1)
+        ttl_cache.set("a", "2")
+        assert ttl_cache.get("short") == "1"
+    with patch("cache.time.time", return_value=100.5):
+        ttl_cache.set("b", "3")
+    with patch("cache.time.time", return_value=101):
+        assert ttl_cache.get("short") is None
+        ttl_cache.set("c", "4")
+        assert ttl_cache.stats()["size"] == 2
+        assert ttl_cache.get("a") is None
+        assert ttl_cache.get("c") == "4"
+
+
+def test_sqlite_cache_codec_and_errors(tmp_path):
+    """Test encoding of values and that database errors are misses."""
+    ttl_cache = cache.open_cache(
+        str(tmp_path / "cache.db"),
+        "owners.v1",
+        ttl=10,
+        encode=lambda value: list(value),
+        decode=lambda value: tuple(value),
+    )
+    ttl_cache.set("key", ("a", "b"))
+    assert ttl_cache.get("key") == ("a", "b")
+    with ttl_cache._database.connection() as db:  # pylint: disable=protected-access
+        db.execute("DROP TABLE cache")
+    assert ttl_cache.get("key", "default") == "default"
+    ttl_cache.set("key", ("a", "b"))
+    assert ttl_cache.stats()["errors"] == 2
+    # after shutdown, too
+    ttl_cache.close()
+    assert ttl_cache.get("key", "default") == "default"
+    assert ttl_cache.stats()["errors"] == 3
+    assert isinstance(cache.open_cache("", "owners.v1", ttl=10), cache.TTLCache)
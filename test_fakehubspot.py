@@ -0,0 +1,265 @@
+"""End-to-end tests of the webhook against the fake HubSpot API."""
+
+import collections
+import concurrent.futures
+import json
+import logging
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+import answers
+import app as harmonizely_app
+import cache
+import fakehubspot
+import hubspotclient
+import hubspotcontacts
+import hubspotdeals
+import replay
+
+EXAMPLE_PAYLOAD = json.loads(Path("example.json").read_text())
+
+
+@pytest.fixture(name="fake")
+def fixture_fake():
+    """Point the app at a fresh fake HubSpot with one owner."""
+    with (
+        fakehubspot.FakeHubSpot() as fake,
+        patch.object(
+            harmonizely_app,
+            "CONFIG",
+            {"emails": ["user@example.com"], "token": "fake", "host": fake.url},
+        ),
+        patch.object(
+            harmonizely_app,
+            "POOL",
+            hubspotclient.PooledApiFactory(
+                rate_limiter=hubspotclient.RateLimiter(limits=[], backoff=0),
+                observer=harmonizely_app.observe_hubspot_request,
+            ),
+        ),
+        patch.object(harmonizely_app, "API_CLIENT", None),
+        patch.object(harmonizely_app, "OWNERS", cache.TTLCache(ttl=60)),
+        patch.object(hubspotcontacts, "CONTACTS", cache.TTLCache(ttl=0)),
+        patch.object(hubspotdeals, "DEALS", cache.TTLCache(ttl=0)),
+    ):
+        fake.add_owner("user@example.com")
+        yield fake
+
+
+def post(payload):
+    """Post a payload to the webhook."""
+    with harmonizely_app.APP.test_client() as client:
+        return client.post("/user@example.com", json=payload)
+
+
+def test_webhook_creates_objects(fake):
+    """Test the objects and API calls of a new and a returning invitee."""
+    assert post(EXAMPLE_PAYLOAD).status_code == 200
+    invitee = fake.contacts["aarno.aukia@vshn.ch"]
+    assert invitee["properties"]["phone"] == "+41 44 545 53 00"
+    assert "a@aukia.com" in fake.contacts
+    assert fake.calls["create_deals"] == 1
+    assert fake.calls["create_meetings"] == 1
+    first_calls = fake.calls.total()
+
+    # the returning invitee's deal is reused
+    assert post(EXAMPLE_PAYLOAD).status_code == 200
+    assert fake.calls["create_deals"] == 1
+    assert fake.calls["create_meetings"] == 2
+    assert ("contacts", invitee["id"], "meetings") in {
+        association[:3] for association in fake.associations
+    }
+    assert fake.calls.total() - first_calls <= first_calls
+
+
+def test_webhook_retries_rate_limited_calls(fake):
+    """Test that calls answered with 429 are retried."""
+    # with this seed the 3rd and the 18th call are rate-limited
+    fake.random.seed(22)
+    fake.rate_limit_rate = 0.1
+    fake.retry_after = 0
+    assert post(EXAMPLE_PAYLOAD).status_code == 200
+    assert harmonizely_app.POOL.rate_limiter.stats()["retries"] >= 1
+
+
+def test_webhook_fails_on_errors(fake):
+    """Test that HubSpot errors are answered with 500."""
+    fake.error_rate = 1.0
+    assert post(EXAMPLE_PAYLOAD).status_code == 500
+
+
+def scrape(series):
+    """Get the value of a series on /metrics, 0 if it is missing."""
+    with harmonizely_app.APP.test_client() as client:
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    for line in response.get_data(as_text=True).splitlines():
+        name, _, value = line.rpartition(" ")
+        if name == series:
+            return float(value)
+    return 0
+
+
+def test_metrics_count_calls_by_operation(fake):
+    """Test that HubSpot calls and webhooks show up on /metrics."""
+    meetings = 'hubspot_requests_total{operation="create_meeting",status="201"}'
+    webhooks = 'webhook_request_duration_seconds_count{status="200"}'
+    requests = 'payload_hubspot_requests_sum{outcome="ok"}'
+    before = {series: scrape(series) for series in (meetings, webhooks, requests)}
+    assert post(EXAMPLE_PAYLOAD).status_code == 200
+    assert scrape(meetings) == before[meetings] + 1
+    assert scrape(webhooks) == before[webhooks] + 1
+    assert scrape(requests) == before[requests] + fake.calls.total()
+    assert scrape('hubspot_requests_total{operation="search_contact",status="404"}')
+    assert scrape(
+        'hubspot_requests_total{operation="associate_contact_to_deal",status="201"}'
+    )
+    assert scrape('payload_duration_seconds_count{outcome="ok"}')
+    assert scrape("payloads_in_flight") == 0
+
+
+def test_concurrent_webhooks_share_batch_calls(fake):
+    """Test that deals and meetings of concurrent payloads are created together."""
+    payloads = [
+        dict(
+            EXAMPLE_PAYLOAD,
+            uuid=f"batch-{number}",
+            invitee=dict(EXAMPLE_PAYLOAD["invitee"], email=f"i{number}@example.com"),
+            participants=[],
+        )
+        for number in range(4)
+    ]
+    batcher = hubspotclient.MicroBatcher(window=5, max_items=4)
+    observe = harmonizely_app.METRICS.observe
+    with (
+        patch.object(hubspotdeals, "BATCHER", batcher),
+        patch.object(harmonizely_app.METRICS, "observe", wraps=observe) as observed,
+        concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor,
+    ):
+        responses = list(executor.map(post, payloads))
+    assert [response.status_code for response in responses] == [200] * 4
+    assert fake.calls["create_deals"] == 1
+    assert fake.calls["create_meetings"] == 1
+    # the batched calls count evenly against the alike payloads, not the leader's
+    requests = [
+        call.args[1]
+        for call in observed.call_args_list
+        if call.args[0] == "payload_hubspot_requests"
+    ]
+    assert requests == pytest.approx([fake.calls.total() / 4] * 4)
+    for number in range(4):
+        contact_id = fake.contacts[f"i{number}@example.com"]["id"]
+        associated = collections.Counter(
+            to_type
+            for from_type, from_id, to_type, _ in fake.associations
+            if (from_type, from_id) == ("contacts", contact_id)
+        )
+        assert associated == {"deals": 1, "meetings": 1}
+
+
+def test_replicas_share_cached_contacts(fake, tmp_path):
+    """Test that a contact cached by one replica saves the other one a read."""
+
+    def replica():
+        return cache.SQLiteCache(
+            str(tmp_path / "cache.db"),
+            "contacts.v1",
+            ttl=60,
+            encode=hubspotcontacts.encode_contact,
+            decode=hubspotcontacts.decode_contact,
+        )
+
+    with patch.object(hubspotcontacts, "CONTACTS", replica()):
+        # creates the invitee and its deal, which invalidates the cached invitee
+        assert post(EXAMPLE_PAYLOAD).status_code == 200
+        assert post(EXAMPLE_PAYLOAD).status_code == 200
+    reads = fake.calls["get_contact"]
+    with patch.object(hubspotcontacts, "CONTACTS", replica()):
+        assert post(EXAMPLE_PAYLOAD).status_code == 200
+    assert fake.calls["get_contact"] == reads
+    assert fake.calls["create_deals"] == 1
+
+
+def test_webhook_logs_redacted_payload_and_ids(fake, caplog):
+    """Test that logged payloads leave out personal data and events carry IDs."""
+    # an existing contact without name and phone number is updated
+    fake.add_contact(
+        EXAMPLE_PAYLOAD["invitee"]["email"], firstname=None, lastname=None, phone=None
+    )
+    with caplog.at_level(logging.INFO):
+        assert post(EXAMPLE_PAYLOAD).status_code == 200
+    assert any("updating contacts" in r.getMessage() for r in caplog.records)
+    for personal in ("aarno.aukia@vshn.ch", "Aukia", "+41 44 545 53 00"):
+        assert not any(personal in r.getMessage() for r in caplog.records)
+    received = next(r for r in caplog.records if getattr(r, "event", "") == "webhook")
+    assert received.uuid == EXAMPLE_PAYLOAD["uuid"]
+    assert "aarno.aukia@vshn.ch" not in received.getMessage()
+    assert "[redacted]" in received.getMessage()
+    processed = next(
+        r for r in caplog.records if getattr(r, "event", "") == "processed"
+    )
+    assert processed.deal in fake.objects
+    assert processed.meeting in fake.objects
+    assert processed.duration_ms > 0
+
+
+def test_outage_spools_payloads_until_probe_succeeds(fake, tmp_path):
+    """Test that an open circuit spools payloads without calling HubSpot."""
+    spool_file = str(tmp_path / "spool.jsonl")
+    breaker = hubspotclient.CircuitBreaker(max_failures=1, reset_timeout=0.2)
+    harmonizely_app.POOL.circuit_breaker = breaker
+    fake.error_rate = 1.0
+    with (
+        patch.dict(harmonizely_app.CONFIG, spool_file=spool_file),
+        harmonizely_app.APP.test_client() as client,
+    ):
+        assert post(EXAMPLE_PAYLOAD).status_code == 500
+        calls = fake.calls.total()
+        assert post(EXAMPLE_PAYLOAD).status_code == 202
+        assert fake.calls.total() == calls
+        assert client.get("/").data == b"OK (HubSpot circuit breaker open)"
+
+        fake.error_rate = 0.0
+        time.sleep(0.2)
+        assert client.get("/").data == b"OK (HubSpot circuit breaker half-open)"
+        assert post(EXAMPLE_PAYLOAD).status_code == 200
+        assert client.get("/").data == b"OK"
+
+    assert replay.replay(spool_file, harmonizely_app.replay_payload) == (1, 0)
+    assert fake.calls["create_meetings"] == 2
+
+
+def test_participant_booking_reuses_deal_with_contact_cache(fake):
+    """Test that a cached participant sees the deal of a meeting it joined."""
+    participant = {"email": EXAMPLE_PAYLOAD["participants"][0]["email"]}
+    booking = dict(
+        EXAMPLE_PAYLOAD,
+        uuid="participant-booking",
+        invitee=dict(EXAMPLE_PAYLOAD["invitee"], **participant),
+        participants=[],
+    )
+    with patch.object(hubspotcontacts, "CONTACTS", cache.TTLCache(ttl=300)):
+        assert post(EXAMPLE_PAYLOAD).status_code == 200
+        assert post(booking).status_code == 200
+    assert fake.calls["create_deals"] == 1
+
+
+def test_answer_fields_for_all_event_types(fake):
+    """Test that "*" ANSWER_FIELDS keep the default fields and add new ones."""
+    extractor = answers.AnswerExtractor.from_json(
+        json.dumps({"*": {"meeting_title": ["topic"], "mobile": ["number"]}})
+    )
+    with patch.object(harmonizely_app, "ANSWERS", extractor):
+        assert post(EXAMPLE_PAYLOAD).status_code == 200
+    (meeting,) = [
+        stored
+        for stored in fake.objects.values()
+        if "hs_meeting_body" in stored["properties"]
+    ]
+    assert meeting["properties"]["hs_meeting_body"].endswith(
+        "\nmobile: " + EXAMPLE_PAYLOAD["answers"][0]["value"]
+    )
@@ -0,0 +1,310 @@
+"""Tests for the pooled HubSpot client layer."""
+
+import concurrent.futures
+import http.server
+import json
+import socket
+import threading
+import time
+from unittest.mock import MagicMock
+
+import hubspot
+import hubspot.crm.contacts
+import pytest
+
+import hubspotclient
+
+
+class ContactHandler(http.server.BaseHTTPRequestHandler):
+    """Answer every GET with the same contact over a kept-alive connection."""
+
+    protocol_version = "HTTP/1.1"
+    rate_limited = 0  # number of requests to answer with 429 first
+
+    def do_GET(self):  # noqa: N802
+        """Return a minimal contact object."""
+        if ContactHandler.rate_limited > 0:
+            ContactHandler.rate_limited -= 1
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = json.dumps(
+            {
+                "id": "1",
+                "properties": {"email": "a@example.com"},
+                "createdAt": "2024-01-01T00:00:00Z",
+                "updatedAt": "2024-01-01T00:00:00Z",
+                "archived": False,
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep the test output quiet."""
+
+
+def test_api_clients_are_shared():
+    """Test that all SDK packages reuse one client each and one pool manager."""
+    factory = hubspotclient.PooledApiFactory()
+    client = hubspot.HubSpot(access_token="fake", api_factory=factory)
+
+    contacts = client.crm.contacts.basic_api.api_client
+    assert client.crm.contacts.batch_api.api_client is contacts
+    deals = client.crm.deals.basic_api.api_client
+    assert deals is not contacts
+    assert deals.rest_client.pool_manager is contacts.rest_client.pool_manager
+    assert factory.stats()["api_clients"] == 2
+
+
+def test_connections_are_reused():
+    """Test that sequential calls reuse one kept-alive connection."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ContactHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    factory = hubspotclient.PooledApiFactory()
+    client = hubspot.HubSpot(
+        access_token="fake",
+        api_factory=factory,
+        host=f"http://127.0.0.1:{server.server_port}",
+    )
+    try:
+        for _ in range(3):
+            assert client.crm.contacts.basic_api.get_by_id("1").id == "1"
+    finally:
+        server.shutdown()
+
+    stats = factory.stats()
+    assert stats["requests"] == 3
+    assert stats["misses"] == 1
+    assert stats["hits"] == 2
+
+
+def test_unanswered_request_fails_once():
+    """Test that a hanging request fails after one timeout as an ApiException."""
+    # accepted by the backlog of the socket, but never answered
+    listener = socket.create_server(("127.0.0.1", 0))
+    breaker = hubspotclient.CircuitBreaker(max_failures=5, slow_call=None)
+    observer = MagicMock()
+    client = hubspot.HubSpot(
+        access_token="fake",
+        api_factory=hubspotclient.PooledApiFactory(
+            observer=observer, circuit_breaker=breaker, timeout=0.2
+        ),
+        host=f"http://127.0.0.1:{listener.getsockname()[1]}",
+    )
+    basic_api = client.crm.contacts.basic_api
+    started = time.monotonic()
+    try:
+        with pytest.raises(hubspot.crm.contacts.ApiException) as error:
+            basic_api.get_by_id("1")
+    finally:
+        listener.close()
+    assert time.monotonic() - started < 0.6
+    assert error.value.status == 0
+    assert "ReadTimeoutError" in error.value.reason
+    assert breaker.stats()["failures"] == 1
+    observer.assert_called_once()
+    assert observer.call_args.args[1] == "error"
+
+
+def test_association_batch_groups_and_chunks():
+    """Test that associations are grouped per object pair and chunked."""
+    batch = hubspotclient.AssociationBatch()
+    for contact_id in range(150):
+        batch.add(("Contact", "Meeting", "contact_to_meeting_event"), contact_id, "m")
+    batch.add(("Contact", "Meeting", "contact_to_meeting_event"), 0, "m")
+    batch.add(("Deals", "Meeting", "deal_to_meeting_event"), "d", "m")
+    assert len(batch) == 151
+
+    api_client = MagicMock()
+    assert batch.flush(api_client) == 151
+    calls = api_client.crm.associations.batch_api.create.call_args_list
+    assert [len(c.kwargs["batch_input_public_association"].inputs) for c in calls] == [
+        100,
+        50,
+        1,
+    ]
+    assert len(batch) == 0
+
+
+def test_rate_limiter_throttles():
+    """Test that calls beyond the bucket size wait for a refill."""
+    limiter = hubspotclient.RateLimiter(limits=[(2, 0.2)])
+    started = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+    assert time.monotonic() - started >= 0.09
+    assert limiter.stats()["waiting"] == 0
+    assert limiter.stats()["throttled_seconds"] >= 0.09
+
+
+def test_rate_limiter_retries_rate_limited_requests():
+    """Test that 429 responses are retried after Retry-After."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ContactHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    limiter = hubspotclient.RateLimiter(max_retries=2)
+    client = hubspot.HubSpot(
+        access_token="fake",
+        api_factory=hubspotclient.PooledApiFactory(rate_limiter=limiter),
+        host=f"http://127.0.0.1:{server.server_port}",
+    )
+    ContactHandler.rate_limited = 2
+    try:
+        assert client.crm.contacts.basic_api.get_by_id("1").id == "1"
+        ContactHandler.rate_limited = 3
+        with pytest.raises(hubspot.crm.contacts.ApiException) as error:
+            client.crm.contacts.basic_api.get_by_id("1")
+        assert error.value.status == 429
+    finally:
+        ContactHandler.rate_limited = 0
+        server.shutdown()
+    assert limiter.stats()["retries"] == 4
+
+
+def test_observer_sees_each_attempt_by_operation():
+    """Test that the observer gets the operation and status of every attempt."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ContactHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    observed = []
+    client = hubspot.HubSpot(
+        access_token="fake",
+        api_factory=hubspotclient.PooledApiFactory(
+            rate_limiter=hubspotclient.RateLimiter(max_retries=1),
+            observer=lambda *args: observed.append(args),
+        ),
+        host=f"http://127.0.0.1:{server.server_port}",
+    )
+    ContactHandler.rate_limited = 1
+    try:
+        with hubspotclient.operation("get_contact"):
+            client.crm.contacts.basic_api.get_by_id("1")
+        client.crm.contacts.basic_api.get_by_id("1")
+    finally:
+        ContactHandler.rate_limited = 0
+        server.shutdown()
+    assert [(name, status) for name, status, _ in observed] == [
+        ("get_contact", "429"),
+        ("get_contact", "200"),
+        ("other", "200"),
+    ]
+    assert all(seconds >= 0 for _, _, seconds in observed)
+
+
+def test_micro_batcher_combines_concurrent_items():
+    """Test that items of concurrent threads share one call and get their results."""
+    calls = []
+
+    def send(items):
+        calls.append(items)
+        return [item * 10 for item in items]
+
+    batcher = hubspotclient.MicroBatcher(window=5, max_items=4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(batcher.submit, "key", send, items)
+            for items in ([1], [2, 3], [4])
+        ]
+        results = [future.result(timeout=5) for future in futures]
+    assert results == [[10], [20, 30], [40]]
+    assert len(calls) == 1
+    assert sorted(calls[0]) == [1, 2, 3, 4]
+    assert batcher.stats() == {"batches": 1, "items": 4}
+
+
+def test_micro_batcher_does_not_wait_when_idle():
+    """Test that a lone item is sent right away and errors reach the caller."""
+    batcher = hubspotclient.MicroBatcher(window=5, busy=lambda: False)
+    started = time.monotonic()
+    assert batcher.submit("key", lambda items: items, ["a"]) == ["a"]
+    assert time.monotonic() - started < 1
+
+    def fail(_items):
+        raise ValueError("batch failed")
+
+    with pytest.raises(ValueError, match="batch failed"):
+        batcher.submit("key", fail, ["b"])
+
+
+def test_micro_batcher_fails_only_rejected_items():
+    """Test that a rejected batch is resent per thread to isolate the error."""
+    calls = []
+
+    def send(items):
+        calls.append(sorted(items))
+        if "invalid" in items:
+            raise hubspot.crm.contacts.ApiException(status=400)
+        return [ValueError("missing") if item == "lost" else item for item in items]
+
+    batcher = hubspotclient.MicroBatcher(window=5, max_items=4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(batcher.submit, "key", send, items)
+            for items in (["a"], ["invalid", "b"], ["lost"])
+        ]
+        concurrent.futures.wait(futures, timeout=5)
+    assert futures[0].result() == ["a"]
+    assert futures[1].exception().status == 400
+    assert isinstance(futures[2].exception(), ValueError)
+    assert calls[0] == ["a", "b", "invalid", "lost"]
+    assert sorted(calls[1:]) == [["a"], ["b", "invalid"], ["lost"]]
+
+
+def test_circuit_breaker_opens_and_probes():
+    """Test that failures open the circuit and a successful probe closes it."""
+    breaker = hubspotclient.CircuitBreaker(
+        max_failures=2, slow_call=None, reset_timeout=0.1
+    )
+
+    def fail(status):
+        raise hubspot.crm.contacts.ApiException(status=status)
+
+    # a 404 is answered by HubSpot and resets the consecutive failures, the
+    # SDK raises status 0 for SSL and connection errors
+    for status in (500, 404, 0, 503):
+        with pytest.raises(hubspot.crm.contacts.ApiException):
+            breaker.call(breaker.send, fail, status)
+    assert breaker.state() == "open"
+    with pytest.raises(hubspotclient.CircuitOpenError):
+        breaker.call(breaker.send, lambda: "not sent")
+
+    time.sleep(0.1)
+    assert breaker.state() == "half-open"
+    with pytest.raises(hubspot.crm.contacts.ApiException):
+        breaker.call(breaker.send, fail, 500)
+    assert breaker.state() == "open"
+    time.sleep(0.1)
+    assert breaker.call(breaker.send, lambda: "probe") == "probe"
+    assert breaker.state() == "closed"
+    assert breaker.stats() == {
+        "opened": 2,
+        "rejected": 1,
+        "state": "closed",
+        "failures": 0,
+    }
+
+
+def test_circuit_breaker_ignores_rate_limiter_waits():
+    """Test that waiting for the rate limiter does not count as a slow call."""
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ContactHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    breaker = hubspotclient.CircuitBreaker(max_failures=2, slow_call=0.5)
+    client = hubspot.HubSpot(
+        access_token="fake",
+        api_factory=hubspotclient.PooledApiFactory(
+            rate_limiter=hubspotclient.RateLimiter(limits=[(1, 0.6)]),
+            circuit_breaker=breaker,
+        ),
+        host=f"http://127.0.0.1:{server.server_port}",
+    )
+    try:
+        for _ in range(3):
+            assert client.crm.contacts.basic_api.get_by_id("1").id == "1"
+    finally:
+        server.shutdown()
+    assert breaker.stats()["state"] == "closed"
+    assert breaker.stats()["failures"] == 0
@@ -0,0 +1,160 @@
+"""Tests for the HubSpot contacts of a meeting."""
+
+import datetime
+import json
+from unittest.mock import MagicMock, patch
+
+import flask
+import pytest
+from hubspot.crm.contacts import (
+    ApiException,
+    AssociatedId,
+    CollectionResponseAssociatedId,
+    SimplePublicObjectWithAssociations,
+)
+
+import cache
+import hubspotcontacts
+
+APP = flask.Flask(__name__)
+
+
+def test_parse_name():
+    """Test name parsing from full name string."""
+    first, last = hubspotcontacts.parse_name("Aarno Aukia")
+    assert first == "Aarno"
+    assert last == "Aukia"
+
+
+def test_parse_name_with_title():
+    """Test that Herr/Frau titles are stripped."""
+    first, last = hubspotcontacts.parse_name("Herr Max Mustermann")
+    assert first == "Max"
+    assert last == "Mustermann"
+
+
+def test_parse_name_with_middle():
+    """Test that middle names are included in first name."""
+    first, last = hubspotcontacts.parse_name("Johann Sebastian Bach")
+    assert first == "Johann Sebastian"
+    assert last == "Bach"
+
+
+@pytest.fixture(name="name_titles")
+def fixture_name_titles(monkeypatch):
+    """Restore NAME_TITLES and the names parsed with them after a test."""
+    monkeypatch.setattr(
+        hubspotcontacts, "NAME_TITLES", list(hubspotcontacts.NAME_TITLES)
+    )
+    yield hubspotcontacts.NAME_TITLES
+    monkeypatch.undo()
+    hubspotcontacts.name_constants.cache_clear()
+    hubspotcontacts.parse_name.cache_clear()
+
+
+@pytest.mark.usefixtures("name_titles")
+def test_configure_name_titles():
+    """Test that configured titles are removed from names parsed before."""
+    assert hubspotcontacts.parse_name("Doktorin Eva Muster") == (
+        "Doktorin Eva",
+        "Muster",
+    )
+    hubspotcontacts.configure_name_titles(["Doktorin"])
+    assert hubspotcontacts.parse_name("Doktorin Eva Muster") == ("Eva", "Muster")
+
+
+def test_name_titles_are_restored():
+    """Test that titles configured by other tests do not leak."""
+    assert "Doktorin" not in hubspotcontacts.NAME_TITLES
+    assert hubspotcontacts.parse_name("Doktorin Eva Muster") == (
+        "Doktorin Eva",
+        "Muster",
+    )
+
+
+def test_search_contact_cached():
+    """Test that contacts and not-found emails are served from the cache."""
+    api_client = MagicMock()
+    contact = MagicMock(properties={"email": "a@example.com"})
+    api_client.crm.contacts.basic_api.get_by_id.side_effect = [
+        contact,
+        ApiException(status=404),
+    ]
+    with (
+        APP.app_context(),
+        patch.object(hubspotcontacts, "CONTACTS", cache.TTLCache(ttl=60)),
+    ):
+        flask.g.api_client = api_client
+        assert hubspotcontacts.search_contact("A@example.com") is contact
+        assert hubspotcontacts.search_contact("a@example.com ") is contact
+        assert hubspotcontacts.search_contact("new@example.com") is None
+        assert hubspotcontacts.search_contact("new@example.com") is None
+    assert api_client.crm.contacts.basic_api.get_by_id.call_count == 2
+
+
+def test_hubspot_update_writes_through():
+    """Test that updated properties are visible in the cached contact."""
+    contacts = cache.TTLCache(ttl=60)
+    contact = SimplePublicObjectWithAssociations(
+        id="1", properties={"email": "a@example.com", "phone": None}
+    )
+    with APP.app_context(), patch.object(hubspotcontacts, "CONTACTS", contacts):
+        flask.g.api_client = MagicMock()
+        hubspotcontacts.hubspot_update([(contact, {"phone": "+41 44 545 53 00"})])
+    assert contacts.get("a@example.com").properties["phone"] == "+41 44 545 53 00"
+
+
+def test_contact_cache_encoding():
+    """Test that contacts survive the JSON encoding of a shared cache."""
+    contact = SimplePublicObjectWithAssociations(
+        id="1",
+        properties={"email": "a@example.com", "phone": None},
+        created_at=datetime.datetime(2024, 1, 1, tzinfo=datetime.UTC),
+        updated_at=datetime.datetime(2024, 1, 2, tzinfo=datetime.UTC),
+        archived=False,
+        associations={
+            "deals": CollectionResponseAssociatedId(
+                results=[AssociatedId(id="7", type="contact_to_deal")]
+            )
+        },
+    )
+    data = json.loads(json.dumps(hubspotcontacts.encode_contact(contact)))
+    assert hubspotcontacts.decode_contact(data) == contact
+    assert hubspotcontacts.decode_contact(hubspotcontacts.encode_contact(None)) is None
+
+
+def test_contact_fixups():
+    """Test the name and phone number fix-ups of existing contacts."""
+    contact = MagicMock(
+        properties={
+            "firstname": "Max Mustermann",
+            "lastname": "Mustermann",
+            "phone": "+41445455300",
+        }
+    )
+    # the unchanged lastname is not written again
+    assert hubspotcontacts.contact_fixups(contact, "Max", "Mustermann") == {
+        "firstname": "Max",
+        "phone": "+41 44 545 53 00",
+    }
+    contact.properties = {"firstname": "Max", "lastname": "Muster", "phone": None}
+    assert hubspotcontacts.contact_fixups(contact, "Max", "Muster", "+4144") == {
+        "phone": "+4144"
+    }
+    contact.properties = {
+        "firstname": "Max",
+        "lastname": "Muster",
+        "phone": "0445455300",
+    }
+    assert hubspotcontacts.contact_fixups(contact, "Max", "Muster") == {}
+    assert hubspotcontacts.contact_fixups(
+        contact, "Max", "Muster", phone_region="CH"
+    ) == {"phone": "+41 44 545 53 00"}
+
+    # a participant created with its email only, as echoed by the batch create
+    contact.properties = {"email": "p@example.com"}
+    assert hubspotcontacts.contact_fixups(contact) == {}
+    assert hubspotcontacts.contact_fixups(contact, "Max", "Muster") == {
+        "firstname": "Max",
+        "lastname": "Muster",
+    }
@@ -0,0 +1,55 @@
+"""Tests for the HubSpot deals and meetings of a payload."""
+
+from unittest.mock import MagicMock, patch
+
+import flask
+import hubspot
+
+import cache
+import hubspotdeals
+
+APP = flask.Flask(__name__)
+
+
+def test_create_objects_fails_only_missing_results():
+    """Test that an object missing in the response only fails its own input."""
+    api_client = MagicMock()
+    api_client.crm.objects.batch_api.create.return_value = MagicMock(
+        results=[MagicMock(id="meeting-1", object_write_trace_id="1")]
+    )
+    with APP.app_context():
+        flask.g.api_client = api_client
+        missing, created = hubspotdeals.create_objects("meetings", [{}, {}])
+    assert isinstance(missing, hubspot.crm.objects.ApiException)
+    assert created.id == "meeting-1"
+
+
+def test_find_first_non_closed_deal():
+    """Test that the first open deal in association order is selected."""
+    deals = {
+        "1": MagicMock(id="1", properties={"dealstage": "closedwon"}),
+        "2": MagicMock(id="2", properties={"dealstage": "appointmentscheduled"}),
+        "3": MagicMock(id="3", properties={"dealstage": "qualifiedtobuy"}),
+    }
+    api_client = MagicMock()
+    api_client.crm.deals.batch_api.read.side_effect = lambda batch_read_input: (
+        MagicMock(results=[deals[x.id] for x in batch_read_input.inputs])
+    )
+    with APP.app_context(), patch.object(hubspotdeals, "DEALS", cache.TTLCache(ttl=60)):
+        flask.g.api_client = api_client
+        associations = [MagicMock(id=deal_id) for deal_id in deals]
+        assert hubspotdeals.find_first_non_closed_deal(associations).id == "2"
+        # served from the cache
+        assert hubspotdeals.find_first_non_closed_deal(associations).id == "2"
+
+        # custom pipelines have stage IDs without "closed"
+        with patch.object(
+            hubspotdeals,
+            "CLOSED_DEAL_STAGES",
+            ["closedwon", "appointmentscheduled"],
+        ):
+            assert hubspotdeals.find_first_non_closed_deal(associations).id == "3"
+    assert api_client.crm.deals.batch_api.read.call_count == 1
+    assert api_client.crm.deals.batch_api.read.call_args.args[0].properties == [
+        "dealstage"
+    ]
@@ -0,0 +1,48 @@
+"""Tests for the webhook delivery idempotency store."""
+
+import pytest
+
+import idempotency
+
+
+def test_begin_finish(tmp_path):
+    """Test that a finished key returns its stored result."""
+    store = idempotency.IdempotencyStore(str(tmp_path / "idempotency.db"))
+    assert store.begin("uuid") is None
+    store.finish("uuid", {"meeting": "1"})
+    assert store.begin("uuid") == {"meeting": "1"}
+
+
+def test_in_flight_duplicate(tmp_path):
+    """Test that a duplicate of a key being processed times out."""
+    store = idempotency.IdempotencyStore(
+        str(tmp_path / "idempotency.db"), poll_interval=0.01
+    )
+    assert store.begin("uuid") is None
+    with pytest.raises(idempotency.InFlightError):
+        store.begin("uuid", timeout=0.05)
+
+
+def test_release_and_expired_lease(tmp_path):
+    """Test that released keys and keys with expired leases can be claimed."""
+    path = str(tmp_path / "idempotency.db")
+    store = idempotency.IdempotencyStore(path)
+    assert store.begin("uuid") is None
+    store.release("uuid")
+    assert store.begin("uuid", timeout=0) is None
+
+    expired = idempotency.IdempotencyStore(path, lease=-1)
+    assert expired.begin("other") is None
+    assert expired.begin("other", timeout=0) is None
+
+
+def test_compaction(tmp_path):
+    """Test that entries older than the ttl are deleted."""
+    store = idempotency.IdempotencyStore(str(tmp_path / "idempotency.db"), ttl=-1)
+    assert store.begin("uuid") is None
+    store.finish("uuid", {})
+    store.compact()
+    # the first begin() already compacted within the last hour
+    assert store.begin("uuid") == {}
+    store._last_compaction = 0  # pylint: disable=protected-access
+    assert store.begin("uuid") is None
@@ -0,0 +1,66 @@
+"""Tests for the durable webhook job queue."""
+
+import concurrent.futures
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+import jobqueue
+
+
+def test_put_get_done(tmp_path):
+    """Test that jobs are returned in order and removed when done."""
+    queue = jobqueue.JobQueue(str(tmp_path / "queue.db"))
+    queue.put("user@example.com", {"uuid": "1"})
+    queue.put("user@example.com", {"uuid": "2"})
+    assert queue.depth() == 2
+
+    job_id, user_email, payload = queue.get(timeout=0)
+    assert user_email == "user@example.com"
+    assert payload == {"uuid": "1"}
+    assert queue.depth() == 1
+
+    queue.done(job_id)
+    assert queue.get(timeout=0)[2] == {"uuid": "2"}
+    assert queue.get(timeout=0) is None
+
+
+def test_retry_backoff_and_failure(tmp_path):
+    """Test that failed jobs are delayed and parked after max_attempts."""
+    queue = jobqueue.JobQueue(str(tmp_path / "queue.db"), max_attempts=2)
+    job_id = queue.put("user@example.com", {})
+    queue.get(timeout=0)
+
+    assert queue.retry(job_id, "boom") == "queued"
+    # the retry is delayed, so the job is not runnable yet
+    assert queue.get(timeout=0) is None
+
+    assert queue.retry(job_id, "boom") == "failed"
+    assert queue.depth() == 0
+
+
+def test_running_jobs_recovered(tmp_path):
+    """Test that jobs claimed by a crashed process are queued again."""
+    path = str(tmp_path / "queue.db")
+    queue = jobqueue.JobQueue(path)
+    queue.put("user@example.com", {"uuid": "1"})
+    assert queue.get(timeout=0) is not None
+
+    restarted = jobqueue.JobQueue(path)
+    assert restarted.get(timeout=0)[2] == {"uuid": "1"}
+
+
+def test_threads_share_one_connection(tmp_path):
+    """Test that short-lived threads do not open a connection each."""
+    with patch("jobqueue.sqlite3.connect", wraps=sqlite3.connect) as connect:
+        queue = jobqueue.JobQueue(str(tmp_path / "queue.db"))
+        for number in range(8):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(queue.put, ["user@example.com"] * 4, [{}] * 4))
+            assert queue.depth() == 4 * (number + 1)
+    assert connect.call_count == 1
+
+    queue.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        queue.depth()
@@ -0,0 +1,63 @@
+"""Tests for the logging helpers."""
+
+import json
+import logging
+from unittest.mock import patch
+
+import logs
+
+
+def test_json_formatter_includes_extra_fields():
+    """Test that a record becomes one JSON line with its extra fields."""
+    record = logging.makeLogRecord(
+        {
+            "name": "app",
+            "levelno": logging.INFO,
+            "levelname": "INFO",
+            "msg": "processed %s",
+            "args": ("payload",),
+            "uuid": "1",
+            "duration_ms": 12.5,
+        }
+    )
+    line = logs.JSONFormatter().format(record)
+    assert "\n" not in line
+    event = json.loads(line)
+    assert event["message"] == "processed payload"
+    assert event["level"] == "INFO"
+    assert event["logger"] == "app"
+    assert event["uuid"] == "1"
+    assert event["duration_ms"] == 12.5
+    assert "args" not in event
+
+
+def test_pretty_formats_only_emitted_records(caplog):
+    """Test that nothing is formatted for disabled levels."""
+    logger = logging.getLogger("test_logs")
+    with patch("logs.pprint.pformat", return_value="formatted") as pformat:
+        with caplog.at_level(logging.INFO, logger="test_logs"):
+            logger.debug("value: %s", logs.Pretty({"a": 1}))
+            pformat.assert_not_called()
+            logger.info("value: %s", logs.Pretty({"a": 1}))
+        pformat.assert_called_once_with({"a": 1})
+    assert caplog.messages == ["value: formatted"]
+
+
+def test_redact_fields_and_truncate():
+    """Test redaction by dotted path, also within lists, and truncation."""
+    payload = {
+        "uuid": "1",
+        "invitee": {"email": "a@example.com", "timezone": "Europe/Zurich"},
+        "answers": [{"question_label": "Phone", "value": "+41 44 545 53 00"}],
+        "location": "x" * 12,
+    }
+    assert logs.redact(payload, ["invitee.email", "answers.value"], 10) == {
+        "uuid": "1",
+        "invitee": {
+            "email": logs.REDACTED,
+            "timezone": "Europe/Zur... (13 characters)",
+        },
+        "answers": [{"question_label": "Phone", "value": logs.REDACTED}],
+        "location": "xxxxxxxxxx... (12 characters)",
+    }
+    assert logs.redact(payload) == payload
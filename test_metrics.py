@@ -0,0 +1,44 @@
+"""Tests for the Prometheus metrics registry."""
+
+import metrics
+
+
+def test_counter_by_labels():
+    """Test that counters are rendered per label set."""
+    registry = metrics.Registry()
+    registry.counter("calls_total", "Calls")
+    registry.inc("calls_total", operation="b", status="200")
+    registry.inc("calls_total", operation="a", status="200")
+    registry.inc("calls_total", 2, status="200", operation="a")
+    assert registry.render().splitlines() == [
+        "# HELP calls_total Calls",
+        "# TYPE calls_total counter",
+        'calls_total{operation="a",status="200"} 3',
+        'calls_total{operation="b",status="200"} 1',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    """Test bucket boundaries, sum and count of a histogram."""
+    registry = metrics.Registry(buckets=(0.1, 1))
+    registry.histogram("duration_seconds", "Duration")
+    for value in (0.05, 0.1, 0.5, 3):
+        registry.observe("duration_seconds", value)
+    assert registry.render(gauges=[("queued", "Queued", 2)]).splitlines() == [
+        "# HELP duration_seconds Duration",
+        "# TYPE duration_seconds histogram",
+        'duration_seconds_bucket{le="0.1"} 2',
+        'duration_seconds_bucket{le="1"} 3',
+        'duration_seconds_bucket{le="+Inf"} 4',
+        "duration_seconds_sum 3.65",
+        "duration_seconds_count 4",
+        "# HELP queued Queued",
+        "# TYPE queued gauge",
+        "queued 2",
+    ]
+
+
+def test_label_values_are_escaped():
+    """Test escaping of quotes, backslashes and newlines in label values."""
+    assert metrics.format_labels([("path", 'a"b\\c\nd')]) == ('{path="a\\"b\\\\c\\nd"}')
+    assert metrics.format_labels([]) == ""
@@ -0,0 +1,31 @@
+"""Tests for the phone number normalization."""
+
+import phones
+
+
+def test_normalize():
+    """Test international and local numbers with and without a region."""
+    assert phones.normalize("+41445455300") == "+41 44 545 53 00"
+    assert phones.normalize("044 545 53 00") == "044 545 53 00"
+    assert phones.normalize("044 545 53 00", "CH") == "+41 44 545 53 00"
+    assert phones.normalize("+41445455300", "DE") == "+41 44 545 53 00"
+    assert phones.normalize("12", "CH") == "12"
+    assert phones.normalize("not a number", "CH") == "not a number"
+    assert phones.normalize("") == ""
+
+
+def test_normalize_cached():
+    """Test that the same number and region is only parsed once."""
+    phones.normalize.cache_clear()
+    phones.normalize("044 545 53 00", "CH")
+    phones.normalize("044 545 53 00", "CH")
+    assert phones.normalize.cache_info().hits == 1
+
+
+def test_default_region():
+    """Test the region from the locale, or else the timezone."""
+    assert phones.default_region("de_CH", "Europe/Berlin") == "CH"
+    assert phones.default_region("de-at") == "AT"
+    assert phones.default_region("en", "Europe/Berlin") in ("DE", None)
+    assert phones.default_region("en", "Mars/Olympus_Mons") is None
+    assert phones.default_region(None, None) is None
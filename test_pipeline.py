@@ -0,0 +1,70 @@
+"""Tests for the dependency graph execution of payload steps."""
+
+import contextvars
+import threading
+
+import pytest
+
+import pipeline
+
+VARIABLE = contextvars.ContextVar("VARIABLE")
+
+
+def test_run_passes_dependency_results():
+    """Test that steps get the results of their dependencies."""
+    results, trace = pipeline.run(
+        {
+            "sum": (lambda a, b: a + b, ["a", "b"]),
+            "a": (lambda: 1, []),
+            "b": (lambda a: a + 1, ["a"]),
+        }
+    )
+    assert results == {"a": 1, "b": 2, "sum": 3}
+    assert trace["a"][1] <= trace["b"][0]
+    assert trace["b"][1] <= trace["sum"][0]
+
+
+def test_run_overlaps_independent_steps():
+    """Test that independent steps run at the same time with the context."""
+    barrier = threading.Barrier(2, timeout=5)
+    VARIABLE.set("value")
+
+    def step():
+        barrier.wait()
+        return VARIABLE.get()
+
+    results, trace = pipeline.run({"a": (step, []), "b": (step, [])})
+    assert results == {"a": "value", "b": "value"}
+    assert "a" in pipeline.describe(trace).split("parallel with ", 1)[1]
+
+
+def test_run_stops_after_failure():
+    """Test that a failing step is raised and its dependents are not run."""
+    called = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError, match="boom"):
+        pipeline.run(
+            {
+                "fail": (fail, []),
+                "after": (lambda fail: called.append(fail), ["fail"]),
+            }
+        )
+    assert not called
+
+
+def test_run_rejects_unknown_dependencies():
+    """Test that steps depending on missing steps are reported."""
+    with pytest.raises(ValueError, match="orphan"):
+        pipeline.run({"orphan": (lambda missing: missing, ["missing"])})
+
+
+def test_map_concurrently_keeps_order_and_context():
+    """Test that concurrent calls see the context and keep the item order."""
+    VARIABLE.set("value")
+    results = pipeline.map_concurrently(
+        lambda item: (item, VARIABLE.get()), range(10), max_workers=3
+    )
+    assert results == [(item, "value") for item in range(10)]
@@ -0,0 +1,38 @@
+"""Tests for the replay of spooled webhook payloads."""
+
+import json
+from unittest.mock import MagicMock, call
+
+import replay
+
+
+def test_replay_checkpoints_and_resumes(tmp_path):
+    """Test that a replay records failures and resumes after the checkpoint."""
+    path = tmp_path / "payloads.jsonl"
+    path.write_text(
+        json.dumps({"id": 1})
+        + "\n\n"
+        + json.dumps({"invitee": {}})
+        + "\n"
+        + json.dumps({"user_email": "other@example.com", "payload": {"id": 2}})
+        + "\n"
+    )
+
+    def fail_incomplete(user_email, payload):  # pylint: disable=unused-argument
+        if "invitee" in payload:
+            raise ValueError("missing payload fields: invitee.email")
+
+    process = MagicMock(side_effect=fail_incomplete)
+    assert replay.replay(str(path), process, "user@example.com", batch_size=2) == (
+        2,
+        1,
+    )
+    # the user_email of a job overrides the default one
+    assert call("user@example.com", {"id": 1}) in process.call_args_list
+    assert call("other@example.com", {"id": 2}) in process.call_args_list
+    assert (tmp_path / "payloads.jsonl.checkpoint").read_text() == "4"
+    assert "invitee" in (tmp_path / "payloads.jsonl.failed").read_text()
+
+    # nothing left to do
+    assert replay.replay(str(path), process, "user@example.com") == (0, 0)
+    assert process.call_count == 3
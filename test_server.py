@@ -0,0 +1,42 @@
+"""Tests for serving the app."""
+
+import subprocess
+import sys
+from unittest.mock import patch
+
+import app as harmonizely_app
+import server
+
+
+def test_serve_uses_waitress(monkeypatch):
+    """Test that the app is served by waitress unless SERVER=development."""
+    monkeypatch.setenv("THREADS", "16")
+    with patch("server.waitress.create_server") as mock_create, patch("server.signal"):
+        server.serve(harmonizely_app.APP, port=8081)
+    assert mock_create.call_args.args == (harmonizely_app.APP,)
+    assert mock_create.call_args.kwargs["port"] == 8081
+    assert mock_create.call_args.kwargs["threads"] == 16
+    mock_create.return_value.run.assert_called_once()
+
+    monkeypatch.setenv("SERVER", "development")
+    with (
+        patch("server.waitress.create_server") as mock_create,
+        patch.object(harmonizely_app.APP, "run") as mock_run,
+    ):
+        server.serve(harmonizely_app.APP, port=8081)
+    mock_create.assert_not_called()
+    mock_run.assert_called_once_with(host="0.0.0.0", port=8081)
+
+
+def test_heavy_modules_are_imported_lazily():
+    """Test that importing the app leaves the slow modules to warm_up()."""
+    code = (
+        "import sys, app, server;"
+        "print(sorted(set(server.WARM_UP_MODULES + ['sentry_sdk']) & set(sys.modules)));"
+        "server.warm_up();"
+        "print(sorted(set(server.WARM_UP_MODULES) - set(sys.modules)))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.splitlines() == ["[]", "[]"]